@@ -1,14 +1,140 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response, g, abort, Response, stream_with_context, has_request_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
+from sqlalchemy import func, extract, case, update, insert, delete, select, literal, or_, event, tuple_, bindparam, inspect
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError
+from sqlalchemy.orm import Session, selectinload, joinedload
+from jinja2 import FileSystemBytecodeCache
+from datetime import datetime, timedelta, date
+from collections import defaultdict, namedtuple, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlencode
+import atexit
+import click
+import csv
+import hashlib
+import io
+import json
+import math
 import os
+import queue
 import random
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///subscriptions.db'
+class SubscriptionApp(Flask):
+    """Flask app that runs create_app() before its first app context.
+
+    Requests, CLI commands, test clients and `with app.app_context()` all
+    start here, so importing the module binds nothing and create_app(config)
+    can still change the configuration.
+    """
+
+    def app_context(self):
+        create_app()
+        return super().app_context()
+
+app = SubscriptionApp(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///subscriptions.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 30))  # seconds, 0 disables
+app.config['CHATBOT_WORKERS'] = int(os.environ.get('CHATBOT_WORKERS', 4))
+app.config['CHATBOT_MAX_PENDING'] = int(os.environ.get('CHATBOT_MAX_PENDING', 32))
+app.config['CHATBOT_PROVIDER_TIMEOUT'] = 10  # seconds
+app.config['CHATBOT_JOB_TIMEOUT'] = 120  # seconds before a job with no stored reply counts as failed
+app.config['CHATBOT_TRANSPORT'] = None  # callable(url, payload, headers, timeout) -> dict; None uses urllib
+app.config['CHAT_CONTEXT_CACHE_SIZE'] = 1024  # users
+app.config['CHAT_CONTEXT_TTL'] = 300  # seconds
+app.config['IDENTITY_RECHECK_SECONDS'] = int(os.environ.get('IDENTITY_RECHECK_SECONDS', 60))  # user routes; admin routes always re-check
+app.config['IDENTITY_CACHE_SIZE'] = 4096  # users
+app.config['NOTIFICATION_WINDOW_SECONDS'] = 10  # initial notifications only shortly after login
+app.config['NOTIFICATION_SCAN_INTERVAL'] = int(os.environ.get('NOTIFICATION_SCAN_INTERVAL', 60))  # seconds
+app.config['NOTIFICATION_FANOUT_INTERVAL'] = float(os.environ.get('NOTIFICATION_FANOUT_INTERVAL', 2))  # seconds between discount stamp checks
+app.config['NOTIFICATION_HEARTBEAT'] = 15  # seconds between SSE keepalive comments
+app.config['NOTIFICATION_STREAM_TIMEOUT'] = 300  # seconds before the browser is asked to reconnect
+app.config['NOTIFICATION_MAX_STREAMS'] = int(os.environ.get('NOTIFICATION_MAX_STREAMS', 1000))  # per worker; serve.py lowers it
+app.config['NOTIFICATION_STREAMS_PER_USER'] = int(os.environ.get('NOTIFICATION_STREAMS_PER_USER', 3))  # per worker; the oldest is evicted
+app.config['BILLING_PAGE_SIZE'] = 50
+app.config['EXPORT_CHUNK_ROWS'] = 1000  # rows fetched and flushed per chunk of a streamed export
+app.config['LIFECYCLE_CHUNK_SIZE'] = 5000  # subscriptions per lifecycle transaction
+app.config['LIFECYCLE_INTERVAL'] = int(os.environ.get('LIFECYCLE_INTERVAL', 0))  # seconds between in-process sweeps, 0 disables
+app.config['QUERY_BUDGET_STRICT'] = False  # raise instead of logging when a route exceeds its budget
+app.config['STORAGE_PROFILE'] = os.environ.get('STORAGE_PROFILE', 'wal')  # see STORAGE_PROFILES
+app.config['AUDIT_MODE'] = os.environ.get('AUDIT_MODE', 'async')  # 'sync' writes audit rows in the caller's transaction
+app.config['AUDIT_BATCH_SIZE'] = 500  # entries per batched insert
+app.config['AUDIT_FLUSH_INTERVAL'] = 1.0  # seconds an entry may wait for its batch
+app.config['AUDIT_QUEUE_MAX'] = 10000
+app.config['AUDIT_MAX_RETRIES'] = 3  # attempts at a failed batch before its rows are written one by one
+app.config['AUDIT_RETENTION_DAYS'] = int(os.environ.get('AUDIT_RETENTION_DAYS', 365))
+app.config['AUDIT_ARCHIVE_DIR'] = os.environ.get('AUDIT_ARCHIVE_DIR', os.path.join(app.instance_path, 'audit_archive'))
+app.config['AUDIT_ARCHIVE_CHUNK'] = 5000  # rows archived and deleted per transaction
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))  # seconds to wait for a free connection
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # 'shared' for one budget across processes
+app.config['RATE_LIMIT_SHARED_PATH'] = os.environ.get('RATE_LIMIT_SHARED_PATH', os.path.join(app.instance_path, 'rate_limits.bin'))
+app.config['RATE_LIMIT_SHARED_SLOTS'] = 65536  # buckets in the shared file, 24 bytes each
+app.config['JINJA_BYTECODE_CACHE'] = os.environ.get('JINJA_BYTECODE_CACHE', '')  # directory for compiled templates, '' disables
 app.secret_key = 'dev-secret-key-change-me'
-db = SQLAlchemy(app)
+
+# Storage profile
+# SQLite pragmas applied to every new connection. 'wal' lets readers run
+# alongside the single writer and makes writers wait (busy_timeout) instead
+# of failing with "database is locked"; synchronous=NORMAL is durable in WAL
+# mode except for the last transactions before a power loss. 'rollback' is
+# SQLite's default journal. Individual values can be overridden with
+# SQLITE_PRAGMAS="cache_size=-131072,mmap_size=0".
+STORAGE_PROFILES = {
+    'wal': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'busy_timeout': 5000,  # ms
+        'cache_size': -65536,  # KiB, i.e. 64 MB per connection
+        'mmap_size': 268435456,
+        'temp_store': 'memory',
+    },
+    'rollback': {
+        'journal_mode': 'delete',
+        'synchronous': 'full',
+        'busy_timeout': 5000,
+    },
+}
+
+def sqlite_pragmas(profile, overrides=''):
+    pragmas = dict(STORAGE_PROFILES[profile])
+    for item in filter(None, (part.strip() for part in overrides.split(','))):
+        name, _, value = item.partition('=')
+        pragmas[name.strip()] = value.strip()
+    return pragmas
+
+def engine_options(config):
+    database_url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if database_url.get_backend_name() == 'sqlite' and database_url.database in (None, '', ':memory:'):
+        return {}  # in-memory SQLite uses a single shared connection, so there is no pool to size
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+    }
+
+@event.listens_for(Engine, 'connect')
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    import sqlite3  # already loaded by the pysqlite dialect; other backends never need it
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+db = SQLAlchemy()  # bound to the app by create_app()
 
 # Models
 class User(db.Model):
@@ -26,10 +152,15 @@ class Plan(db.Model):
     active = db.Column(db.Boolean, default=True)
 
 class Subscription(db.Model):
+    __table_args__ = (
+        db.Index('ix_subscription_status_end_date', 'status', 'end_date'),
+        db.Index('ix_subscription_user_status', 'user_id', 'status'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     plan_id = db.Column(db.Integer, db.ForeignKey('plan.id'), nullable=False)
-    status = db.Column(db.String(20), default='active')  # active, cancelled
+    status = db.Column(db.String(20), default='active')  # active, cancelled, expired
     start_date = db.Column(db.DateTime, default=datetime.utcnow)
     end_date = db.Column(db.DateTime)
     
@@ -61,6 +192,10 @@ class DiscountUsage(db.Model):
     used_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class PaymentMethod(db.Model):
+    __table_args__ = (
+        db.Index('ix_payment_method_user_active', 'user_id', 'is_active'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     card_type = db.Column(db.String(20), nullable=False)  # visa, mastercard, etc.
@@ -72,6 +207,10 @@ class PaymentMethod(db.Model):
     is_active = db.Column(db.Boolean, default=True)
 
 class BillingHistory(db.Model):
+    __table_args__ = (
+        db.Index('ix_billing_history_user_date_id', 'user_id', 'payment_date', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
@@ -88,6 +227,11 @@ class BillingHistory(db.Model):
     payment_method = db.relationship('PaymentMethod', backref='billing_history')
 
 class Analytics(db.Model):
+    # Daily per-plan rollup store, maintained by apply_rollup() (see below)
+    __table_args__ = (
+        db.Index('ix_analytics_metric_day_plan', 'metric_name', 'metric_date', 'plan_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     metric_name = db.Column(db.String(100), nullable=False)
     metric_value = db.Column(db.Float, nullable=False)
@@ -101,8 +245,26 @@ class AuditLog(db.Model):
     action = db.Column(db.String(200))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_audit_log_timestamp', 'timestamp'),
+    )
+
+class LifecycleRun(db.Model):
+    # Progress of a run_lifecycle() sweep; an unfinished row is resumed
+    id = db.Column(db.Integer, primary_key=True)
+    as_of = db.Column(db.DateTime, nullable=False)  # subscriptions ending on or before this are due
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    chunks = db.Column(db.Integer, default=0)
+    renewed = db.Column(db.Integer, default=0)
+    expired = db.Column(db.Integer, default=0)
+
 # Chatbot models (additive)
 class Chat(db.Model):
+    __table_args__ = (
+        db.Index('ix_chat_user_created', 'user_id', 'created_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     name = db.Column(db.String(120), nullable=False)
@@ -111,20 +273,815 @@ class Chat(db.Model):
     user = db.relationship('User', backref='chats')
 
 class ChatMessage(db.Model):
+    __table_args__ = (
+        db.Index('ix_chat_message_chat_id_id', 'chat_id', 'id'),
+        db.Index('ix_chat_message_job_id', 'job_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=False)
     sender = db.Column(db.String(10), nullable=False)  # 'user' or 'bot'
     text = db.Column(db.String(2000), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    job_id = db.Column(db.String(80), nullable=True)  # the chatbot job that wrote this bot reply
 
     chat = db.relationship('Chat', backref='messages')
 
+class SchemaMigration(db.Model):
+    # Applied entries of MIGRATIONS (see apply_migrations())
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class CacheVersion(db.Model):
+    # Version stamps for in-process caches (see cache_versions())
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class Counter(db.Model):
+    # Running totals for the admin dashboard (see bump_counters())
+    name = db.Column(db.String(80), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+# Analytics rollups
+# Every subscription contributes 1 to two Analytics rows:
+#   'subscriptions_started:<status>' on its start day, and
+#   'subscriptions_ending' on its end day,
+# both keyed by plan. The analytics endpoints sum these rows instead of
+# scanning the subscription table. Write paths keep them current with
+# apply_rollup(removed=<keys before the change>, added=<keys after>).
+ROLLUP_STARTED = 'subscriptions_started:'
+ROLLUP_ENDING = 'subscriptions_ending'
+ROLLUP_NO_END_DATE = date(1970, 1, 1)  # bucket for subscriptions without an end date (counted as expired)
+
+def rollup_keys(sub):
+    """Return the (metric_name, metric_date, plan_id) rollup keys a subscription counts towards."""
+    start = (sub.start_date or datetime.utcnow()).date()
+    end = sub.end_date.date() if sub.end_date else ROLLUP_NO_END_DATE
+    return [
+        (ROLLUP_STARTED + (sub.status or 'active'), start, sub.plan_id),
+        (ROLLUP_ENDING, end, sub.plan_id),
+    ]
+
+def upsert(model):
+    """INSERT for model that supports .on_conflict_do_update() (SQLite and PostgreSQL)."""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(model)
+
+def apply_rollup(removed=(), added=()):
+    """Apply rollup key deltas inside the current transaction (committed with the caller's changes).
+
+    Each key is one INSERT ... ON CONFLICT DO UPDATE against the unique
+    (metric_name, metric_date, plan_id) index, so concurrent writers of a new
+    key add to the same row. The dashboard counters move with the
+    'subscriptions_started' keys.
+    """
+    deltas = defaultdict(int)
+    for key in removed:
+        deltas[key] -= 1
+    for key in added:
+        deltas[key] += 1
+    counters = defaultdict(int)
+    for (name, day, plan_id), delta in deltas.items():
+        if name.startswith(ROLLUP_STARTED):
+            counters[COUNTER_SUBSCRIPTIONS] += delta
+            counters[COUNTER_STATUS + name[len(ROLLUP_STARTED):]] += delta
+            counters[COUNTER_PLAN + str(plan_id)] += delta
+    bump_counters(counters)
+    for (name, day, plan_id), delta in deltas.items():
+        if not delta:
+            continue
+        statement = upsert(Analytics).values(
+            metric_name=name, metric_value=delta, metric_date=day, plan_id=plan_id, created_at=datetime.utcnow()
+        )
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['metric_name', 'metric_date', 'plan_id'],
+            set_={'metric_value': Analytics.metric_value + statement.excluded.metric_value},
+        ))
+
+def rebuild_analytics():
+    """Recompute all subscription rollups and counters from the source tables. Returns the number of rollup rows."""
+    db.session.execute(delete(Analytics).where(
+        (Analytics.metric_name == ROLLUP_ENDING) | Analytics.metric_name.like(ROLLUP_STARTED + '%')
+    ))
+    now = datetime.utcnow()
+    columns = ['metric_name', 'metric_date', 'plan_id', 'metric_value', 'created_at']
+    start_day = func.date(Subscription.start_date)
+    status = func.coalesce(Subscription.status, 'active')
+    started = select(
+        literal(ROLLUP_STARTED) + status, start_day, Subscription.plan_id, func.count(Subscription.id), literal(now)
+    ).group_by(status, start_day, Subscription.plan_id)
+    end_day = func.coalesce(func.date(Subscription.end_date), ROLLUP_NO_END_DATE.isoformat())
+    ending = select(
+        literal(ROLLUP_ENDING), end_day, Subscription.plan_id, func.count(Subscription.id), literal(now)
+    ).group_by(end_day, Subscription.plan_id)
+    db.session.execute(insert(Analytics).from_select(columns, started))
+    db.session.execute(insert(Analytics).from_select(columns, ending))
+    reconcile_counters()
+    db.session.commit()
+    return Analytics.query.filter(
+        (Analytics.metric_name == ROLLUP_ENDING) | Analytics.metric_name.like(ROLLUP_STARTED + '%')
+    ).count()
+
+def duration_category(end_day, today):
+    """Duration bucket of a subscription ending on end_day, as shown on the analytics page."""
+    if end_day > today + timedelta(days=30):
+        return 'Long-term (30+ days)'
+    if end_day > today + timedelta(days=7):
+        return 'Medium-term (7-30 days)'
+    if end_day > today:
+        return 'Short-term (1-7 days)'
+    return 'Expired'
+
+def build_analytics_bundle():
+    """Compute every analytics series with a single grouped query over the rollups."""
+    today = datetime.utcnow().date()
+    # Started rows are bucketed by month, ending rows by duration category
+    duration = case(
+        (Analytics.metric_date > today + timedelta(days=30), 'Long-term (30+ days)'),
+        (Analytics.metric_date > today + timedelta(days=7), 'Medium-term (7-30 days)'),
+        (Analytics.metric_date > today, 'Short-term (1-7 days)'),
+        else_='Expired'
+    )
+    bucket = case((Analytics.metric_name == ROLLUP_ENDING, duration), else_=extract('month', Analytics.metric_date))
+    rows = db.session.query(
+        Analytics.metric_name, bucket.label('bucket'), Plan.name, Plan.price,
+        func.sum(Analytics.metric_value).label('count')
+    ).outerjoin(Plan, Analytics.plan_id == Plan.id).filter(
+        (Analytics.metric_name == ROLLUP_ENDING) | Analytics.metric_name.like(ROLLUP_STARTED + '%')
+    ).group_by(Analytics.metric_name, bucket, Analytics.plan_id).all()
+
+    month_status = defaultdict(lambda: defaultdict(int))
+    month_revenue = defaultdict(float)
+    status_counts = defaultdict(int)
+    plan_counts = defaultdict(int)
+    plan_revenue = defaultdict(float)
+    durations = defaultdict(int)
+    for row in rows:
+        count = int(row.count)
+        if count <= 0:
+            continue
+        if row.metric_name == ROLLUP_ENDING:
+            durations[row.bucket] += count
+            continue
+        status = row.metric_name[len(ROLLUP_STARTED):]
+        month = int(row.bucket)
+        month_status[month][status] += count
+        status_counts[status] += count
+        if row.name is not None:
+            month_revenue[month] += count * row.price
+            plan_counts[row.name] += count
+            plan_revenue[row.name] += count * row.price
+
+    months = sorted(month_status)
+    trend_months = [m for m in months if month_status[m]['active'] or month_status[m]['cancelled']]
+    revenue_months = sorted(month_revenue)
+    plan_names = sorted(plan_counts)
+    statuses = sorted(status_counts)
+    duration_labels = sorted(durations)
+    total_subs = sum(status_counts.values())
+    return {
+        'subscription_trends': {
+            'labels': [f"Month {m}" for m in trend_months],
+            'datasets': [
+                {'label': 'Active Subscriptions', 'data': [month_status[m]['active'] for m in trend_months], 'backgroundColor': '#1cc88a'},
+                {'label': 'Cancelled Subscriptions', 'data': [month_status[m]['cancelled'] for m in trend_months], 'backgroundColor': '#e74a3b'}
+            ]
+        },
+        'revenue': {'labels': [f"Month {m}" for m in revenue_months], 'data': [month_revenue[m] for m in revenue_months]},
+        'subscription_status': {'labels': [s.title() for s in statuses], 'data': [status_counts[s] for s in statuses]},
+        'subscription_growth': {'labels': [f"Month {m}" for m in months], 'data': [sum(month_status[m].values()) for m in months]},
+        'subscription_duration': {'labels': duration_labels, 'data': [durations[d] for d in duration_labels]},
+        'monthly_subs': [{'month': m, 'count': sum(month_status[m].values())} for m in months],
+        'plan_popularity': [{'name': name, 'count': plan_counts[name]} for name in plan_names],
+        'revenue_by_plan': [{'name': name, 'revenue': plan_revenue[name]} for name in plan_names],
+        'churn_rate': (status_counts['cancelled'] / total_subs * 100) if total_subs > 0 else 0,
+    }
+
+# Dashboard counters
+# Counter rows hold the totals shown on the admin dashboard, so its tiles
+# are primary-key reads instead of COUNT(*) scans:
+#   'users'                       accounts with the 'user' role
+#   'subscriptions'               all subscriptions
+#   'subscriptions:status:<s>'    per status
+#   'subscriptions:plan:<id>'     per plan
+# Subscription counters change in apply_rollup(), user counters where users
+# are created; both in the caller's transaction. reconcile_counters()
+# recomputes them from the source tables.
+COUNTER_USERS = 'users'
+COUNTER_SUBSCRIPTIONS = 'subscriptions'
+COUNTER_STATUS = 'subscriptions:status:'
+COUNTER_PLAN = 'subscriptions:plan:'
+
+def bump_counters(deltas):
+    """Add {name: delta} to the counters inside the current transaction.
+
+    One upsert per counter on its primary key, so two transactions creating
+    the same counter both land their deltas on one row.
+    """
+    for name, delta in deltas.items():
+        if not delta:
+            continue
+        statement = upsert(Counter).values(name=name, value=delta)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['name'], set_={'value': Counter.value + statement.excluded.value},
+        ))
+
+def counter_values(prefix=None):
+    """Return {name: value}, optionally only for names starting with prefix."""
+    query = db.session.query(Counter.name, Counter.value)
+    if prefix:
+        query = query.filter(Counter.name.startswith(prefix))
+    return dict(query.all())
+
+def source_counts():
+    """Compute every counter from the users and subscription tables."""
+    counts = {COUNTER_USERS: User.query.filter_by(role='user').count()}
+    status = func.coalesce(Subscription.status, 'active')
+    for value, plan_id, count in db.session.query(status, Subscription.plan_id, func.count(Subscription.id)) \
+            .group_by(status, Subscription.plan_id):
+        counts[COUNTER_SUBSCRIPTIONS] = counts.get(COUNTER_SUBSCRIPTIONS, 0) + count
+        counts[COUNTER_STATUS + value] = counts.get(COUNTER_STATUS + value, 0) + count
+        counts[COUNTER_PLAN + str(plan_id)] = counts.get(COUNTER_PLAN + str(plan_id), 0) + count
+    return counts
+
+def reconcile_counters():
+    """Reset the counters to the source counts inside the current transaction; return {name: (stored, actual)} for drifted ones."""
+    stored = counter_values()
+    actual = source_counts()
+    drift = {name: (stored.get(name, 0), actual.get(name, 0))
+             for name in set(stored) | set(actual) if stored.get(name, 0) != actual.get(name, 0)}
+    db.session.execute(delete(Counter))
+    if actual:
+        db.session.execute(insert(Counter), [{'name': name, 'value': value} for name, value in actual.items()])
+    return drift
+
+@app.cli.command('reconcile-counters')
+@click.option('--dry-run', is_flag=True, help='Only report drift.')
+def reconcile_counters_command(dry_run):
+    """Recompute the dashboard counters from the source tables and report drift."""
+    drift = reconcile_counters()
+    for name, (stored, actual) in sorted(drift.items()):
+        click.echo(f'{name}: {stored} -> {actual} ({actual - stored:+d})')
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    click.echo(f"{len(drift)} counters drifted{' (not fixed, dry run)' if dry_run and drift else ''}.")
+    if drift:
+        raise SystemExit(1)
+
+# Migrations
+# New tables come from create_all(); indexes added to existing tables are
+# listed here, applied once in version order and recorded in
+# schema_migration. A new table or index needs a new entry: startup only
+# looks at the schema again when the recorded version is behind
+# SCHEMA_VERSION (see bootstrap_schema()). MIGRATION_STEPS run before a
+# version's indexes are created, for changes an index alone can't make
+# (new columns, data fixes).
+def merge_analytics_duplicates():
+    """Fold duplicate rollup rows into one and replace the old non-unique rollup index."""
+    key = (Analytics.metric_name, Analytics.metric_date, Analytics.plan_id)
+    duplicates = db.session.execute(
+        select(*key, func.min(Analytics.id), func.sum(Analytics.metric_value))
+        .group_by(*key).having(func.count(Analytics.id) > 1)
+    ).all()
+    for name, day, plan_id, keep_id, total in duplicates:
+        same_key = (Analytics.metric_name == name, Analytics.metric_date == day,
+                    Analytics.plan_id.is_not_distinct_from(plan_id))
+        db.session.execute(delete(Analytics).where(*same_key, Analytics.id != keep_id))
+        db.session.execute(update(Analytics).where(Analytics.id == keep_id).values(metric_value=total))
+    db.session.commit()
+    index = next(i for i in Analytics.__table__.indexes if i.name == 'ix_analytics_metric_day_plan')
+    index.drop(bind=db.engine, checkfirst=True)  # recreated unique by the migration
+
+def add_chat_message_job_id():
+    """Add chat_message.job_id to databases created before it existed."""
+    if 'job_id' in {column['name'] for column in inspect(db.engine).get_columns('chat_message')}:
+        return
+    column_type = ChatMessage.__table__.c.job_id.type.compile(db.engine.dialect)
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(f'ALTER TABLE chat_message ADD COLUMN job_id {column_type}')
+
+MIGRATION_STEPS = {3: merge_analytics_duplicates, 4: add_chat_message_job_id}
+
+MIGRATIONS = [
+    (1, 'Rollup, expiry, billing keyset, chat sync and audit timestamp indexes', [
+        'ix_analytics_metric_day_plan', 'ix_subscription_status_end_date', 'ix_billing_history_user_date_id',
+        'ix_chat_message_chat_id_id', 'ix_audit_log_timestamp',
+    ]),
+    (2, 'Per-user subscription, payment method and chat indexes', [
+        'ix_subscription_user_status', 'ix_payment_method_user_active', 'ix_chat_user_created',
+    ]),
+    (3, 'Unique rollup key', ['ix_analytics_metric_day_plan']),
+    (4, 'Chatbot job id on bot replies', ['ix_chat_message_job_id']),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def apply_migrations():
+    """Apply pending MIGRATIONS; return the versions applied by this call."""
+    indexes = {index.name: index for table in db.metadata.sorted_tables for index in table.indexes}
+    applied = set(db.session.scalars(select(SchemaMigration.version)))
+    db.session.rollback()
+    done = []
+    for version, name, index_names in MIGRATIONS:
+        if version in applied:
+            continue
+        if version in MIGRATION_STEPS:
+            MIGRATION_STEPS[version]()
+        for index_name in index_names:
+            indexes[index_name].create(bind=db.engine, checkfirst=True)
+        db.session.add(SchemaMigration(version=version, name=name))
+        try:
+            db.session.commit()
+            done.append(version)
+        except IntegrityError:
+            db.session.rollback()  # another process recorded it first
+    return done
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Create missing tables and apply pending index migrations."""
+    db.create_all()
+    started = time.perf_counter()
+    done = apply_migrations()
+    for version, name, _ in MIGRATIONS:
+        click.echo(f"{version:>3} {'applied now' if version in done else 'applied':<12} {name}")
+    click.echo(f'{len(done)} migrations applied in {time.perf_counter() - started:.1f}s.')
+
+def ensure_schema():
+    """Create missing tables, apply pending migrations, and backfill the rollups and counters if they were never built."""
+    db.create_all()
+    apply_migrations()
+    has_rollups = Analytics.query.filter(Analytics.metric_name.like(ROLLUP_STARTED + '%')).first()
+    if not has_rollups and Subscription.query.first():
+        rebuild_analytics()
+    elif not db.session.get(Counter, COUNTER_USERS) and User.query.first():
+        reconcile_counters()
+        db.session.commit()
+
+def bootstrap_schema():
+    """Run ensure_schema() unless the database is already at SCHEMA_VERSION; return whether it ran.
+
+    An up-to-date database costs one query, so worker boot stays cheap.
+    """
+    try:
+        current = db.session.scalar(select(func.max(SchemaMigration.version)))
+    except OperationalError:  # no schema_migration table yet
+        current = None
+    db.session.rollback()
+    if current is not None and current >= SCHEMA_VERSION:
+        return False
+    ensure_schema()
+    return True
+
+@app.cli.command('rebuild-analytics')
+def rebuild_analytics_command():
+    """Backfill the analytics rollup tables from existing subscriptions."""
+    ensure_schema()
+    rows = rebuild_analytics()
+    click.echo(f'Rebuilt analytics rollups: {rows} rows.')
+
+# Response cache
+# Analytics payloads are identical for every admin tab, so they are kept for
+# RESPONSE_CACHE_TTL seconds. Subscription and plan write paths call
+# response_cache.clear() after committing; other worker processes pick the
+# change up when their entries expire.
+class ResponseCache:
+    """Thread-safe in-process TTL cache with hit/miss/eviction counters."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = {}  # key -> (expires_at, value), oldest first
+        self._lock = threading.Lock()
+        self._key_locks = {}  # key -> [lock, requests using it], only while a compute runs
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            now = time.monotonic()
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.max_entries:
+                for stale in [k for k, (expires_at, _) in self._entries.items() if expires_at <= now]:
+                    del self._entries[stale]
+                    self.evictions += 1
+            while len(self._entries) >= self.max_entries:
+                del self._entries[next(iter(self._entries))]
+                self.evictions += 1
+            self._entries[key] = (now + ttl, value)
+
+    def get_or_set(self, key, compute, cacheable=lambda value: True):
+        """Return the cached value for key, computing it once (per process) on a miss.
+
+        Values for which cacheable(value) is false are returned but not stored.
+        """
+        ttl = app.config['RESPONSE_CACHE_TTL']
+        if ttl <= 0:
+            return compute()
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            slot = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            slot[1] += 1
+        try:
+            with slot[0]:
+                # Another request may have filled the entry while we waited
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry and entry[0] > time.monotonic():
+                        return entry[1]
+                value = compute()
+                if cacheable(value):
+                    self.set(key, value, ttl)
+                return value
+        finally:
+            with self._lock:
+                slot[1] -= 1
+                if not slot[1]:
+                    del self._key_locks[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'ttl_seconds': app.config['RESPONSE_CACHE_TTL'],
+            }
+
+response_cache = ResponseCache()
+
+def cache_response(view=None, *, query_args=()):
+    """Cache a JSON view's successful (2xx) response body.
+
+    The key is the path plus the query_args the view reads, so arbitrary query
+    strings share one entry instead of each adding a new one.
+    """
+    if view is None:
+        return lambda view: cache_response(view, query_args=query_args)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        def render():
+            response = make_response(view(*args, **kwargs))
+            return response.status_code, response.get_data(), response.mimetype
+        key = request.path
+        if query_args:
+            key += '?' + urlencode([(name, request.args[name]) for name in query_args if name in request.args])
+        status, body, mimetype = response_cache.get_or_set(key, render, cacheable=lambda value: 200 <= value[0] < 300)
+        return app.response_class(body, status=status, mimetype=mimetype)
+    return wrapper
+
+# Cache version stamps
+# Each in-process cache is stamped with a counter from CacheVersion. Writers
+# bump the counter in the same transaction as the data it covers, so every
+# worker process notices the change on its next request.
+def cache_versions():
+    """Return {name: version} for all cache stamps, read at most once per request."""
+    versions = g.get('cache_versions')
+    if versions is None:
+        versions = dict(db.session.query(CacheVersion.name, CacheVersion.version).all())
+        g.cache_versions = versions
+    return versions
+
+def bump_cache_version(name):
+    """Increment a cache stamp inside the current transaction."""
+    result = db.session.execute(
+        update(CacheVersion).where(CacheVersion.name == name).values(version=CacheVersion.version + 1)
+    )
+    if result.rowcount == 0:
+        db.session.execute(insert(CacheVersion).values(name=name, version=1))
+    g.pop('cache_versions', None)
+
+# Plan catalog
+PlanRecord = namedtuple('PlanRecord', ['id', 'name', 'quota_gb', 'price', 'description', 'active'])
+
+class PlanCatalog:
+    """Immutable snapshot of every plan, stamped with the 'plans' cache version."""
+
+    def __init__(self, version, plans):
+        self.version = version
+        self.plans = tuple(plans)
+        self.active = tuple(plan for plan in self.plans if plan.active)
+        self._by_id = {plan.id: plan for plan in self.plans}
+
+    def get(self, plan_id):
+        try:
+            return self._by_id.get(int(plan_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get_or_404(self, plan_id):
+        plan = self.get(plan_id)
+        if plan is None:
+            abort(404)
+        return plan
+
+_plan_catalog = None
+_plan_catalog_lock = threading.Lock()
+
+def plan_catalog():
+    """Return the current plan catalog, rebuilding it only when the 'plans' stamp has moved."""
+    global _plan_catalog
+    # Read the stamp before the plans so a snapshot is never newer-stamped than its data
+    version = cache_versions().get('plans', 0)
+    catalog = _plan_catalog
+    if catalog is not None and catalog.version == version:
+        return catalog
+    with _plan_catalog_lock:
+        if _plan_catalog is None or _plan_catalog.version != version:
+            rows = db.session.query(
+                Plan.id, Plan.name, Plan.quota_gb, Plan.price, Plan.description, Plan.active
+            ).order_by(Plan.id).all()
+            _plan_catalog = PlanCatalog(version, [PlanRecord(*row) for row in rows])
+        return _plan_catalog
+
+# Pricing
+# Every price shown or charged comes from quote(). Active discounts are
+# compiled into an in-memory rule table keyed by code and stamped with the
+# 'discounts' cache version, so looking up a code (valid or guessed) costs no
+# query. Usage counts in the table can lag behind reserve_discount(); the
+# reservation at checkout is authoritative and bumps the stamp when it finds
+# a discount used up.
+DiscountRule = namedtuple('DiscountRule', [
+    'id', 'name', 'code', 'discount_type', 'discount_value', 'min_amount', 'max_discount',
+    'valid_from', 'valid_until', 'usage_limit', 'used_count',
+])
+Quote = namedtuple('Quote', ['plan', 'discount', 'discount_amount', 'final_price', 'error'])
+
+class PricingRules:
+    """Immutable snapshot of the active discounts, stamped with the 'discounts' cache version."""
+
+    def __init__(self, version, rules):
+        self.version = version
+        self.by_code = {rule.code: rule for rule in rules}
+
+    def get(self, code):
+        return self.by_code.get((code or '').strip().upper())
+
+_pricing_rules = None
+_pricing_rules_lock = threading.Lock()
+
+def pricing_rules():
+    """Return the current rule table, recompiling it only when the 'discounts' stamp has moved."""
+    global _pricing_rules
+    version = cache_versions().get('discounts', 0)
+    rules = _pricing_rules
+    if rules is not None and rules.version == version:
+        return rules
+    with _pricing_rules_lock:
+        if _pricing_rules is None or _pricing_rules.version != version:
+            rows = db.session.query(
+                Discount.id, Discount.name, Discount.code, Discount.discount_type, Discount.discount_value,
+                Discount.min_amount, Discount.max_discount, Discount.valid_from, Discount.valid_until,
+                Discount.usage_limit, Discount.used_count,
+            ).filter(Discount.active == True).all()
+            _pricing_rules = PricingRules(version, [DiscountRule(*row) for row in rows])
+        return _pricing_rules
+
+def discount_error(rule, price, now):
+    """Why the discount cannot be applied to price, or None if it can."""
+    if rule is None:
+        return 'Invalid discount code'
+    if now < rule.valid_from:
+        return 'Discount not yet valid'
+    if now > rule.valid_until:
+        return 'Discount code has expired'
+    if rule.usage_limit and (rule.used_count or 0) >= rule.usage_limit:
+        return 'Discount code usage limit exceeded'
+    if price < (rule.min_amount or 0):
+        return f'Minimum order amount of ₹{rule.min_amount} required'
+    return None
+
+def discount_value_for(rule, price):
+    if rule.discount_type == 'percentage':
+        amount = (price * rule.discount_value) / 100
+        if rule.max_discount:
+            amount = min(amount, rule.max_discount)
+        return amount
+    return min(rule.discount_value, price)
+
+def quote(plan, code=None, now=None):
+    """Price a plan with an optional discount code; error says why a given code was not applied."""
+    rule, error, amount = None, None, 0
+    if code:
+        rule = pricing_rules().get(code)
+        error = discount_error(rule, plan.price, now or datetime.utcnow())
+        if error is None:
+            amount = discount_value_for(rule, plan.price)
+    return Quote(plan, rule, amount, max(0, plan.price - amount), error)
+
+# Audit log
+# Routes call audit() instead of adding AuditLog rows themselves. In 'async'
+# mode the entry waits in session.info until the transaction commits (a
+# rolled-back action is never logged) and is then handed to audit_sink,
+# which inserts queued entries in batches from a background thread. The
+# user's transaction no longer holds the write lock for the audit insert.
+# 'sync' mode adds the row to the current transaction as before, which tests
+# that read the log straight after a request rely on.
+def audit(actor, action):
+    entry = {'actor': actor, 'action': action, 'timestamp': datetime.utcnow()}
+    if app.config['AUDIT_MODE'] == 'sync':
+        db.session.add(AuditLog(**entry))
+    else:
+        session = db.session()
+        if not session.in_transaction():
+            session.begin()  # so a rollback before any query still discards the entry
+        session.info.setdefault('audit', []).append(entry)
+
+@event.listens_for(Session, 'after_commit')
+def _hand_over_audit_entries(session):
+    entries = session.info.pop('audit', None)
+    if entries:
+        audit_sink.submit(entries)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_audit_entries(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('audit', None)  # the outermost transaction rolled back
+
+class AuditSink:
+    """Background writer that inserts queued audit entries in batches.
+
+    A batch is written once AUDIT_BATCH_SIZE entries are queued or
+    AUDIT_FLUSH_INTERVAL seconds after its first entry, whichever comes
+    first. A failed batch is retried after the interval, AUDIT_MAX_RETRIES
+    times. After that its entries are written one by one, and any entry
+    that still fails is logged and dropped, so one bad row cannot hold up
+    the queue. When the queue is full, the caller writes its entries
+    itself. That write runs in the after_commit hook of a request that has
+    already committed, so a failure is logged and counted, never raised.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=app.config['AUDIT_QUEUE_MAX'])
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self.enqueued = self.written = self.flushes = self.failures = self.overflows = self.dropped = 0
+        self.flush_seconds = self.max_flush_seconds = self.last_flush_seconds = 0.0
+
+    def submit(self, entries):
+        self._start()
+        for i, entry in enumerate(entries):
+            try:
+                self._queue.put_nowait(entry)
+            except queue.Full:
+                with self._lock:
+                    self.overflows += 1
+                try:
+                    self._write(entries[i:])
+                except SQLAlchemyError:
+                    self._drop(entries[i:])
+                return
+        with self._lock:
+            self.enqueued += len(entries)
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='audit-sink', daemon=True)
+                    self._thread.start()
+
+    def _write(self, entries):
+        started = time.perf_counter()
+        with app.app_context():
+            with db.engine.begin() as conn:
+                conn.execute(insert(AuditLog), entries)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.written += len(entries)
+            self.flushes += 1
+            self.flush_seconds += elapsed
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    def _drop(self, entries):
+        with self._lock:
+            self.dropped += len(entries)
+        for entry in entries:
+            app.logger.exception('Dropped audit entry %r', entry)
+
+    def _write_each(self, entries):
+        for entry in entries:
+            try:
+                self._write([entry])
+            except SQLAlchemyError:
+                self._drop([entry])
+
+    def _run(self):
+        batch, drained, attempts = [], [], 0
+        while True:
+            if not batch and not drained:
+                item = self._queue.get()  # idle until the next entry
+            else:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    item = None
+            if not batch and not drained:
+                deadline = time.monotonic() + app.config['AUDIT_FLUSH_INTERVAL']
+            if isinstance(item, threading.Event):
+                drained.append(item)  # flush() marker: write everything queued before it now
+            elif item is not None:
+                batch.append(item)
+                if len(batch) < app.config['AUDIT_BATCH_SIZE'] and time.monotonic() < deadline:
+                    continue
+            if batch:
+                try:
+                    self._write(batch)
+                    batch, attempts = [], 0
+                except SQLAlchemyError:
+                    attempts += 1
+                    with self._lock:
+                        self.failures += 1
+                    if attempts < app.config['AUDIT_MAX_RETRIES']:
+                        app.logger.exception('Writing %d audit entries failed; retrying', len(batch))
+                        time.sleep(app.config['AUDIT_FLUSH_INTERVAL'])
+                        deadline = time.monotonic()
+                        continue
+                    app.logger.exception('Writing %d audit entries failed %d times; writing them one by one',
+                                         len(batch), attempts)
+                    self._write_each(batch)
+                    batch, attempts = [], 0
+            for marker in drained:
+                marker.set()
+            drained = []
+            if self._stopping and self._queue.empty():
+                return
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is written; False on timeout."""
+        if self._thread is None:
+            return True
+        self._start()  # e.g. after a fork, which does not copy the writer thread
+        marker = threading.Event()
+        self._queue.put(marker)
+        return marker.wait(timeout)
+
+    def close(self, timeout=10):
+        """Drain the queue at shutdown."""
+        self._stopping = True
+        return self.flush(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': app.config['AUDIT_MODE'],
+                'queue_depth': self._queue.qsize(),
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'flushes': self.flushes,
+                'failures': self.failures,
+                'overflows': self.overflows,
+                'dropped': self.dropped,
+                'last_flush_ms': round(self.last_flush_seconds * 1000, 3),
+                'avg_flush_ms': round(self.flush_seconds * 1000 / self.flushes, 3) if self.flushes else 0,
+                'max_flush_ms': round(self.max_flush_seconds * 1000, 3),
+            }
+
+audit_sink = AuditSink()
+atexit.register(audit_sink.close)
+
+def recent_activity(limit=10):
+    """Latest audit entries, read backwards from ix_audit_log_timestamp."""
+    return AuditLog.query.order_by(AuditLog.timestamp.desc()).limit(limit).all()
+
 # Helpers
 def seed_data():
     if User.query.count() == 0:
         admin = User(username='admin', password='admin123', role='admin')
         user = User(username='user1', password='user123', role='user')
         db.session.add_all([admin, user])
+        bump_counters({COUNTER_USERS: 1})
     if Plan.query.count() == 0:
         plans = [
             Plan(name='Basic Fiber', quota_gb=100, price=499.0, description='Basic broadband 100GB/mo'),
@@ -132,6 +1089,7 @@ def seed_data():
             Plan(name='Unlimited', quota_gb=0, price=1299.0, description='Unlimited plan (quota guide only)'),
         ]
         db.session.add_all(plans)
+        bump_cache_version('plans')
     if Discount.query.count() == 0:
         discounts = [
             Discount(
@@ -156,6 +1114,7 @@ def seed_data():
             )
         ]
         db.session.add_all(discounts)
+        bump_cache_version('discounts')
     if PaymentMethod.query.count() == 0:
         # Add sample payment methods for user1
         user1 = User.query.filter_by(username='user1').first()
@@ -219,6 +1178,7 @@ def seed_data():
                     )
                 ]
                 db.session.add_all(sample_subs)
+                apply_rollup(added=[key for sub in sample_subs for key in rollup_keys(sub)])
     
     # Add sample billing history
     if BillingHistory.query.count() == 0:
@@ -243,16 +1203,686 @@ def seed_data():
             db.session.add_all(billing_records)
     db.session.commit()
 
+# Synthetic data
+# generate_data() appends a large, reproducible dataset for load tests and
+# benchmarks. Rows get explicit ids so children can reference their parents
+# without reading them back, and go in with one executemany per batch.
+GENERATED_CARD_TYPES = ['visa', 'mastercard', 'rupay', 'amex']
+GENERATED_CHAT_LINES = [
+    ('user', 'Which plan is best for streaming in 4K?'),
+    ('bot', 'A plan with at least 200GB or unlimited data works well for 4K streaming.'),
+    ('user', 'Are there any discounts this month?'),
+    ('bot', 'Yes, check the Offers page for the codes that apply to your plan.'),
+    ('user', 'How do I change my payment method?'),
+    ('bot', 'Open Payment Methods from your dashboard and set a new default card.'),
+]
+
+def bulk_insert(conn, table, columns, rows, batch_size):
+    """executemany rows (tuples in `columns` order) into table, batch_size rows at a time.
+
+    Values are converted with the columns' bind processors up front, which
+    skips the per-row parameter dicts of a regular Core insert. Returns the
+    number of rows inserted.
+    """
+    statement = table.insert().compile(dialect=conn.dialect, column_keys=columns)
+    processors = [table.c[c].type.dialect_impl(conn.dialect).bind_processor(conn.dialect) for c in columns]
+    positional = conn.dialect.positional
+    count = 0
+    batch = []
+
+    def flush():
+        if positional:
+            conn.exec_driver_sql(str(statement), batch)
+        else:
+            conn.exec_driver_sql(str(statement), [dict(zip(columns, row)) for row in batch])
+
+    for row in rows:
+        batch.append(tuple(p(v) if p and v is not None else v for p, v in zip(processors, row)))
+        if len(batch) >= batch_size:
+            flush()
+            count += len(batch)
+            batch = []
+    if batch:
+        flush()
+        count += len(batch)
+    return count
+
+def generate_data(users=1000, plans=12, subscriptions=10000, invoices_per_subscription=12, discounts=50,
+                  chats=1000, messages_per_chat=6, seed=42, batch_size=50000, report=None):
+    """Append a synthetic dataset with realistic distributions.
+
+    The same seed on the same UTC day into the same starting database gives the
+    same rows.
+
+    - users own subscriptions with a long tail (a few accounts have many)
+    - cheaper plans are more popular; about 1 in 6 plans is retired
+    - sign-ups grow towards the present; 70% active, 25% cancelled, 5% expired
+    - every elapsed month of a subscription is billed (capped at
+      invoices_per_subscription), 95% paid
+    - 85% of users have a default card; 5% of subscriptions used a discount
+    Returns {table name: rows inserted}. report(table, rows, seconds) is
+    called after each table. Raises ValueError unless there is at least one
+    user and one plan to attach subscriptions to.
+    """
+    if users < 1 or plans < 1:
+        raise ValueError(f'generate_data needs at least one user and one plan (got users={users}, plans={plans})')
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)  # UTC day, like every stored timestamp
+    counts = {}
+
+    def next_id(model):
+        return (db.session.scalar(select(func.max(model.id))) or 0) + 1
+
+    first_user, first_plan, first_sub, first_discount, first_chat = (
+        next_id(User), next_id(Plan), next_id(Subscription), next_id(Discount), next_id(Chat)
+    )
+    db.session.rollback()
+    tag = f'g{seed}-{first_user}'  # keeps usernames, codes and invoice numbers unique across runs
+
+    def timed(name, model, columns, rows):
+        started = time.perf_counter()
+        with db.engine.begin() as conn:
+            counts[name] = bulk_insert(conn, model.__table__, columns, rows, batch_size)
+        if report:
+            report(name, counts[name], time.perf_counter() - started)
+
+    timed('user', User, ['id', 'username', 'password', 'role'], (
+        (first_user + i, f'{tag}-user{i}', 'password', 'user') for i in range(users)
+    ))
+
+    quotas = [50, 100, 200, 300, 500, 1000, 0]
+    plan_rows = []
+    for i in range(plans):
+        quota = quotas[i % len(quotas)]
+        price = round((quota or 2000) * rng.uniform(1.5, 2.5) + 199, 0)
+        plan_rows.append((first_plan + i, f'Plan {tag}-{i}', quota, price,
+                          f'{"Unlimited" if quota == 0 else f"{quota}GB"} generated plan', i % 6 != 5))
+    timed('plan', Plan, ['id', 'name', 'quota_gb', 'price', 'description', 'active'], plan_rows)
+    plan_ids = [row[0] for row in plan_rows]
+    plan_prices = {row[0]: row[3] for row in plan_rows}
+    plan_names = {row[0]: row[1] for row in plan_rows}
+    price_order = sorted(range(plans), key=lambda i: plan_rows[i][3])
+    price_rank = {i: rank for rank, i in enumerate(price_order)}
+    plan_weights = [1 / (price_rank[i] + 1) for i in range(plans)]  # cheaper plans are more popular
+
+    card_of = {}
+    def payment_method_rows():
+        for i in range(users):
+            if rng.random() < 0.85:
+                card_of[first_user + i] = len(card_of) + 1
+                yield (first_user + i, rng.choice(GENERATED_CARD_TYPES), f'{rng.randrange(10000):04d}',
+                       rng.randint(1, 12), now.year + rng.randint(1, 5), True, now, True)
+    first_card = next_id(PaymentMethod)
+    db.session.rollback()
+    timed('payment_method', PaymentMethod, ['user_id', 'card_type', 'last_four_digits', 'expiry_month',
+                                             'expiry_year', 'is_default', 'created_at', 'is_active'],
+          payment_method_rows())
+    card_of = {user_id: first_card + n - 1 for user_id, n in card_of.items()}
+
+    sub_rows = []  # (id, user_id, plan_id, status, start, end), kept for billing
+    def subscription_rows():
+        for i in range(subscriptions):
+            user_id = first_user + int(users * rng.random() ** 2)  # long tail of heavy accounts
+            plan_id = rng.choices(plan_ids, plan_weights)[0]
+            start = now - timedelta(days=730 * (1 - rng.random() ** 0.5), seconds=rng.randrange(86400))
+            roll = rng.random()
+            if roll < 0.70:
+                status, end = 'active', now + timedelta(days=rng.uniform(1, 30))
+            elif roll < 0.95:
+                status, end = 'cancelled', start + timedelta(days=rng.uniform(15, 400))
+            else:
+                status, end = 'expired', start + timedelta(days=rng.uniform(30, 400))
+            end = max(end, start + timedelta(days=1))
+            if status == 'expired':
+                end = min(end, now)
+            row = (first_sub + i, user_id, plan_id, status, start, end)
+            sub_rows.append(row)
+            yield row
+    timed('subscription', Subscription, ['id', 'user_id', 'plan_id', 'status', 'start_date', 'end_date'],
+          subscription_rows())
+
+    def billing_rows():
+        for sub_id, user_id, plan_id, status, start, end in sub_rows:
+            months = min(invoices_per_subscription, max(1, (min(end, now) - start).days // 30))
+            for k in range(months):
+                roll = rng.random()
+                yield (user_id, sub_id, plan_prices[plan_id], card_of.get(user_id),
+                       'paid' if roll < 0.95 else ('failed' if roll < 0.98 else 'pending'),
+                       start + timedelta(days=30 * k, minutes=rng.randrange(1440)),
+                       f'INV-{tag}-{sub_id}-{k}', f'{plan_names[plan_id]} monthly payment')
+    timed('billing_history', BillingHistory, ['user_id', 'subscription_id', 'amount', 'payment_method_id',
+                                               'status', 'payment_date', 'invoice_number', 'description'],
+          billing_rows())
+
+    discount_rows = []
+    for i in range(discounts):
+        percentage = rng.random() < 0.7
+        valid_from = now - timedelta(days=rng.randint(0, 365))
+        limit = rng.choice([None, 100, 500, 1000, 5000])
+        discount_rows.append((
+            first_discount + i, f'Generated offer {i}', f'{tag}-{i}'.upper(),
+            'percentage' if percentage else 'fixed',
+            rng.choice([5, 10, 15, 20, 25, 30]) if percentage else rng.choice([50, 100, 150, 200]),
+            rng.choice([0, 0, 299, 499]), rng.choice([None, 200, 500]) if percentage else None,
+            valid_from, valid_from + timedelta(days=rng.randint(7, 120)), limit, 0, rng.random() < 0.8,
+            'Generated discount',
+        ))
+    timed('discount', Discount, ['id', 'name', 'code', 'discount_type', 'discount_value', 'min_amount',
+                                 'max_discount', 'valid_from', 'valid_until', 'usage_limit', 'used_count',
+                                 'active', 'description'], discount_rows)
+
+    used = defaultdict(int)
+    def discount_usage_rows():
+        if not discount_rows:
+            return
+        for sub_id, user_id, plan_id, status, start, end in sub_rows:
+            if rng.random() < 0.05:
+                discount = rng.choice(discount_rows)
+                if discount[9] is not None and used[discount[0]] >= discount[9]:
+                    continue
+                used[discount[0]] += 1
+                yield (discount[0], user_id, sub_id, round(plan_prices[plan_id] * 0.1, 2), start)
+    timed('discount_usage', DiscountUsage, ['discount_id', 'user_id', 'subscription_id', 'discount_amount',
+                                            'used_at'], discount_usage_rows())
+    with db.engine.begin() as conn:
+        if used:
+            conn.execute(
+                update(Discount.__table__).where(Discount.__table__.c.id == bindparam('discount_id'))
+                .values(used_count=bindparam('uses')),
+                [{'discount_id': d, 'uses': n} for d, n in used.items()],
+            )
+
+    chat_rows = []
+    for i in range(chats):
+        chat_rows.append((first_chat + i, first_user + rng.randrange(users) if users else None, f'Chat {i}',
+                          now - timedelta(days=rng.uniform(0, 365))))
+    chat_rows = [row for row in chat_rows if row[1] is not None]
+    timed('chat', Chat, ['id', 'user_id', 'name', 'created_at'], chat_rows)
+    timed('chat_message', ChatMessage, ['chat_id', 'sender', 'text', 'timestamp'], (
+        (chat_id, *GENERATED_CHAT_LINES[k % len(GENERATED_CHAT_LINES)], created + timedelta(seconds=20 * k))
+        for chat_id, _, _, created in chat_rows for k in range(messages_per_chat)
+    ))
+
+    rebuild_analytics()
+    bump_cache_version('plans')
+    bump_cache_version('discounts')
+    audit('system', f"Generated synthetic data (seed {seed}): " + ', '.join(f'{n} {name}' for name, n in counts.items()))
+    db.session.commit()
+    return counts
+
+@app.cli.command('generate-data')
+@click.option('--users', type=click.IntRange(min=1), default=1000, show_default=True)
+@click.option('--plans', type=click.IntRange(min=1), default=12, show_default=True)
+@click.option('--subscriptions', type=int, default=10000, show_default=True)
+@click.option('--invoices-per-subscription', type=int, default=12, show_default=True,
+              help='Cap on monthly invoices per subscription.')
+@click.option('--discounts', type=int, default=50, show_default=True)
+@click.option('--chats', type=int, default=1000, show_default=True)
+@click.option('--messages-per-chat', type=int, default=6, show_default=True)
+@click.option('--seed', type=int, default=42, show_default=True)
+@click.option('--batch-size', type=int, default=50000, show_default=True, help='Rows per executemany.')
+def generate_data_command(**options):
+    """Append a large deterministic synthetic dataset for load tests."""
+    def report(table, rows, seconds):
+        click.echo(f'{table:<16}{rows:>12,} rows {seconds:>8.1f}s {rows / max(seconds, 1e-9):>12,.0f} rows/sec')
+
+    started = time.perf_counter()
+    counts = generate_data(report=report, **options)
+    elapsed = time.perf_counter() - started
+    total = sum(counts.values())
+    click.echo(f'{"total":<16}{total:>12,} rows {elapsed:>8.1f}s {total / elapsed:>12,.0f} rows/sec '
+               '(including the analytics rebuild)')
+
+def reserve_discount(discount_id):
+    """Claim one use of a discount with a single conditional UPDATE.
+
+    Returns False when the discount is inactive, outside its validity window or
+    used up. The claim belongs to the caller's transaction, so a rollback
+    releases it.
+    """
+    now = datetime.utcnow()
+    result = db.session.execute(
+        update(Discount)
+        .where(
+            Discount.id == discount_id,
+            Discount.active == True,
+            Discount.valid_from <= now,
+            Discount.valid_until >= now,
+            or_(
+                Discount.usage_limit.is_(None),
+                Discount.usage_limit == 0,
+                func.coalesce(Discount.used_count, 0) < Discount.usage_limit,
+            ),
+        )
+        .values(used_count=func.coalesce(Discount.used_count, 0) + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        bump_cache_version('discounts')  # the pricing rule table still thinks it is usable
+        return False
+    return True
+
+# Identity
+Identity = namedtuple('Identity', 'id username role')
+
+def remember_identity(user):
+    """Store the identity claims in the signed session cookie."""
+    session['user_id'] = user.id
+    session['username'] = user.username
+    session['role'] = user.role
+
+class IdentityCache:
+    """Size-capped LRU of (username, role) rows read from the users table."""
+
+    def __init__(self):
+        self._entries = OrderedDict()  # user_id -> (expires_at, Identity or None)
+        self._lock = threading.Lock()
+
+    def get(self, user_id, fresh=False):
+        now = time.monotonic()
+        if not fresh:
+            with self._lock:
+                entry = self._entries.get(user_id)
+                if entry and entry[0] > now:
+                    self._entries.move_to_end(user_id)
+                    return entry[1]
+        row = db.session.execute(
+            select(User.id, User.username, User.role).where(User.id == user_id)
+        ).first()
+        identity = Identity(*row) if row else None
+        self.put(user_id, identity)
+        return identity
+
+    def put(self, user_id, identity):
+        expires_at = time.monotonic() + app.config['IDENTITY_RECHECK_SECONDS']
+        with self._lock:
+            self._entries[user_id] = (expires_at, identity)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > app.config['IDENTITY_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+
+identities = IdentityCache()
+
+def current_identity(fresh=False):
+    """Return the logged-in user's id, username and role, or None.
+
+    Resolved once per request. The session only says who logged in: the
+    username and role come from the users table, memoized per process for
+    IDENTITY_RECHECK_SECONDS. fresh=True reads the row now, so a demoted
+    admin loses access on their next request. A session whose user is gone
+    is cleared, and claims that no longer match the row are rewritten.
+    """
+    if 'identity' not in g or (fresh and not g.identity_fresh):
+        uid = session.get('user_id')
+        identity = identities.get(uid, fresh=fresh) if uid else None
+        if uid and not identity:
+            session.clear()
+        elif identity and (session.get('username'), session.get('role')) != (identity.username, identity.role):
+            remember_identity(identity)
+        g.identity = identity
+        g.identity_fresh = fresh
+    return g.identity
+
 def current_user():
-    uid = session.get('user_id')
-    if not uid:
+    """Return the full User row, for the few views that modify it."""
+    identity = current_identity()
+    if not identity:
         return None
-    return User.query.get(uid)
+    return db.session.get(User, identity.id)
+
+def json_unauthorized():
+    return jsonify({'error': 'unauthorized'}), 401
+
+def require_role(role, unauthorized=None):
+    """Only run the view for a logged-in `role`; otherwise return unauthorized().
+
+    The default response redirects to the login page. Admin routes check the
+    role against the database on every request.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            identity = current_identity(fresh=(role == 'admin'))
+            if not identity or identity.role != role:
+                return unauthorized() if unauthorized else redirect(url_for('login'))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+require_user = require_role('user')
+require_admin = require_role('admin')
+require_user_json = require_role('user', unauthorized=json_unauthorized)
+require_admin_json = require_role('admin', unauthorized=json_unauthorized)
+
+# Query budgets
+# Maximum SQL statements per request for routes that render per-row data.
+# The counts must not grow with the number of subscriptions or invoices, so
+# relationships used by these views are eager-loaded. Each budget includes
+# one statement for the identity re-check that current_identity() makes
+# every IDENTITY_RECHECK_SECONDS.
+QUERY_BUDGETS = {
+    'user_dashboard': 4,
+    'user_billing_history': 2,
+    'user_recommendations': 4,
+    'user_offers': 3,
+    'user_notifications': 3,
+    'api_chatbot_reply': 7,
+    'api_get_chats': 3,
+    'api_quote': 4,
+}
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+_query_recorders = []
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+    for statements, with_parameters in _query_recorders:
+        statements.append((statement, parameters) if with_parameters else statement)
+
+@contextmanager
+def count_queries(parameters=False):
+    """Collect the SQL statements executed inside the block, e.g. in tests:
+
+        with count_queries() as statements:
+            client.get('/user/dashboard')
+        assert len(statements) <= QUERY_BUDGETS['user_dashboard']
+
+    With parameters=True each item is a (statement, parameters) pair.
+    """
+    recorder = ([], parameters)
+    _query_recorders.append(recorder)
+    try:
+        yield recorder[0]
+    finally:
+        _query_recorders.remove(recorder)
+
+@app.after_request
+def check_query_budget(response):
+    budget = QUERY_BUDGETS.get(request.endpoint)
+    count = g.get('query_count', 0)
+    if budget is not None and count > budget:
+        message = f'{request.endpoint} ran {count} queries (budget {budget})'
+        if app.config['QUERY_BUDGET_STRICT']:
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+    return response
+
+# Rate limiting
+# Expensive endpoints get a token bucket per caller: `capacity` requests in a
+# burst, refilled at `per_second`. Callers are keyed by user id from the
+# session cookie (no query), or by IP before login. A request over its
+# budget, or over the route's max_in_flight in this process, is answered
+# at once with 429/503 and Retry-After instead of waiting for a thread or
+# the database. Override single routes with
+# RATE_LIMITS="api_chatbot_reply=10/1,login=5/0.1".
+RateLimit = namedtuple('RateLimit', 'capacity per_second methods max_in_flight', defaults=(None, None))
+
+RATE_LIMITS = {
+    'login': RateLimit(10, 0.2, methods=('POST',)),  # per IP: 10 attempts, then one per 5 s
+    'apply_discount': RateLimit(20, 2),
+    'api_quote': RateLimit(20, 2),
+    'api_chatbot_reply': RateLimit(5, 0.5, max_in_flight=8),
+    'user_notifications': RateLimit(10, 1),
+}
+
+def rate_limits(overrides=''):
+    limits = dict(RATE_LIMITS)
+    for item in filter(None, (part.strip() for part in overrides.split(','))):
+        endpoint, _, value = item.partition('=')
+        capacity, _, per_second = value.partition('/')
+        capacity, per_second = float(capacity), float(per_second)
+        if capacity < 1 or per_second <= 0:
+            raise ValueError(f'RATE_LIMITS: {item!r} needs a burst of at least 1 and a positive refill rate')
+        limits[endpoint.strip()] = limits.get(endpoint.strip(), RateLimit(0, 0))._replace(
+            capacity=capacity, per_second=per_second)
+    return limits
+
+
+def refill(tokens, updated, now, capacity, per_second):
+    """Take one token; return (tokens left, seconds until one is available or 0 if taken)."""
+    tokens = min(capacity, tokens + max(0.0, now - updated) * per_second)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / per_second
+
+class TokenBuckets:
+    """Token buckets for this process, shared by its request threads."""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()  # key -> (tokens, updated), least recently used first
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, per_second):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens, wait = refill(tokens, updated, now, capacity, per_second)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)  # forgetting a bucket refills it
+        return wait
+
+class SharedTokenBuckets:
+    """Token buckets in a memory-mapped file, shared by every process on the host.
+
+    A key hashes to PROBES adjacent slots of (key hash, tokens, updated). It
+    uses the slot with its hash, else claims one that is empty or idle long
+    enough to be full again, else the least recently used. The slots are
+    locked with fcntl.lockf across processes and a thread lock within one.
+    """
+
+    SLOT = struct.Struct('<Qdd')
+    PROBES = 4
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        import fcntl  # POSIX only, like the shared backend itself
+        import mmap
+        self._fcntl = fcntl
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.slots * self.SLOT.size
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        self._fd = fd
+        self._map = mmap.mmap(fd, size)
+
+    def take(self, key, capacity, per_second):
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') | 1
+        first = digest % (self.slots - self.PROBES + 1)
+        offset, length = first * self.SLOT.size, self.PROBES * self.SLOT.size
+        with self._lock:
+            if self._map is None:
+                self._open()
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_EX, length, offset)
+            try:
+                now = time.time()
+                idle = capacity / per_second
+                slots = [(offset + i * self.SLOT.size,) + self.SLOT.unpack_from(self._map, offset + i * self.SLOT.size)
+                         for i in range(self.PROBES)]
+                mine = next((slot for slot in slots if slot[1] == digest), None)
+                if mine is None:
+                    free = [slot for slot in slots if not slot[1] or now - slot[3] >= idle]
+                    mine = (free or sorted(slots, key=lambda slot: slot[3]))[0]
+                    mine = (mine[0], digest, capacity, now)
+                position, _, tokens, updated = mine
+                tokens, wait = refill(tokens, updated, now, capacity, per_second)
+                self.SLOT.pack_into(self._map, position, digest, tokens, now)
+            finally:
+                self._fcntl.lockf(self._fd, self._fcntl.LOCK_UN, length, offset)
+        return wait
+
+class RateLimiter:
+    """Applies app.config['RATE_LIMITS'] before each request and counts what it refused."""
+
+    def __init__(self):
+        self.memory = TokenBuckets()
+        self.shared = SharedTokenBuckets(app.config['RATE_LIMIT_SHARED_PATH'], app.config['RATE_LIMIT_SHARED_SLOTS'])
+        self._lock = threading.Lock()
+        self._in_flight = defaultdict(int)  # endpoint -> running requests in this process
+        self.limited = defaultdict(int)
+        self.shed = defaultdict(int)
+
+    def buckets(self):
+        return self.shared if app.config['RATE_LIMIT_BACKEND'] == 'shared' else self.memory
+
+    def check(self, endpoint, limit):
+        """Return (status, retry_after) to refuse the request, or None to let it run."""
+        who = session.get('user_id')
+        caller = f'user:{who}' if who and endpoint != 'login' else f'ip:{request.remote_addr}'
+        wait = self.buckets().take(f'{endpoint}:{caller}', limit.capacity, limit.per_second)
+        if wait:
+            with self._lock:
+                self.limited[endpoint] += 1
+            return 429, wait
+        if limit.max_in_flight:
+            with self._lock:
+                if self._in_flight[endpoint] >= limit.max_in_flight:
+                    self.shed[endpoint] += 1
+                    return 503, 1
+                self._in_flight[endpoint] += 1
+            g.rate_limit_slot = endpoint
+        return None
+
+    def release(self, endpoint):
+        with self._lock:
+            self._in_flight[endpoint] -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': app.config['RATE_LIMIT_BACKEND'],
+                'in_flight': {k: v for k, v in self._in_flight.items() if v},
+                'limited': dict(self.limited),
+                'shed': dict(self.shed),
+            }
+
+rate_limiter = RateLimiter()
+
+@app.before_request
+def apply_rate_limit():
+    limit = app.config['RATE_LIMITS'].get(request.endpoint)
+    if not app.config['RATE_LIMIT_ENABLED'] or limit is None or (limit.methods and request.method not in limit.methods):
+        return None
+    refused = rate_limiter.check(request.endpoint, limit)
+    if refused is None:
+        return None
+    status, wait = refused
+    retry_after = str(max(1, math.ceil(wait)))
+    message = 'Too many requests, try again later' if status == 429 else 'Server busy, try again shortly'
+    if request.accept_mimetypes.best == 'text/html':
+        response = make_response(message, status)
+    else:
+        response = jsonify({'success': False, 'error': message, 'message': message, 'retry_after': int(retry_after)})
+        response.status_code = status
+    response.headers['Retry-After'] = retry_after
+    return response
+
+@app.teardown_request
+def release_rate_limit_slot(exc):
+    endpoint = g.pop('rate_limit_slot', None)
+    if endpoint:
+        rate_limiter.release(endpoint)
+
+# Index advisor
+# `flask explain-routes` requests each read-only page below as a user and an
+# admin, runs EXPLAIN QUERY PLAN over every statement it captured and flags
+# full table scans, so a new query cannot silently fall back to a scan.
+# Tables that stay small by design may be scanned.
+EXPLAIN_ROUTES = [
+    ('user', '/user/dashboard'), ('user', '/plans'), ('user', '/select-payment/{plan_id}'),
+    ('user', '/user/billing-history'), ('user', '/user/recommendations'), ('user', '/user/offers'),
+    ('user', '/api/user/notifications'), ('user', '/api/chats'), ('user', '/api/chats/sync'),
+    ('user', '/api/quote?code=SUMMER20'), ('user', '/user/payment-methods'),
+    ('admin', '/admin/dashboard'), ('admin', '/admin/analytics'), ('admin', '/admin/discounts'),
+    ('admin', '/api/analytics/bundle'), ('admin', '/api/plan_counts'), ('admin', '/admin/audit/search?q=plan'),
+]
+EXPLAIN_SCAN_ALLOWED = {
+    'plan': 'catalog, loaded whole into PlanCatalog',
+    'discount': 'loaded whole into PricingRules',
+    'cache_version': 'a handful of stamps',
+    'counter': 'one row per counter',
+    'analytics': 'rollups, bounded by days x plans x statuses',
+}
+
+def explain_statement(statement, parameters):
+    """Return the EXPLAIN QUERY PLAN detail lines of a captured statement."""
+    if isinstance(parameters, list):  # executemany: the first row plans like the rest
+        parameters = parameters[0] if parameters else ()
+    rows = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    return [row[-1] for row in rows]
+
+def full_scans(plan):
+    """Tables the plan reads without an index, e.g. 'SCAN subscription'."""
+    return [line.split()[1] for line in plan if line.startswith('SCAN ') and ' USING ' not in line]
+
+def explain_route(client, path):
+    """Request path and return [(statement, plan, scanned tables)] for its reads."""
+    response_cache.clear()
+    # A fresh app context gives the request its own g, as in a real server
+    with app.app_context(), count_queries(parameters=True) as statements:
+        response = client.get(path)
+    if response.status_code >= 400:
+        raise click.ClickException(f'{path} returned HTTP {response.status_code}')
+    results = []
+    for statement, parameters in statements:
+        if statement.lstrip().split(None, 1)[0].upper() not in ('SELECT', 'WITH', 'UPDATE', 'DELETE'):
+            continue
+        plan = explain_statement(statement, parameters)
+        results.append((statement, plan, full_scans(plan)))
+    return results
+
+@app.cli.command('explain-routes')
+@click.option('--user', 'username', default='user1', show_default=True, help='Account for the user pages.')
+@click.option('--admin', 'admin_name', default='admin', show_default=True, help='Account for the admin pages.')
+@click.option('--verbose', '-v', is_flag=True, help='Print every statement and its plan.')
+def explain_routes_command(username, admin_name, verbose):
+    """Flag full table scans in the SQL of the main read-only routes (SQLite)."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('explain-routes reads SQLite query plans')
+    clients = {}
+    for role, name in (('user', username), ('admin', admin_name)):
+        account = User.query.filter_by(username=name, role=role).first()
+        if account is None:
+            raise click.ClickException(f'no {role} account named {name}')
+        clients[role] = app.test_client()
+        with clients[role].session_transaction() as client_session:
+            client_session.update(user_id=account.id, username=account.username, role=account.role)
+    plan_ids = [plan.id for plan in plan_catalog().active]
+    flagged = 0
+    for role, path in EXPLAIN_ROUTES:
+        path = path.format(plan_id=plan_ids[0] if plan_ids else 0)
+        results = explain_route(clients[role], path)
+        scans = [(statement, table) for statement, _, tables in results for table in tables
+                 if table not in EXPLAIN_SCAN_ALLOWED]
+        flagged += len(scans)
+        click.echo(f"{'SCAN' if scans else 'ok':<5} {path} ({len(results)} statements)")
+        for statement, table in scans:
+            click.echo(f'      full scan of {table}: ' + ' '.join(statement.split())[:160])
+        if verbose:
+            for statement, plan, _ in results:
+                click.echo('      ' + ' '.join(statement.split())[:160])
+                for line in plan:
+                    click.echo('        ' + line)
+    db.session.rollback()
+    click.echo(f'{flagged} full table scans outside {sorted(EXPLAIN_SCAN_ALLOWED)}.')
+    if flagged:
+        raise SystemExit(1)
 
 # Routes
 @app.route('/')
 def index():
-    user = current_user()
+    user = current_identity()
     return render_template('index.html', user=user)
 
 @app.route('/login', methods=['GET','POST'])
@@ -262,8 +1892,8 @@ def login():
         password = request.form['password']
         user = User.query.filter_by(username=username, password=password).first()
         if user:
-            session['user_id'] = user.id
-            session['role'] = user.role
+            identities.put(user.id, Identity(user.id, user.username, user.role))
+            remember_identity(user)
             session['login_at'] = datetime.utcnow().isoformat()
             flash('Logged in successfully', 'success')
             if user.role == 'admin':
@@ -294,7 +1924,9 @@ def signup():
         # Create new user
         user = User(username=username, password=password, role=role)
         db.session.add(user)
-        db.session.add(AuditLog(actor=username, action=f"User registered with role {role}"))
+        if role == 'user':
+            bump_counters({COUNTER_USERS: 1})
+        audit(username, f"User registered with role {role}")
         db.session.commit()
         
         flash('Registration successful! Please login.', 'success')
@@ -304,34 +1936,27 @@ def signup():
 
 # User pages
 @app.route('/user/dashboard')
+@require_user
 def user_dashboard():
-    user = current_user()
-    if not user or user.role != 'user':
-        return redirect(url_for('login'))
-    subs = Subscription.query.filter_by(user_id=user.id).all()
-    plans = Plan.query.filter_by(active=True).all()
-    # Ensure chat tables exist (safe if already created)
-    try:
-        Chat.__table__.create(bind=db.engine, checkfirst=True)
-        ChatMessage.__table__.create(bind=db.engine, checkfirst=True)
-    except Exception:
-        pass
+    user = current_identity()
+    subs = Subscription.query.options(joinedload(Subscription.plan)).filter_by(user_id=user.id).all()
+    plans = plan_catalog().active
     return render_template('user_dashboard.html', user=user, subs=subs, plans=plans)
 
 @app.route('/plans')
 def list_plans():
-    user = current_user()
-    plans = Plan.query.filter_by(active=True).all()
+    user = current_identity()
+    plans = plan_catalog().active
     return render_template('plans.html', plans=plans, user=user)
 
 @app.route('/subscribe/<int:plan_id>', methods=['POST'])
 def subscribe(plan_id):
-    user = current_user()
+    user = current_identity()
     if not user or user.role != 'user':
         flash('Login as user to subscribe', 'warning')
         return redirect(url_for('login'))
     
-    plan = Plan.query.get_or_404(plan_id)
+    plan = plan_catalog().get_or_404(plan_id)
     
     # Check if user has any payment methods
     payment_methods = PaymentMethod.query.filter_by(user_id=user.id, is_active=True).all()
@@ -358,77 +1983,76 @@ def subscribe(plan_id):
         flash('Invalid payment method selected', 'danger')
         return redirect(url_for('select_payment_method', plan_id=plan_id, discount_code=discount_code))
 
-    discount_amount = 0
-    
-    # Apply discount if code provided
-    if discount_code:
-        discount = Discount.query.filter_by(code=discount_code, active=True).first()
-        if discount:
-            now = datetime.utcnow()
-            if now < discount.valid_from:
-                flash('Discount not yet valid', 'warning')
-            elif now > discount.valid_until:
-                flash('Discount validity expired', 'warning')
-            elif discount.usage_limit and discount.used_count >= discount.usage_limit:
-                flash('Discount code usage limit exceeded', 'warning')
+    # Everything below runs in one transaction: a failed checkout rolls back
+    # the discount reservation together with the subscription.
+    try:
+        discount_amount = 0
+    
+        # Apply discount if code provided
+        if discount_code:
+            price = quote(plan, discount_code)
+            discount = price.discount
+            if price.error:
+                flash(price.error, 'warning')
+            # Claim one use atomically; a concurrent checkout may have taken the last one
+            elif reserve_discount(discount.id):
+                discount_amount = price.discount_amount
             else:
-                if discount.discount_type == 'percentage':
-                    discount_amount = (plan.price * discount.discount_value) / 100
-                    if discount.max_discount:
-                        discount_amount = min(discount_amount, discount.max_discount)
-                else:
-                    discount_amount = min(discount.discount_value, plan.price)
-                
-                # Update discount usage
-                discount.used_count += 1
-                db.session.add(discount)
-        else:
-            flash('Invalid discount code', 'warning')
-    
-    # Use the selected payment method
-    default_payment = selected_payment
-    
-    # Create subscription
-    sub = Subscription(
-        user_id=user.id, 
-        plan_id=plan.id, 
-        status='active', 
-        start_date=datetime.utcnow(), 
-        end_date=datetime.utcnow()+timedelta(days=30)
-    )
-    db.session.add(sub)
-    db.session.flush()  # Get the subscription ID
+                flash('Discount code usage limit exceeded', 'warning')
     
-    # Create billing record
-    final_amount = max(0, plan.price - discount_amount)
-    billing_record = BillingHistory(
-        user_id=user.id,
-        subscription_id=sub.id,
-        amount=final_amount,
-        payment_method_id=default_payment.id,
-        status='paid',
-        payment_date=datetime.utcnow(),
-        invoice_number=f'INV-{sub.id}-{int(datetime.utcnow().timestamp())}',
-        description=f'{plan.name} subscription payment'
-    )
-    db.session.add(billing_record)
+        # Use the selected payment method
+        default_payment = selected_payment
+    
+        # Create subscription
+        sub = Subscription(
+            user_id=user.id, 
+            plan_id=plan.id, 
+            status='active', 
+            start_date=datetime.utcnow(), 
+            end_date=datetime.utcnow()+timedelta(days=30)
+        )
+        db.session.add(sub)
+        db.session.flush()  # Get the subscription ID
+        apply_rollup(added=rollup_keys(sub))
     
-    # Create discount usage record if discount applied
-    if discount_amount > 0:
-        discount_usage = DiscountUsage(
-            discount_id=discount.id,
+        # Create billing record
+        final_amount = max(0, plan.price - discount_amount)
+        billing_record = BillingHistory(
             user_id=user.id,
             subscription_id=sub.id,
-            discount_amount=discount_amount
+            amount=final_amount,
+            payment_method_id=default_payment.id,
+            status='paid',
+            payment_date=datetime.utcnow(),
+            invoice_number=f'INV-{sub.id}-{int(datetime.utcnow().timestamp())}',
+            description=f'{plan.name} subscription payment'
         )
-        db.session.add(discount_usage)
+        db.session.add(billing_record)
     
-    action_msg = f"Subscribed to {plan.name}"
-    if discount_amount > 0:
-        action_msg += f" with {discount_code} discount (₹{discount_amount:.2f} off)"
+        # Create discount usage record if discount applied
+        if discount_amount > 0:
+            discount_usage = DiscountUsage(
+                discount_id=discount.id,
+                user_id=user.id,
+                subscription_id=sub.id,
+                discount_amount=discount_amount
+            )
+            db.session.add(discount_usage)
     
-    db.session.add(AuditLog(actor=user.username, action=action_msg))
-    db.session.commit()
+        action_msg = f"Subscribed to {plan.name}"
+        if discount_amount > 0:
+            action_msg += f" with {discount_code} discount (₹{discount_amount:.2f} off)"
+    
+        audit(user.username, action_msg)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'success': False, 'message': 'Checkout failed, please try again'})
+        flash('Checkout failed, please try again', 'danger')
+        return redirect(url_for('select_payment_method', plan_id=plan_id, discount_code=discount_code))
+    response_cache.clear()
+    chat_contexts.invalidate(user.id)
     
     # Demo-friendly success handling
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -448,12 +2072,11 @@ def subscribe(plan_id):
         return redirect(url_for('user_dashboard'))
 
 @app.route('/select-payment/<int:plan_id>')
+@require_user
 def select_payment_method(plan_id):
-    user = current_user()
-    if not user or user.role != 'user':
-        return redirect(url_for('login'))
+    user = current_identity()
     
-    plan = Plan.query.get_or_404(plan_id)
+    plan = plan_catalog().get_or_404(plan_id)
     payment_methods = PaymentMethod.query.filter_by(user_id=user.id, is_active=True).all()
     discount_code = request.args.get('discount_code', '')
     
@@ -461,31 +2084,18 @@ def select_payment_method(plan_id):
         flash('Please add a payment method before subscribing', 'info')
         return redirect(url_for('user_payment_methods'))
     
-    # Calculate discount if code provided
-    discount_amount = 0
-    if discount_code:
-        discount = Discount.query.filter_by(code=discount_code, active=True).first()
-        if discount and discount.valid_from <= datetime.utcnow() <= discount.valid_until:
-            if not discount.usage_limit or discount.used_count < discount.usage_limit:
-                if discount.discount_type == 'percentage':
-                    discount_amount = (plan.price * discount.discount_value) / 100
-                    if discount.max_discount:
-                        discount_amount = min(discount_amount, discount.max_discount)
-                else:
-                    discount_amount = min(discount.discount_value, plan.price)
-    
-    final_amount = max(0, plan.price - discount_amount)
+    price = quote(plan, discount_code)
     
     return render_template('select_payment_method.html', 
                          plan=plan, 
                          payment_methods=payment_methods, 
                          discount_code=discount_code,
-                         discount_amount=discount_amount,
-                         final_amount=final_amount)
+                         discount_amount=price.discount_amount,
+                         final_amount=price.final_price)
 
 @app.route('/apply_discount', methods=['POST'])
 def apply_discount():
-    user = current_user()
+    user = current_identity()
     if not user:
         return jsonify({'success': False, 'message': 'Please login first'})
     
@@ -495,74 +2105,80 @@ def apply_discount():
     if not discount_code or not plan_id:
         return jsonify({'success': False, 'message': 'Please provide discount code and plan'})
     
-    plan = Plan.query.get_or_404(plan_id)
-    discount = Discount.query.filter_by(code=discount_code, active=True).first()
-    
-    if not discount:
-        return jsonify({'success': False, 'message': 'Invalid discount code'})
-    
-    if not (discount.valid_from <= datetime.utcnow() <= discount.valid_until):
-        return jsonify({'success': False, 'message': 'Discount code has expired'})
-    
-    if discount.usage_limit and discount.used_count >= discount.usage_limit:
-        return jsonify({'success': False, 'message': 'Discount code usage limit exceeded'})
-    
-    if plan.price < discount.min_amount:
-        return jsonify({'success': False, 'message': f'Minimum order amount of ₹{discount.min_amount} required'})
-    
-    # Calculate discount amount
-    if discount.discount_type == 'percentage':
-        discount_amount = (plan.price * discount.discount_value) / 100
-        if discount.max_discount:
-            discount_amount = min(discount_amount, discount.max_discount)
-    else:
-        discount_amount = min(discount.discount_value, plan.price)
-    
-    final_price = plan.price - discount_amount
-    
+    plan = plan_catalog().get_or_404(plan_id)
+    return jsonify(quote_json(quote(plan, discount_code)))
+
+def quote_json(price):
+    if price.error:
+        return {'success': False, 'message': price.error, 'plan_id': price.plan.id}
+    return {
+        'success': True,
+        'plan_id': price.plan.id,
+        'discount_amount': price.discount_amount,
+        'original_price': price.plan.price,
+        'final_price': price.final_price,
+        'discount_name': price.discount.name,
+        'discount_type': price.discount.discount_type
+    }
+
+@app.route('/api/quote')
+def api_quote():
+    """Price every active plan against ?code= in one call (used by the plans page)."""
+    user = current_identity()
+    if not user:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    discount_code = request.args.get('code', '').strip().upper()
+    if not discount_code:
+        return jsonify({'success': False, 'message': 'Please provide a discount code'})
+    now = datetime.utcnow()
     return jsonify({
         'success': True,
-        'discount_amount': discount_amount,
-        'original_price': plan.price,
-        'final_price': final_price,
-        'discount_name': discount.name,
-        'discount_type': discount.discount_type
+        'code': discount_code,
+        'quotes': [quote_json(quote(plan, discount_code, now)) for plan in plan_catalog().active],
     })
 
 @app.route('/cancel/<int:sub_id>', methods=['POST'])
 def cancel(sub_id):
-    user = current_user()
+    user = current_identity()
     if not user:
         return redirect(url_for('login'))
     sub = Subscription.query.get_or_404(sub_id)
     if user.role!='admin' and sub.user_id != user.id:
         flash('Not authorized', 'danger')
         return redirect(url_for('user_dashboard'))
+    before = rollup_keys(sub)
     sub.status = 'cancelled'
-    db.session.add(AuditLog(actor=user.username, action=f"Cancelled subscription {sub.id}"))
+    apply_rollup(removed=before, added=rollup_keys(sub))
+    audit(user.username, f"Cancelled subscription {sub.id}")
     db.session.commit()
+    response_cache.clear()
+    chat_contexts.invalidate(sub.user_id)
     flash('Subscription cancelled', 'info')
     return redirect(url_for('user_dashboard') if user.role=='user' else url_for('admin_dashboard'))
 
 @app.route('/renew/<int:sub_id>', methods=['POST'])
 def renew(sub_id):
-    user = current_user()
+    user = current_identity()
     if not user:
         return redirect(url_for('login'))
     sub = Subscription.query.get_or_404(sub_id)
     if user.role!='admin' and sub.user_id != user.id:
         flash('Not authorized', 'danger')
         return redirect(url_for('user_dashboard'))
+    before = rollup_keys(sub)
     sub.status = 'active'
     sub.end_date = datetime.utcnow()+timedelta(days=30)
-    db.session.add(AuditLog(actor=user.username, action=f"Renewed subscription {sub.id}"))
+    apply_rollup(removed=before, added=rollup_keys(sub))
+    audit(user.username, f"Renewed subscription {sub.id}")
     db.session.commit()
+    response_cache.clear()
+    chat_contexts.invalidate(sub.user_id)
     flash('Subscription renewed', 'success')
     return redirect(url_for('user_dashboard') if user.role=='user' else url_for('admin_dashboard'))
 
 @app.route('/upgrade/<int:sub_id>', methods=['POST'])
 def upgrade_subscription(sub_id):
-    user = current_user()
+    user = current_identity()
     if not user or user.role != 'user':
         flash('Login as user to upgrade subscription', 'warning')
         return redirect(url_for('login'))
@@ -577,10 +2193,11 @@ def upgrade_subscription(sub_id):
         flash('Please select a plan to upgrade to', 'warning')
         return redirect(url_for('user_dashboard'))
     
-    new_plan = Plan.query.get_or_404(new_plan_id)
+    new_plan = plan_catalog().get_or_404(new_plan_id)
     old_plan = sub.plan
     
     # Cancel current subscription
+    before = rollup_keys(sub)
     sub.status = 'cancelled'
     
     # Create new subscription
@@ -593,15 +2210,18 @@ def upgrade_subscription(sub_id):
     )
     
     db.session.add(new_sub)
-    db.session.add(AuditLog(actor=user.username, action=f"Upgraded from {old_plan.name} to {new_plan.name}"))
+    apply_rollup(removed=before, added=rollup_keys(sub) + rollup_keys(new_sub))
+    audit(user.username, f"Upgraded from {old_plan.name} to {new_plan.name}")
     db.session.commit()
+    response_cache.clear()
+    chat_contexts.invalidate(user.id)
     
     flash(f'Successfully upgraded from {old_plan.name} to {new_plan.name}', 'success')
     return redirect(url_for('user_dashboard'))
 
 @app.route('/downgrade/<int:sub_id>', methods=['POST'])
 def downgrade_subscription(sub_id):
-    user = current_user()
+    user = current_identity()
     if not user or user.role != 'user':
         flash('Login as user to downgrade subscription', 'warning')
         return redirect(url_for('login'))
@@ -616,10 +2236,11 @@ def downgrade_subscription(sub_id):
         flash('Please select a plan to downgrade to', 'warning')
         return redirect(url_for('user_dashboard'))
     
-    new_plan = Plan.query.get_or_404(new_plan_id)
+    new_plan = plan_catalog().get_or_404(new_plan_id)
     old_plan = sub.plan
     
     # Cancel current subscription
+    before = rollup_keys(sub)
     sub.status = 'cancelled'
     
     # Create new subscription
@@ -632,32 +2253,33 @@ def downgrade_subscription(sub_id):
     )
     
     db.session.add(new_sub)
-    db.session.add(AuditLog(actor=user.username, action=f"Downgraded from {old_plan.name} to {new_plan.name}"))
+    apply_rollup(removed=before, added=rollup_keys(sub) + rollup_keys(new_sub))
+    audit(user.username, f"Downgraded from {old_plan.name} to {new_plan.name}")
     db.session.commit()
+    response_cache.clear()
+    chat_contexts.invalidate(user.id)
     
     flash(f'Successfully downgraded from {old_plan.name} to {new_plan.name}', 'success')
     return redirect(url_for('user_dashboard'))
 
 # Admin pages
 @app.route('/admin/dashboard')
+@require_admin
 def admin_dashboard():
-    user = current_user()
-    if not user or user.role != 'admin':
-        return redirect(url_for('login'))
+    user = current_identity()
     plans = Plan.query.all()
     discounts = Discount.query.filter_by(active=True).all()
-    total_users = User.query.filter_by(role='user').count()
-    total_subs = Subscription.query.count()
-    from sqlalchemy import func
-    plan_counts = db.session.query(Plan.name, func.count(Subscription.id)).join(Subscription, Subscription.plan_id==Plan.id).group_by(Plan.name).all()
-    logs = AuditLog.query.order_by(AuditLog.timestamp.desc()).limit(10).all()
+    counters = counter_values()
+    total_users = counters.get(COUNTER_USERS, 0)
+    total_subs = counters.get(COUNTER_SUBSCRIPTIONS, 0)
+    plan_counts = plan_subscription_counts(counters)
+    logs = recent_activity()
     return render_template('admin_dashboard.html', plans=plans, discounts=discounts, total_users=total_users, total_subs=total_subs, plan_counts=plan_counts, logs=logs)
 
 @app.route('/admin/plans/create', methods=['GET','POST'])
+@require_admin
 def create_plan():
-    user = current_user()
-    if not user or user.role!='admin':
-        return redirect(url_for('login'))
+    user = current_identity()
     if request.method=='POST':
         name = request.form['name']
         quota = int(request.form['quota_gb'])
@@ -665,55 +2287,56 @@ def create_plan():
         desc = request.form.get('description','')
         plan = Plan(name=name, quota_gb=quota, price=price, description=desc, active=True)
         db.session.add(plan)
-        db.session.add(AuditLog(actor=user.username, action=f"Created plan {name}"))
+        bump_cache_version('plans')
+        audit(user.username, f"Created plan {name}")
         db.session.commit()
+        response_cache.clear()
         flash('Plan created', 'success')
         return redirect(url_for('admin_dashboard'))
     return render_template('create_plan.html')
 
 @app.route('/admin/plans/<int:plan_id>/edit', methods=['GET','POST'])
+@require_admin
 def edit_plan(plan_id):
-    user = current_user()
-    if not user or user.role!='admin':
-        return redirect(url_for('login'))
+    user = current_identity()
     plan = Plan.query.get_or_404(plan_id)
     if request.method=='POST':
         plan.name = request.form['name']
         plan.quota_gb = int(request.form['quota_gb'])
         plan.price = float(request.form['price'])
         plan.description = request.form.get('description','')
-        db.session.add(AuditLog(actor=user.username, action=f"Edited plan {plan.name}"))
+        bump_cache_version('plans')
+        audit(user.username, f"Edited plan {plan.name}")
         db.session.commit()
+        response_cache.clear()
         flash('Plan updated', 'success')
         return redirect(url_for('admin_dashboard'))
     return render_template('edit_plan.html', plan=plan)
 
 @app.route('/admin/plans/<int:plan_id>/delete', methods=['POST'])
+@require_admin
 def delete_plan(plan_id):
-    user = current_user()
-    if not user or user.role!='admin':
-        return redirect(url_for('login'))
+    user = current_identity()
     plan = Plan.query.get_or_404(plan_id)
     plan.active = False
-    db.session.add(AuditLog(actor=user.username, action=f"Deactivated plan {plan.name}"))
+    bump_cache_version('plans')
+    audit(user.username, f"Deactivated plan {plan.name}")
     db.session.commit()
+    response_cache.clear()
     flash('Plan deactivated', 'info')
     return redirect(url_for('admin_dashboard'))
 
 # Discount Management Routes
 @app.route('/admin/discounts')
+@require_admin
 def list_discounts():
-    user = current_user()
-    if not user or user.role != 'admin':
-        return redirect(url_for('login'))
     discounts = Discount.query.all()
     return render_template('admin_discounts.html', discounts=discounts)
 
 @app.route('/admin/discounts/create', methods=['GET', 'POST'])
+@require_admin
 def create_discount():
-    user = current_user()
-    if not user or user.role != 'admin':
-        return redirect(url_for('login'))
+    user = current_identity()
     if request.method == 'POST':
         name = request.form['name']
         code = request.form['code']
@@ -734,17 +2357,17 @@ def create_discount():
             description=description
         )
         db.session.add(discount)
-        db.session.add(AuditLog(actor=user.username, action=f"Created discount {name}"))
+        bump_cache_version('discounts')
+        audit(user.username, f"Created discount {name}")
         db.session.commit()
         flash('Discount created successfully', 'success')
         return redirect(url_for('list_discounts'))
     return render_template('create_discount.html')
 
 @app.route('/admin/discounts/<int:discount_id>/edit', methods=['GET', 'POST'])
+@require_admin
 def edit_discount(discount_id):
-    user = current_user()
-    if not user or user.role != 'admin':
-        return redirect(url_for('login'))
+    user = current_identity()
     discount = Discount.query.get_or_404(discount_id)
     if request.method == 'POST':
         discount.name = request.form['name']
@@ -758,76 +2381,45 @@ def edit_discount(discount_id):
         discount.usage_limit = int(request.form['usage_limit']) if request.form.get('usage_limit') else None
         discount.description = request.form.get('description', '')
         
-        db.session.add(AuditLog(actor=user.username, action=f"Edited discount {discount.name}"))
+        bump_cache_version('discounts')
+        audit(user.username, f"Edited discount {discount.name}")
         db.session.commit()
         flash('Discount updated successfully', 'success')
         return redirect(url_for('list_discounts'))
     return render_template('edit_discount.html', discount=discount)
 
 @app.route('/admin/discounts/<int:discount_id>/toggle', methods=['POST'])
+@require_admin
 def toggle_discount(discount_id):
-    user = current_user()
-    if not user or user.role != 'admin':
-        return redirect(url_for('login'))
+    user = current_identity()
     discount = Discount.query.get_or_404(discount_id)
     discount.active = not discount.active
-    db.session.add(AuditLog(actor=user.username, action=f"Toggled discount {discount.name} to {'active' if discount.active else 'inactive'}"))
+    bump_cache_version('discounts')
+    audit(user.username, f"Toggled discount {discount.name} to {'active' if discount.active else 'inactive'}")
     db.session.commit()
     flash(f'Discount {"activated" if discount.active else "deactivated"}', 'info')
     return redirect(url_for('list_discounts'))
 
 # Analytics Routes
 @app.route('/admin/analytics')
+@require_admin
 def admin_analytics():
-    user = current_user()
-    if not user or user.role != 'admin':
-        return redirect(url_for('login'))
-    
-    # Get subscription trends
-    from sqlalchemy import func, extract
-    monthly_subs_raw = db.session.query(
-        extract('month', Subscription.start_date).label('month'),
-        func.count(Subscription.id).label('count')
-    ).group_by(extract('month', Subscription.start_date)).all()
-    
-    # Convert Row objects to dictionaries for JSON serialization
-    monthly_subs = [{'month': int(row.month), 'count': row.count} for row in monthly_subs_raw]
-    
-    # Get plan popularity
-    plan_popularity_raw = db.session.query(
-        Plan.name, func.count(Subscription.id).label('count')
-    ).join(Subscription, Subscription.plan_id == Plan.id).group_by(Plan.name).all()
-    
-    # Convert Row objects to dictionaries for JSON serialization
-    plan_popularity = [{'name': row.name, 'count': row.count} for row in plan_popularity_raw]
-    
-    # Get churn rate
-    total_subs = Subscription.query.count()
-    cancelled_subs = Subscription.query.filter_by(status='cancelled').count()
-    churn_rate = (cancelled_subs / total_subs * 100) if total_subs > 0 else 0
-    
-    # Get revenue data
-    revenue_data_raw = db.session.query(
-        Plan.name, func.sum(Plan.price).label('revenue')
-    ).join(Subscription, Subscription.plan_id == Plan.id).group_by(Plan.name).all()
-    
-    # Convert Row objects to dictionaries for JSON serialization
-    revenue_data = [{'name': row.name, 'revenue': float(row.revenue)} for row in revenue_data_raw]
     
+    # All figures come from one pass over the daily per-plan rollups
+    bundle = response_cache.get_or_set('analytics_bundle', build_analytics_bundle)
     return render_template('admin_analytics.html', 
-                         monthly_subs=monthly_subs,
-                         plan_popularity=plan_popularity,
-                         churn_rate=churn_rate,
-                         revenue_data=revenue_data)
+                         monthly_subs=bundle['monthly_subs'],
+                         plan_popularity=bundle['plan_popularity'],
+                         churn_rate=bundle['churn_rate'],
+                         revenue_data=bundle['revenue_by_plan'])
 
 @app.route('/admin/seed_analytics')
+@require_admin
 def admin_seed_analytics():
     """Create additional synthetic subscriptions and billing records across the last 12 months.
     Admin-only for demo/analytics purposes.
     """
-    user = current_user()
-    if not user or user.role != 'admin':
-        return redirect(url_for('login'))
+    user = current_identity()
 
     plans = Plan.query.all()
     if not plans:
@@ -839,11 +2431,13 @@ def admin_seed_analytics():
     if not demo_user:
         demo_user = User(username='demo_analytics', password='demo', role='user')
         db.session.add(demo_user)
+        bump_counters({COUNTER_USERS: 1})
         db.session.flush()  # get ID
 
     # Create synthetic subscriptions per month
     now = datetime.utcnow()
     created_count = 0
+    seeded_subs = []
     for m in range(1, 13):  # last 12 months
         # pick a date roughly m months ago
         start_date = now - timedelta(days=30*m + random.randint(-5, 5))
@@ -864,8 +2458,10 @@ def admin_seed_analytics():
                 end_date=end_date
             )
             db.session.add(sub)
+            seeded_subs.append(sub)
             created_count += 1
 
+    apply_rollup(added=[key for sub in seeded_subs for key in rollup_keys(sub)])
     db.session.commit()
 
     # Create billing history for active subscriptions
@@ -882,10 +2478,13 @@ def admin_seed_analytics():
         db.session.add(payment_method)
         db.session.flush()
 
-    subs = Subscription.query.filter_by(user_id=demo_user.id).all()
+    subs = Subscription.query.options(joinedload(Subscription.plan)).filter_by(user_id=demo_user.id).all()
+    billed = set(db.session.scalars(
+        select(BillingHistory.subscription_id).where(BillingHistory.user_id == demo_user.id)
+    ))
     invoice_base = 5000
     for i, sub in enumerate(subs):
-        if BillingHistory.query.filter_by(subscription_id=sub.id).first():
+        if sub.id in billed:
             continue
         db.session.add(BillingHistory(
             user_id=demo_user.id,
@@ -898,41 +2497,38 @@ def admin_seed_analytics():
             description=f'{sub.plan.name} seeded payment'
         ))
 
-    db.session.add(AuditLog(actor='admin', action=f"Seeded analytics data: {created_count} subscriptions"))
+    audit('admin', f"Seeded analytics data: {created_count} subscriptions")
     db.session.commit()
+    response_cache.clear()
+    chat_contexts.invalidate(demo_user.id)
 
     flash(f'Seeded analytics data with {created_count} subscriptions and billing entries.', 'success')
     return redirect(url_for('admin_analytics'))
 
 @app.route('/api/analytics/subscription_trends')
+@cache_response
 def api_subscription_trends():
-    from sqlalchemy import func, extract
-    # Get active subscriptions by month
-    active_data = db.session.query(
-        extract('month', Subscription.start_date).label('month'),
-        func.count(Subscription.id).label('count')
-    ).filter(Subscription.status == 'active').group_by(extract('month', Subscription.start_date)).all()
-    
-    # Get cancelled subscriptions by month
-    cancelled_data = db.session.query(
-        extract('month', Subscription.start_date).label('month'),
-        func.count(Subscription.id).label('count')
-    ).filter(Subscription.status == 'cancelled').group_by(extract('month', Subscription.start_date)).all()
+    # Get active and cancelled subscriptions by start month
+    month = extract('month', Analytics.metric_date)
+    count = func.sum(Analytics.metric_value)
+    data = db.session.query(
+        month.label('month'), Analytics.metric_name, count.label('count')
+    ).filter(
+        Analytics.metric_name.in_([ROLLUP_STARTED + 'active', ROLLUP_STARTED + 'cancelled'])
+    ).group_by(month, Analytics.metric_name).having(count > 0).all()
     
     # Create month mapping
     all_months = set()
     active_dict = {}
     cancelled_dict = {}
     
-    for row in active_data:
-        month = int(row.month)
-        all_months.add(month)
-        active_dict[month] = row.count
-    
-    for row in cancelled_data:
+    for row in data:
         month = int(row.month)
         all_months.add(month)
-        cancelled_dict[month] = row.count
+        if row.metric_name == ROLLUP_STARTED + 'active':
+            active_dict[month] = int(row.count)
+        else:
+            cancelled_dict[month] = int(row.count)
     
     # Sort months and create arrays
     sorted_months = sorted(all_months)
@@ -949,12 +2545,15 @@ def api_subscription_trends():
     })
 
 @app.route('/api/analytics/revenue')
+@cache_response
 def api_revenue():
-    from sqlalchemy import func, extract
+    month = extract('month', Analytics.metric_date)
     data = db.session.query(
-        extract('month', Subscription.start_date).label('month'),
-        func.sum(Plan.price).label('revenue')
-    ).join(Plan, Subscription.plan_id == Plan.id).group_by(extract('month', Subscription.start_date)).all()
+        month.label('month'),
+        func.sum(Analytics.metric_value * Plan.price).label('revenue')
+    ).join(Plan, Analytics.plan_id == Plan.id).filter(
+        Analytics.metric_name.like(ROLLUP_STARTED + '%')
+    ).group_by(month).having(func.sum(Analytics.metric_value) > 0).order_by(month).all()
     
     months = [f"Month {int(r[0])}" for r in data]
     revenue = [float(r[1]) for r in data]
@@ -962,71 +2561,98 @@ def api_revenue():
     return jsonify({'labels': months, 'data': revenue})
 
 @app.route('/api/analytics/subscription_status')
+@cache_response
 def api_subscription_status():
-    from sqlalchemy import func
+    count = func.sum(Analytics.metric_value)
     data = db.session.query(
-        Subscription.status, func.count(Subscription.id).label('count')
-    ).group_by(Subscription.status).all()
+        Analytics.metric_name, count.label('count')
+    ).filter(
+        Analytics.metric_name.like(ROLLUP_STARTED + '%')
+    ).group_by(Analytics.metric_name).having(count > 0).order_by(Analytics.metric_name).all()
     
-    labels = [row.status.title() for row in data]
-    counts = [row.count for row in data]
+    labels = [row.metric_name[len(ROLLUP_STARTED):].title() for row in data]
+    counts = [int(row.count) for row in data]
     
     return jsonify({'labels': labels, 'data': counts})
 
 @app.route('/api/analytics/subscription_growth')
+@cache_response
 def api_subscription_growth():
-    from sqlalchemy import func, extract
+    month = extract('month', Analytics.metric_date)
+    count = func.sum(Analytics.metric_value)
     data = db.session.query(
-        extract('month', Subscription.start_date).label('month'),
-        func.count(Subscription.id).label('count')
-    ).group_by(extract('month', Subscription.start_date)).order_by(extract('month', Subscription.start_date)).all()
+        month.label('month'), count.label('count')
+    ).filter(
+        Analytics.metric_name.like(ROLLUP_STARTED + '%')
+    ).group_by(month).having(count > 0).order_by(month).all()
     
     months = [f"Month {int(row.month)}" for row in data]
-    counts = [row.count for row in data]
+    counts = [int(row.count) for row in data]
     
     return jsonify({'labels': months, 'data': counts})
 
 @app.route('/api/analytics/subscription_duration')
+@cache_response
 def api_subscription_duration():
-    from sqlalchemy import func, case
-    from datetime import datetime, timedelta
-    
-    # Calculate duration categories
-    now = datetime.utcnow()
+    # Bucket subscriptions by end day (day granularity, from the rollups)
+    today = datetime.utcnow().date()
     data = db.session.query(
-        case(
-            (Subscription.end_date > now + timedelta(days=30), 'Long-term (30+ days)'),
-            (Subscription.end_date > now + timedelta(days=7), 'Medium-term (7-30 days)'),
-            (Subscription.end_date > now, 'Short-term (1-7 days)'),
-            else_='Expired'
-        ).label('duration_category'),
-        func.count(Subscription.id).label('count')
-    ).group_by('duration_category').all()
-    
-    labels = [row.duration_category for row in data]
-    counts = [row.count for row in data]
+        Analytics.metric_date, func.sum(Analytics.metric_value).label('count')
+    ).filter(Analytics.metric_name == ROLLUP_ENDING).group_by(Analytics.metric_date).all()
+    
+    buckets = defaultdict(int)
+    for row in data:
+        buckets[duration_category(row.metric_date, today)] += int(row.count)
+    
+    labels = [label for label in sorted(buckets) if buckets[label] > 0]
+    counts = [buckets[label] for label in labels]
     
     return jsonify({'labels': labels, 'data': counts})
 
+@app.route('/api/analytics/bundle')
+@require_admin_json
+def api_analytics_bundle():
+    return jsonify(response_cache.get_or_set('analytics_bundle', build_analytics_bundle))
+
+@app.route('/api/cache/stats')
+@require_admin_json
+def api_cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.route('/api/ratelimit/stats')
+@require_admin_json
+def api_ratelimit_stats():
+    return jsonify(rate_limiter.stats())
+
+@app.route('/api/audit/stats')
+@require_admin_json
+def api_audit_stats():
+    return jsonify(audit_sink.stats())
+
+def plan_subscription_counts(counters=None):
+    """[(plan name, subscriptions)] from the per-plan counters, for plans that have any."""
+    counters = counter_values(COUNTER_PLAN) if counters is None else counters
+    totals = defaultdict(int)
+    for plan in plan_catalog().plans:
+        totals[plan.name] += counters.get(COUNTER_PLAN + str(plan.id), 0)
+    return sorted((name, count) for name, count in totals.items() if count > 0)
+
 @app.route('/api/plan_counts')
+@cache_response
 def api_plan_counts():
-    from sqlalchemy import func
-    data = db.session.query(Plan.name, func.count(Subscription.id)).join(Subscription, Subscription.plan_id==Plan.id).group_by(Plan.name).all()
+    data = plan_subscription_counts()
     labels = [r[0] for r in data]
     values = [r[1] for r in data]
     return jsonify({'labels': labels, 'values': values})
 
 # User Recommendations and Notifications
 @app.route('/user/recommendations')
+@require_user
 def user_recommendations():
-    user = current_user()
-    if not user or user.role != 'user':
-        return redirect(url_for('login'))
-    
-    from sqlalchemy import func
+    user = current_identity()
     
     # Get user's subscription history
-    user_subs = Subscription.query.filter_by(user_id=user.id).all()
+    user_subs = Subscription.query.options(joinedload(Subscription.plan)).filter_by(user_id=user.id).all()
     current_plan = None
     for sub in user_subs:
         if sub.status == 'active':
@@ -1034,7 +2660,7 @@ def user_recommendations():
             break
     
     # Get all available plans
-    all_plans = Plan.query.filter_by(active=True).all()
+    all_plans = plan_catalog().active
     
     # Simple recommendation logic based on current plan
     recommendations = []
@@ -1056,8 +2682,13 @@ def user_recommendations():
                         'savings': current_plan.price - plan.price
                     })
     else:
-        # No current subscription - recommend based on popularity
-        popular_plans = db.session.query(Plan, func.count(Subscription.id).label('count')).join(Subscription, Subscription.plan_id == Plan.id).group_by(Plan.id).order_by(func.count(Subscription.id).desc()).limit(3).all()
+        # No current subscription - recommend based on popularity (the per-plan counters)
+        counters = counter_values(COUNTER_PLAN)
+        popular_plans = sorted(
+            ((plan, counters.get(COUNTER_PLAN + str(plan.id), 0)) for plan in plan_catalog().plans),
+            key=lambda item: (-item[1], item[0].id)
+        )
+        popular_plans = [(plan, count) for plan, count in popular_plans if count > 0][:3]
         for plan, count in popular_plans:
             recommendations.append({
                 'plan': plan,
@@ -1069,10 +2700,9 @@ def user_recommendations():
     return render_template('user_recommendations.html', recommendations=recommendations, current_plan=current_plan)
 
 @app.route('/user/offers')
+@require_user
 def user_offers():
-    user = current_user()
-    if not user or user.role != 'user':
-        return redirect(url_for('login'))
+    user = current_identity()
     
     # Get active discounts
     active_discounts = Discount.query.filter(
@@ -1082,7 +2712,7 @@ def user_offers():
     ).all()
     
     # Get user's subscription history to personalize offers
-    user_subs = Subscription.query.filter_by(user_id=user.id).all()
+    user_subs = Subscription.query.options(joinedload(Subscription.plan)).filter_by(user_id=user.id).all()
     current_plan = None
     for sub in user_subs:
         if sub.status == 'active':
@@ -1092,14 +2722,251 @@ def user_offers():
     return render_template('user_offers.html', discounts=active_discounts, current_plan=current_plan)
 
 # ===== Chatbot API (additive, user-scoped) =====
-from flask import jsonify
+# Chatbot context
+# The plan/discount context sent to AI providers is built only when a reply
+# needs it, and memoized per user. Entries are tied to the 'plans' and
+# 'discounts' cache stamps. A user's entry is dropped when their subscriptions
+# change in this process; other processes refresh after CHAT_CONTEXT_TTL.
+ChatContext = namedtuple('ChatContext', ['current_plan', 'plans', 'discounts', 'text'])
+DiscountRecord = namedtuple('DiscountRecord', ['name', 'code', 'discount_type', 'discount_value'])
+
+def format_plan_line(plan):
+    quota = 'Unlimited' if (plan.quota_gb or 0) == 0 else f"{plan.quota_gb}GB"
+    return f"- {plan.name}: ₹{plan.price}/mo, {quota}"
+
+def format_discount_value(discount):
+    return f"{int(discount.discount_value)}%" if discount.discount_type == 'percentage' else f"₹{int(discount.discount_value)}"
+
+def build_chat_context(user_id):
+    """Collect the user's current plan, the active plans and the active discounts."""
+    now = datetime.utcnow()
+    catalog = plan_catalog()
+    current_plan_id = db.session.query(Subscription.plan_id).filter_by(
+        user_id=user_id, status='active'
+    ).order_by(Subscription.id).limit(1).scalar()
+    current_plan = catalog.get(current_plan_id) if current_plan_id else None
+    discounts = tuple(DiscountRecord(*row) for row in db.session.query(
+        Discount.name, Discount.code, Discount.discount_type, Discount.discount_value
+    ).filter(
+        Discount.active == True,
+        Discount.valid_from <= now,
+        Discount.valid_until >= now
+    ).order_by(Discount.id).all())
+
+    current_plan_text = format_plan_line(current_plan)[2:] if current_plan else "None"
+    plan_lines = [format_plan_line(p) for p in catalog.active]
+    discount_lines = [f"- {d.name} ({d.code}): {format_discount_value(d)}" for d in discounts] or ["- None"]
+    text = (
+        "Current Plan: " + current_plan_text + "\n" +
+        "Available Plans:\n" + "\n".join(plan_lines) + "\n" +
+        "Active Discounts:\n" + "\n".join(discount_lines)
+    )
+    return ChatContext(current_plan, catalog.active, discounts, text)
+
+class ChatContextCache:
+    """Size-capped LRU of per-user chatbot contexts."""
+
+    def __init__(self):
+        self._entries = OrderedDict()  # user_id -> (stamps, expires_at, context)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        versions = cache_versions()
+        stamps = (versions.get('plans', 0), versions.get('discounts', 0))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] == stamps and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                return entry[2]
+        context = build_chat_context(user_id)
+        with self._lock:
+            self._entries[user_id] = (stamps, now + app.config['CHAT_CONTEXT_TTL'], context)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > app.config['CHAT_CONTEXT_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+        return context
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+chat_contexts = ChatContextCache()
+
+# Chatbot provider calls
+# Calls to OpenAI/Gemini can take seconds, so they run on a bounded worker pool
+# instead of the request thread. api_chatbot_reply() returns a job id straight
+# away and the client polls /api/chatbot/jobs/<job_id>; the bot reply is
+# stored as a ChatMessage when the job finishes.
+CHAT_SYSTEM_PROMPT = (
+    "You are a helpful assistant for an internet subscription app. "
+    "Use the provided context to recommend 1–2 plans. "
+    "Be concise and actionable. If a discount applies, mention it."
+)
+
+def http_post_json(url, payload, headers, timeout):
+    """Default chatbot transport: POST a JSON payload and return the decoded JSON response."""
+    import urllib.request  # pulls in http.client and ssl; only needed once a provider is configured
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode('utf-8'),
+        headers=dict(headers, **{"Content-Type": "application/json"}),
+        method="POST",
+    )
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+def chat_provider_configured(provider):
+    return (provider == 'openai' and bool(os.getenv('OPENAI_API_KEY'))) or \
+        (provider == 'gemini' and bool(os.getenv('GOOGLE_API_KEY')))
+
+def call_chat_provider(provider, message, context_text, fallback):
+    """Ask the configured AI provider for a reply; returns fallback on any failure."""
+    transport = app.config.get('CHATBOT_TRANSPORT') or http_post_json
+    timeout = app.config['CHATBOT_PROVIDER_TIMEOUT']
+    user_prompt = (
+        "Context:\n" + context_text + "\n\n" +
+        "User question: " + message + "\n\n" +
+        "Return: 1–2 suggested plan(s) with price, brief reason, and any discount."
+    )
+    try:
+        if provider == 'openai':
+            base_url = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1').rstrip('/')
+            payload = {
+                "model": os.getenv('OPENAI_MODEL', 'gpt-4o-mini'),
+                "messages": [
+                    {"role": "system", "content": CHAT_SYSTEM_PROMPT},
+                    {"role": "user", "content": user_prompt},
+                ],
+                "temperature": 0.3,
+                "max_tokens": 250,
+            }
+            headers = {"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}"}
+            data_resp = transport(base_url + "/chat/completions", payload, headers, timeout)
+            return (
+                data_resp.get('choices', [{}])[0]
+                .get('message', {})
+                .get('content')
+            ) or fallback
+        if provider == 'gemini':
+            model = os.getenv('GEMINI_MODEL', 'gemini-1.5-flash')
+            url = (
+                f"https://generativelanguage.googleapis.com/v1beta/models/"
+                f"{model}:generateContent?key={os.getenv('GOOGLE_API_KEY')}"
+            )
+            payload = {
+                "contents": [
+                    {"parts": [{"text": CHAT_SYSTEM_PROMPT}]},
+                    {"parts": [{"text": user_prompt}]},
+                ]
+            }
+            data_resp = transport(url, payload, {}, timeout)
+            candidates = data_resp.get('candidates') or []
+            if candidates:
+                parts = candidates[0].get('content', {}).get('parts') or []
+                if parts and 'text' in parts[0]:
+                    return parts[0]['text'] or fallback
+    except Exception:
+        # On any failure, keep placeholder reply
+        pass
+    return fallback
+
+class ChatJobs:
+    """Registry of chatbot provider jobs running on a bounded thread pool.
+
+    The registry lives in the worker that took the request. The bot reply is
+    stored with its job id, and job ids carry the chat id and the submission
+    time, so a poll that lands on another worker can find the reply or, after
+    CHATBOT_JOB_TIMEOUT, report the job as failed.
+    """
+
+    RETAIN_SECONDS = 300  # how long finished jobs stay pollable
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=app.config['CHATBOT_WORKERS'], thread_name_prefix='chatbot'
+            )
+        return self._executor
+
+    def submit(self, user_id, chat_id, run):
+        """Queue run() and return a job id, or None when the pool is saturated."""
+        now = time.monotonic()
+        with self._lock:
+            for job_id in [j for j, job in self._jobs.items()
+                           if job['status'] != 'pending' and now - job['finished_at'] > self.RETAIN_SECONDS]:
+                del self._jobs[job_id]
+            pending = sum(1 for job in self._jobs.values() if job['status'] == 'pending')
+            if pending >= app.config['CHATBOT_MAX_PENDING']:
+                return None
+            job_id = f'{chat_id}.{datetime.utcnow():%Y%m%d%H%M%S%f}.{uuid.uuid4().hex}'
+            self._jobs[job_id] = {'user_id': user_id, 'chat_id': chat_id, 'status': 'pending', 'reply': None}
+            self._pool().submit(self._run, job_id, run)
+        return job_id
+
+    def _run(self, job_id, run):
+        status, reply = 'failed', None
+        try:
+            reply = run(job_id)
+            status = 'done'
+        except Exception:
+            app.logger.exception('Chatbot job %s failed', job_id)
+        finally:
+            with self._lock:
+                self._jobs[job_id].update(status=status, reply=reply, finished_at=time.monotonic())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+chat_jobs = ChatJobs()
+
+def submit_chat_job(user_id, chat_id, provider, message, context_text, fallback):
+    """Run the provider call in the background and persist the bot reply when it arrives."""
+    def run(job_id):
+        reply = call_chat_provider(provider, message, context_text, fallback)
+        with app.app_context():
+            db.session.add(ChatMessage(chat_id=chat_id, sender='bot', text=reply, job_id=job_id))
+            db.session.commit()
+        return reply
+    return chat_jobs.submit(user_id, chat_id, run)
+
+def persisted_chat_job(user_id, job_id):
+    """Rebuild a job submitted on another worker from its stored reply, or None.
+
+    A job with no reply is pending until CHATBOT_JOB_TIMEOUT after submission
+    and failed after that (its worker died or the reply could not be saved).
+    """
+    try:
+        chat_id, submitted, _ = job_id.split('.')
+        chat_id, submitted_at = int(chat_id), datetime.strptime(submitted, '%Y%m%d%H%M%S%f')
+    except ValueError:
+        return None
+    row = db.session.execute(
+        select(Chat.id, ChatMessage.text)
+        .outerjoin(ChatMessage, (ChatMessage.chat_id == Chat.id) & (ChatMessage.job_id == job_id))
+        .where(Chat.id == chat_id, Chat.user_id == user_id)
+    ).first()
+    if row is None:
+        return None
+    if row.text is not None:
+        return {'user_id': user_id, 'status': 'done', 'reply': row.text}
+    if datetime.utcnow() - submitted_at > timedelta(seconds=app.config['CHATBOT_JOB_TIMEOUT']):
+        return {'user_id': user_id, 'status': 'failed', 'reply': None}
+    return {'user_id': user_id, 'status': 'pending', 'reply': None}
+
 
 @app.route('/api/chats', methods=['GET'])
+@require_role('user', unauthorized=lambda: (jsonify([]), 200))
 def api_get_chats():
-    user = current_user()
-    if not user or user.role != 'user':
-        return jsonify([]), 200
-    chats = Chat.query.filter_by(user_id=user.id).order_by(Chat.created_at.asc()).all()
+    user = current_identity()
+    chats = Chat.query.filter_by(user_id=user.id).options(selectinload(Chat.messages)).order_by(Chat.created_at.asc()).all()
     result = []
     for c in chats:
         result.append({
@@ -1115,11 +2982,60 @@ def api_get_chats():
         })
     return jsonify(result), 200
 
+@app.route('/api/chats/sync', methods=['GET'])
+@require_user_json
+def api_sync_chats():
+    """Return chats and messages created after the client's cursor.
+
+    Query parameters: since (last message id seen), since_chat (last chat id
+    seen), optional chat_id to sync a single chat, and limit. Clients repeat
+    the call with the returned cursor while has_more is true.
+    """
+    user = current_identity()
+    since = request.args.get('since', 0, type=int)
+    since_chat = request.args.get('since_chat', 0, type=int)
+    limit = min(max(request.args.get('limit', 200, type=int), 1), 500)
+
+    chats = db.session.query(Chat.id, Chat.name).filter(Chat.user_id == user.id).order_by(Chat.id).all()
+    chat_ids = [c.id for c in chats]
+    only_chat = request.args.get('chat_id', type=int)
+    if only_chat is not None:
+        if only_chat not in chat_ids:
+            return jsonify({'error': 'chat not found'}), 404
+        chat_ids = [only_chat]
+
+    # Served from ix_chat_message_chat_id_id: one index range per chat
+    messages = []
+    if chat_ids:
+        messages = ChatMessage.query.filter(
+            ChatMessage.chat_id.in_(chat_ids), ChatMessage.id > since
+        ).order_by(ChatMessage.id).limit(limit + 1).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    new_chats = [c for c in chats if c.id > since_chat]
+
+    return jsonify({
+        'chats': [{'chat_id': c.id, 'name': c.name} for c in new_chats],
+        'messages': [
+            {
+                'id': m.id,
+                'chat_id': m.chat_id,
+                'sender': m.sender,
+                'text': m.text,
+                'timestamp': m.timestamp.isoformat()
+            } for m in messages
+        ],
+        'cursor': {
+            'since': messages[-1].id if messages else since,
+            'since_chat': new_chats[-1].id if new_chats else since_chat,
+        },
+        'has_more': has_more,
+    }), 200
+
 @app.route('/api/chats', methods=['POST'])
+@require_user_json
 def api_create_chat():
-    user = current_user()
-    if not user or user.role != 'user':
-        return jsonify({'error': 'unauthorized'}), 401
+    user = current_identity()
     data = request.get_json(silent=True) or {}
     name = data.get('name') or f"Chat {datetime.utcnow().strftime('%H%M%S')}"
     chat = Chat(user_id=user.id, name=name)
@@ -1128,10 +3044,9 @@ def api_create_chat():
     return jsonify({'chat_id': chat.id, 'name': chat.name, 'messages': []}), 201
 
 @app.route('/api/chats/<int:chat_id>/message', methods=['POST'])
+@require_user_json
 def api_add_message(chat_id: int):
-    user = current_user()
-    if not user or user.role != 'user':
-        return jsonify({'error': 'unauthorized'}), 401
+    user = current_identity()
     chat = Chat.query.filter_by(id=chat_id, user_id=user.id).first()
     if not chat:
         return jsonify({'error': 'chat not found'}), 404
@@ -1145,11 +3060,14 @@ def api_add_message(chat_id: int):
     db.session.commit()
     return jsonify({'status': 'ok'}), 200
 
+# Intents of the rule-based replies, matched against the lowercased message
+GREETING_PATTERN = re.compile(r'\b(hi|hello|hey|hlo)\b')
+SUGGEST_PATTERN = re.compile(r'\b(suggest|recommend|plan|plans|subscription|offer|offers|upgrade|change plan)\b')
+
 @app.route('/api/chatbot', methods=['POST'])
+@require_role('user', unauthorized=lambda: (jsonify({'reply': 'unauthorized'}), 401))
 def api_chatbot_reply():
-    user = current_user()
-    if not user or user.role != 'user':
-        return jsonify({'reply': 'unauthorized'}), 401
+    user = current_identity()
     data = request.get_json(silent=True) or {}
     message = (data.get('message') or '').strip()
     chat_id = data.get('chat_id')
@@ -1159,59 +3077,27 @@ def api_chatbot_reply():
     if not chat:
         return jsonify({'reply': 'chat not found'}), 404
 
-    # Plan-aware context and simple intent handling (greetings and plan suggestions)
-    now = datetime.utcnow()
-    # Current plan
-    current_sub = next((s for s in Subscription.query.filter_by(user_id=user.id).all() if s.status == 'active'), None)
-    if current_sub:
-        cp_quota = 'Unlimited' if (current_sub.plan.quota_gb or 0) == 0 else f"{current_sub.plan.quota_gb}GB"
-        current_plan_text = f"{current_sub.plan.name}: ₹{current_sub.plan.price}/mo, {cp_quota}"
-    else:
-        current_plan_text = "None"
-    # Available plans
-    plans = Plan.query.filter_by(active=True).all()
-    plan_lines = []
-    for p in plans:
-        quota = 'Unlimited' if (p.quota_gb or 0) == 0 else f"{p.quota_gb}GB"
-        plan_lines.append(f"- {p.name}: ₹{p.price}/mo, {quota}")
-    # Active discounts
-    discounts = Discount.query.filter(
-        Discount.active == True,
-        Discount.valid_from <= now,
-        Discount.valid_until >= now
-    ).all()
-    discount_lines = []
-    for d in discounts:
-        val = f"{int(d.discount_value)}%" if d.discount_type == 'percentage' else f"₹{int(d.discount_value)}"
-        discount_lines.append(f"- {d.name} ({d.code}): {val}")
-    if not discount_lines:
-        discount_lines = ["- None"]
-
-    context_text = (
-        "Current Plan: " + current_plan_text + "\n" +
-        "Available Plans:\n" + "\n".join(plan_lines) + "\n" +
-        "Active Discounts:\n" + "\n".join(discount_lines)
-    )
-
-    import re
+    # Simple intent handling (greetings and plan suggestions). The plan-aware
+    # context is only looked up for replies that use it.
     lower_msg = message.lower()
     handled = False
     reply = None
 
     # Greeting intent: short greeting response
-    if re.search(r'\b(hi|hello|hey|hlo)\b', lower_msg) and len(lower_msg) <= 40:
+    if GREETING_PATTERN.search(lower_msg) and len(lower_msg) <= 40:
         reply = "Hello! How can I help you today? Ask me to suggest subscription plans."
         handled = True
 
     # Suggestion intent: return subscription plan suggestions without external AI
-    suggest_intent = re.search(r'\b(suggest|recommend|plan|plans|subscription|offer|offers|upgrade|change plan)\b', lower_msg)
+    suggest_intent = SUGGEST_PATTERN.search(lower_msg)
     if not handled and suggest_intent:
+        context = chat_contexts.get(user.id)
         # Build 1–2 concise suggestions from available plans
-        plans_sorted = sorted(plans, key=lambda p: p.price)
+        plans_sorted = sorted(context.plans, key=lambda p: p.price)
         suggestions = []
         # If user has a current plan, try to suggest an upgrade and a value option
-        if current_sub:
-            current_index = next((i for i, p in enumerate(plans_sorted) if p.id == current_sub.plan_id), None)
+        if context.current_plan:
+            current_index = next((i for i, p in enumerate(plans_sorted) if p.id == context.current_plan.id), None)
             next_plan = None
             if current_index is not None and current_index + 1 < len(plans_sorted):
                 next_plan = plans_sorted[current_index + 1]
@@ -1222,14 +3108,12 @@ def api_chatbot_reply():
             picks = plans_sorted[:2]
 
         for p in [pp for pp in picks if pp]:
-            quota = 'Unlimited' if (p.quota_gb or 0) == 0 else f"{p.quota_gb}GB"
-            suggestions.append(f"- {p.name}: ₹{p.price}/mo, {quota}")
+            suggestions.append(format_plan_line(p))
 
         discount_tip = ""
-        if discounts:
-            d = discounts[0]
-            val = f"{int(d.discount_value)}%" if d.discount_type == 'percentage' else f"₹{int(d.discount_value)}"
-            discount_tip = f"\nTip: {d.name} ({d.code}) — {val} off."
+        if context.discounts:
+            d = context.discounts[0]
+            discount_tip = f"\nTip: {d.name} ({d.code}) — {format_discount_value(d)} off."
 
         if suggestions:
             reply = "Here are my plan suggestions:\n" + "\n".join(suggestions) + discount_tip
@@ -1246,166 +3130,362 @@ def api_chatbot_reply():
             "- Use Account Settings to update your profile."
         )
 
-    if not handled:
-        try:
-            if provider == 'openai' and os.getenv('OPENAI_API_KEY'):
-                import json, urllib.request, urllib.error
-                api_key = os.getenv('OPENAI_API_KEY')
-                model = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
-                system = (
-                    "You are a helpful assistant for an internet subscription app. "
-                    "Use the provided context to recommend 1–2 plans. "
-                    "Be concise and actionable. If a discount applies, mention it."
-                )
-                user_prompt = (
-                    "Context:\n" + context_text + "\n\n" +
-                    "User question: " + message + "\n\n" +
-                    "Return: 1–2 suggested plan(s) with price, brief reason, and any discount."
-                )
-                payload = {
-                    "model": model,
-                    "messages": [
-                        {"role": "system", "content": system},
-                        {"role": "user", "content": user_prompt},
-                    ],
-                    "temperature": 0.3,
-                    "max_tokens": 250,
-                }
-                req = urllib.request.Request(
-                    "https://api.openai.com/v1/chat/completions",
-                    data=json.dumps(payload).encode('utf-8'),
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {api_key}",
-                    },
-                    method="POST",
-                )
-                with urllib.request.urlopen(req, timeout=10) as resp:
-                    data_resp = json.loads(resp.read().decode('utf-8'))
-                    reply = (
-                        data_resp.get('choices', [{}])[0]
-                        .get('message', {})
-                        .get('content')
-                    ) or reply
-            elif provider == 'gemini' and os.getenv('GOOGLE_API_KEY'):
-                import json, urllib.request, urllib.error
-                api_key = os.getenv('GOOGLE_API_KEY')
-                model = os.getenv('GEMINI_MODEL', 'gemini-1.5-flash')
-                system = (
-                    "You are a helpful assistant for an internet subscription app. "
-                    "Use the provided context to recommend 1–2 plans. "
-                    "Be concise and actionable. If a discount applies, mention it."
-                )
-                url = (
-                    f"https://generativelanguage.googleapis.com/v1beta/models/"
-                    f"{model}:generateContent?key={api_key}"
-                )
-                user_prompt = (
-                    "Context:\n" + context_text + "\n\n" +
-                    "User question: " + message + "\n\n" +
-                    "Return: 1–2 suggested plan(s) with price, brief reason, and any discount."
-                )
-                payload = {
-                    "contents": [
-                        {"parts": [{"text": system}]},
-                        {"parts": [{"text": user_prompt}]},
-                    ]
-                }
-                req = urllib.request.Request(
-                    url,
-                    data=json.dumps(payload).encode('utf-8'),
-                    headers={"Content-Type": "application/json"},
-                    method="POST",
-                )
-                with urllib.request.urlopen(req, timeout=10) as resp:
-                    data_resp = json.loads(resp.read().decode('utf-8'))
-                    candidates = data_resp.get('candidates') or []
-                    if candidates:
-                        parts = candidates[0].get('content', {}).get('parts') or []
-                        if parts and 'text' in parts[0]:
-                            reply = parts[0]['text'] or reply
-        except Exception:
-            # On any failure, keep placeholder reply
-            pass
-
-    # Save both user message (if not already saved by frontend) and bot reply
+    # Save user message (if not already saved by frontend)
     user_saved = data.get('user_saved', False)
     if not user_saved:
         db.session.add(ChatMessage(chat_id=chat.id, sender='user', text=message))
+
+    if not handled and chat_provider_configured(provider):
+        # Hand the provider call to the worker pool; the client polls for the reply.
+        # chat_id is read before the commit expires chat, which would reload it.
+        chat_id = chat.id
+        db.session.commit()
+        context_text = chat_contexts.get(user.id).text
+        job_id = submit_chat_job(user.id, chat_id, provider, message, context_text, reply)
+        if job_id is None:
+            db.session.add(ChatMessage(chat_id=chat_id, sender='bot', text=reply))
+            db.session.commit()
+            return jsonify({'reply': reply}), 200
+        return jsonify({'job_id': job_id, 'status': 'pending'}), 202
+
     db.session.add(ChatMessage(chat_id=chat.id, sender='bot', text=reply))
     db.session.commit()
 
     return jsonify({'reply': reply}), 200
 
-@app.route('/api/user/notifications')
-def user_notifications():
-    user = current_user()
-    if not user or user.role != 'user':
-        return jsonify({'notifications': []})
+@app.route('/api/chatbot/jobs/<job_id>', methods=['GET'])
+@require_user_json
+def api_chatbot_job(job_id):
+    user = current_identity()
+    job = chat_jobs.get(job_id) or persisted_chat_job(user.id, job_id)
+    if not job or job['user_id'] != user.id:
+        return jsonify({'error': 'job not found'}), 404
+    if job['status'] != 'done':
+        return jsonify({'job_id': job_id, 'status': job['status']}), 200
+    return jsonify({'job_id': job_id, 'status': 'done', 'reply': job['reply']}), 200
 
-    # Only show notifications within N seconds after login
-    SHOW_WINDOW_SECONDS = 10  # visible only for a few seconds
+# Notifications
+EXPIRY_NOTICE_DAYS = 7
+NOTIFICATION_KEY_PATTERN = re.compile(r'(expiry|discount):\d+')
+
+def expiry_notification(sub_id, plan_name, end_date, now):
+    return {
+        'key': f'expiry:{sub_id}',
+        'type': 'warning',
+        'title': 'Subscription Expiring Soon',
+        'message': f'Your {plan_name} subscription expires in {(end_date - now).days} days',
+        'action': 'renew',
+        'action_url': url_for('renew', sub_id=sub_id)
+    }
+
+def discount_notification(discount_id, name, code):
+    return {
+        'key': f'discount:{discount_id}',
+        'type': 'info',
+        'title': 'New Discount Available',
+        'message': f'{name}: {code}',
+        'action': 'view',
+        'action_url': url_for('user_offers')
+    }
+
+def within_notification_window():
+    """True while the session is inside the post-login notification window."""
     login_at_iso = session.get('login_at')
     if login_at_iso:
         try:
             login_at = datetime.fromisoformat(login_at_iso)
-            if (datetime.utcnow() - login_at).total_seconds() > SHOW_WINDOW_SECONDS:
-                return jsonify({'notifications': []})
+            if (datetime.utcnow() - login_at).total_seconds() > app.config['NOTIFICATION_WINDOW_SECONDS']:
+                return False
         except Exception:
             pass
+    return True
 
+def pending_notifications(user_id):
+    now = datetime.utcnow()
     notifications = []
 
     # Check for expiring subscriptions
-    expiring_subs = Subscription.query.filter(
-        Subscription.user_id == user.id,
-        Subscription.status == 'active',
-        Subscription.end_date <= datetime.utcnow() + timedelta(days=7)
+    expiring_subs = db.session.execute(
+        select(Subscription.id, Plan.name, Subscription.end_date)
+        .join(Plan, Plan.id == Subscription.plan_id)
+        .where(
+            Subscription.user_id == user_id,
+            Subscription.status == 'active',
+            Subscription.end_date <= now + timedelta(days=EXPIRY_NOTICE_DAYS)
+        )
     ).all()
-
-    for sub in expiring_subs:
-        days_left = (sub.end_date - datetime.utcnow()).days
-        notifications.append({
-            'type': 'warning',
-            'title': 'Subscription Expiring Soon',
-            'message': f'Your {sub.plan.name} subscription expires in {days_left} days',
-            'action': 'renew',
-            'action_url': url_for('renew', sub_id=sub.id)
-        })
+    for sub_id, plan_name, end_date in expiring_subs:
+        notifications.append(expiry_notification(sub_id, plan_name, end_date, now))
 
     # Check for new discounts
-    new_discounts = Discount.query.filter(
-        Discount.active == True,
-        Discount.valid_from >= datetime.utcnow() - timedelta(days=1),
-        Discount.valid_until >= datetime.utcnow()
+    new_discounts = db.session.execute(
+        select(Discount.id, Discount.name, Discount.code).where(
+            Discount.active == True,
+            Discount.valid_from >= now - timedelta(days=1),
+            Discount.valid_until >= now
+        )
     ).all()
+    for discount_id, name, code in new_discounts:
+        notifications.append(discount_notification(discount_id, name, code))
 
-    for discount in new_discounts:
-        notifications.append({
-            'type': 'info',
-            'title': 'New Discount Available',
-            'message': f'{discount.name}: {discount.code}',
-            'action': 'view',
-            'action_url': url_for('user_offers')
-        })
+    return notifications
+
+class NotificationHub:
+    """In-process fan-out of notification events to open dashboard streams.
+
+    Events are small dicts with a 'key' (e.g. 'discount:3') and either the raw
+    fields needed to render a notification or 'retract': True. Every stream
+    remembers the keys it has delivered so a notification is pushed once.
+    A single scanner thread per worker looks for expiring subscriptions of
+    the connected users, so the database sees one query per scan interval
+    instead of one per dashboard per poll. The same thread watches the
+    'discounts' cache stamp and, when any worker bumps it, diffs the
+    available discounts against its last snapshot, so discount changes reach
+    the streams of every worker. The first snapshot is taken by prime()
+    before the worker's first stream subscribes, so no change goes unseen.
+
+    Every open stream holds a request thread, so a worker takes at most
+    NOTIFICATION_MAX_STREAMS of them and NOTIFICATION_STREAMS_PER_USER per
+    user. A user's oldest stream is evicted to make room for a new one.
+    """
+
+    def __init__(self):
+        self._streams = defaultdict(list)  # user_id -> [Stream], oldest first
+        self._lock = threading.Lock()
+        self._scanner = None
+        self._discounts_lock = threading.Lock()
+        self._discounts_version = None
+        self._discounts = None  # {discount_id: (name, code)} at _discounts_version
+        self.published = 0
+
+    class Stream:
+        def __init__(self, user_id, seen):
+            self.user_id = user_id
+            self.seen = set(seen)
+            self.events = queue.Queue()
+
+    def subscribe(self, user_id, seen=()):
+        """Register a stream, or return None when this worker has no room for it."""
+        stream = self.Stream(user_id, seen)
+        with self._lock:
+            streams = self._streams.get(user_id, [])
+            evicted = streams[:max(0, len(streams) + 1 - app.config['NOTIFICATION_STREAMS_PER_USER'])]
+            open_streams = sum(len(s) for s in self._streams.values()) - len(evicted)
+            if open_streams >= app.config['NOTIFICATION_MAX_STREAMS'] or app.config['NOTIFICATION_STREAMS_PER_USER'] < 1:
+                return None
+            self._streams[user_id] = streams[len(evicted):] + [stream]
+            if self._scanner is None:
+                self._scanner = threading.Thread(target=self._scan_loop, name='notification-scanner', daemon=True)
+                self._scanner.start()
+        for old in evicted:
+            old.events.put({'evicted': True})
+        return stream
+
+    def unsubscribe(self, stream):
+        with self._lock:
+            streams = self._streams.get(stream.user_id)
+            if streams is not None and stream in streams:
+                streams.remove(stream)
+                if not streams:
+                    del self._streams[stream.user_id]
+
+    def close(self):
+        """End every open stream; the browsers reconnect, e.g. to another worker."""
+        with self._lock:
+            targets = [s for streams in self._streams.values() for s in streams]
+            self._streams.clear()
+        for stream in targets:
+            stream.events.put(None)
+
+    def connected_users(self):
+        with self._lock:
+            return list(self._streams)
+
+    def connections(self):
+        with self._lock:
+            return sum(len(streams) for streams in self._streams.values())
+
+    def publish(self, event, user_id=None):
+        """Deliver event to one user's streams, or to everyone when user_id is None."""
+        with self._lock:
+            if user_id is None:
+                targets = [s for streams in self._streams.values() for s in streams]
+            else:
+                targets = list(self._streams.get(user_id, ()))
+        for stream in targets:
+            if event.get('retract'):
+                if event['key'] not in stream.seen:
+                    continue
+                stream.seen.discard(event['key'])
+            elif event['key'] in stream.seen:
+                continue
+            else:
+                stream.seen.add(event['key'])
+            stream.events.put(event)
+            self.published += 1
+
+    def _scan_loop(self):
+        next_scan = time.monotonic() + app.config['NOTIFICATION_SCAN_INTERVAL']
+        while True:
+            time.sleep(app.config['NOTIFICATION_FANOUT_INTERVAL'])
+            user_ids = self.connected_users()
+            if not user_ids:
+                continue
+            try:
+                with app.app_context():
+                    self._check_discounts()
+                    if time.monotonic() >= next_scan:
+                        next_scan = time.monotonic() + app.config['NOTIFICATION_SCAN_INTERVAL']
+                        self._scan_expiring(user_ids)
+            except SQLAlchemyError:
+                app.logger.exception('Notification scan failed')
+
+    def prime(self):
+        """Take the first discount snapshot; call before subscribing, in an app context."""
+        if self._discounts is None:
+            self._check_discounts()
+
+    def _check_discounts(self):
+        with self._discounts_lock:
+            self._diff_discounts()
+
+    def _diff_discounts(self):
+        version = cache_versions().get('discounts')
+        if version == self._discounts_version:
+            return
+        now = datetime.utcnow()
+        available = {
+            discount_id: (name, code)
+            for discount_id, name, code in db.session.execute(
+                select(Discount.id, Discount.name, Discount.code)
+                .where(Discount.active == True, Discount.valid_until >= now)
+            )
+        }
+        previous, self._discounts, self._discounts_version = self._discounts, available, version
+        if previous is None:
+            return  # first look: only later changes are news
+        for discount_id, (name, code) in available.items():
+            if previous.get(discount_id) != (name, code):
+                self.publish({'key': f'discount:{discount_id}', 'kind': 'discount', 'discount_id': discount_id,
+                              'name': name, 'code': code})
+        for discount_id in previous.keys() - available.keys():
+            self.publish({'key': f'discount:{discount_id}', 'retract': True})
+
+    def _scan_expiring(self, user_ids):
+        rows = db.session.execute(
+            select(Subscription.user_id, Subscription.id, Plan.name, Subscription.end_date)
+            .join(Plan, Plan.id == Subscription.plan_id)
+            .where(
+                Subscription.user_id.in_(user_ids),
+                Subscription.status == 'active',
+                Subscription.end_date <= datetime.utcnow() + timedelta(days=EXPIRY_NOTICE_DAYS)
+            )
+        ).all()
+        for user_id, sub_id, plan_name, end_date in rows:
+            self.publish({'key': f'expiry:{sub_id}', 'kind': 'expiry', 'sub_id': sub_id,
+                          'plan_name': plan_name, 'end_date': end_date}, user_id=user_id)
+
+notification_hub = NotificationHub()
+
+def render_notification_event(event):
+    if event.get('retract'):
+        return f"event: retract\ndata: {json.dumps({'key': event['key']})}\n\n"
+    if event['kind'] == 'expiry':
+        notification = expiry_notification(event['sub_id'], event['plan_name'], event['end_date'], datetime.utcnow())
+    else:
+        notification = discount_notification(event['discount_id'], event['name'], event['code'])
+    return f"event: notification\ndata: {json.dumps(notification)}\n\n"
+
+def shown_notification_keys(last_event_id):
+    """Keys a reconnecting browser already shows, from the Last-Event-ID it echoes back."""
+    keys = [key for key in last_event_id.split(',') if NOTIFICATION_KEY_PATTERN.fullmatch(key)]
+    return keys[:200]
+
+@app.route('/api/user/notifications')
+@require_role('user', unauthorized=lambda: jsonify({'notifications': []}))
+def user_notifications():
+    user = current_identity()
 
-    return jsonify({'notifications': notifications})
+    # Only show notifications within N seconds after login
+    if not within_notification_window():
+        return jsonify({'notifications': []})
+
+    return jsonify({'notifications': pending_notifications(user.id)})
+
+@app.route('/api/user/notifications/stream')
+@require_user_json
+def user_notification_stream():
+    """Server-Sent Events stream of the user's notifications.
+
+    Sends the current notifications once (inside the post-login window, like
+    the JSON endpoint), then only what NotificationHub publishes. The DB
+    session is released before streaming, so an idle stream holds no
+    connection. Streams end after NOTIFICATION_STREAM_TIMEOUT and the browser
+    reconnects on its own. Every event's id lists the keys the page shows, and
+    the browser sends the last one back as Last-Event-ID when it reconnects,
+    so the new stream does not repeat them. A worker without room for another
+    stream answers 503, and an evicted stream gets an 'evicted' event; the
+    dashboard polls in both cases.
+    """
+    user = current_identity()
+
+    shown = set(shown_notification_keys(request.headers.get('Last-Event-ID', '')))
+    initial = [n for n in (pending_notifications(user.id) if within_notification_window() else [])
+               if n['key'] not in shown]
+    shown.update(n['key'] for n in initial)
+    notification_hub.prime()
+    stream = notification_hub.subscribe(user.id, seen=shown)
+    db.session.close()
+    if stream is None:
+        response = jsonify({'error': 'Too many notification streams, poll instead'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(app.config['NOTIFICATION_STREAM_TIMEOUT'])
+        return response
+
+    def event_id():
+        return f"id: {','.join(sorted(shown))}\n"
+
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            for notification in initial:
+                yield event_id() + f"event: notification\ndata: {json.dumps(notification)}\n\n"
+            deadline = time.monotonic() + app.config['NOTIFICATION_STREAM_TIMEOUT']
+            while time.monotonic() < deadline:
+                try:
+                    event = stream.events.get(timeout=app.config['NOTIFICATION_HEARTBEAT'])
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if event is None:
+                    return
+                if event.get('evicted'):
+                    yield 'event: evicted\ndata: {}\n\n'
+                    return
+                if event.get('retract'):
+                    shown.discard(event['key'])
+                else:
+                    shown.add(event['key'])
+                yield event_id() + render_notification_event(event)
+        finally:
+            notification_hub.unsubscribe(stream)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # Payment Methods Management
 @app.route('/user/payment-methods')
+@require_user
 def user_payment_methods():
-    user = current_user()
-    if not user or user.role != 'user':
-        return redirect(url_for('login'))
+    user = current_identity()
     
     payment_methods = PaymentMethod.query.filter_by(user_id=user.id, is_active=True).all()
     return render_template('user_payment_methods.html', payment_methods=payment_methods)
 
 @app.route('/user/payment-methods/add', methods=['GET', 'POST'])
+@require_user
 def add_payment_method():
-    user = current_user()
-    if not user or user.role != 'user':
-        return redirect(url_for('login'))
+    user = current_identity()
     
     if request.method == 'POST':
         card_type = request.form['card_type']
@@ -1439,7 +3519,7 @@ def add_payment_method():
         )
         
         db.session.add(payment_method)
-        db.session.add(AuditLog(actor=user.username, action=f"Added {card_type} payment method ending in {last_four_digits}"))
+        audit(user.username, f"Added {card_type} payment method ending in {last_four_digits}")
         db.session.commit()
         
         flash('Payment method added successfully', 'success')
@@ -1448,10 +3528,9 @@ def add_payment_method():
     return render_template('add_payment_method.html')
 
 @app.route('/user/payment-methods/<int:payment_id>/set-default', methods=['POST'])
+@require_user
 def set_default_payment_method(payment_id):
-    user = current_user()
-    if not user or user.role != 'user':
-        return redirect(url_for('login'))
+    user = current_identity()
     
     payment_method = PaymentMethod.query.filter_by(id=payment_id, user_id=user.id).first_or_404()
     
@@ -1460,23 +3539,22 @@ def set_default_payment_method(payment_id):
     
     # Set this as default
     payment_method.is_default = True
-    db.session.add(AuditLog(actor=user.username, action=f"Set {payment_method.card_type} ending in {payment_method.last_four_digits} as default payment method"))
+    audit(user.username, f"Set {payment_method.card_type} ending in {payment_method.last_four_digits} as default payment method")
     db.session.commit()
     
     flash('Default payment method updated', 'success')
     return redirect(url_for('user_payment_methods'))
 
 @app.route('/user/payment-methods/<int:payment_id>/delete', methods=['POST'])
+@require_user
 def delete_payment_method(payment_id):
-    user = current_user()
-    if not user or user.role != 'user':
-        return redirect(url_for('login'))
+    user = current_identity()
     
     payment_method = PaymentMethod.query.filter_by(id=payment_id, user_id=user.id).first_or_404()
     
     # Soft delete
     payment_method.is_active = False
-    db.session.add(AuditLog(actor=user.username, action=f"Deleted {payment_method.card_type} payment method ending in {payment_method.last_four_digits}"))
+    audit(user.username, f"Deleted {payment_method.card_type} payment method ending in {payment_method.last_four_digits}")
     db.session.commit()
     
     flash('Payment method deleted', 'info')
@@ -1484,27 +3562,312 @@ def delete_payment_method(payment_id):
 
 # Billing History
 @app.route('/user/billing-history')
+@require_user
 def user_billing_history():
-    user = current_user()
-    if not user or user.role != 'user':
-        return redirect(url_for('login'))
-    
-    billing_records = BillingHistory.query.filter_by(user_id=user.id).order_by(BillingHistory.payment_date.desc()).all()
-    return render_template('user_billing_history.html', billing_records=billing_records)
+    user = current_identity()
+    page_size = app.config['BILLING_PAGE_SIZE']
+
+    # Keyset pagination, newest first: ?before=<payment_date>&before_id=<id>
+    # continues after the last invoice of the previous page.
+    query = BillingHistory.query.options(
+        joinedload(BillingHistory.subscription).joinedload(Subscription.plan),
+        joinedload(BillingHistory.payment_method),
+    ).filter_by(user_id=user.id)
+    before = request.args.get('before')
+    before_id = request.args.get('before_id', type=int)
+    if before and before_id:
+        try:
+            before_date = datetime.fromisoformat(before)
+        except ValueError:
+            abort(400)
+        query = query.filter(tuple_(BillingHistory.payment_date, BillingHistory.id) < (before_date, before_id))
+    rows = query.order_by(BillingHistory.payment_date.desc(), BillingHistory.id.desc()).limit(page_size + 1).all()
+
+    billing_records = rows[:page_size]
+    next_page = None
+    if len(rows) > page_size:
+        last = billing_records[-1]
+        next_page = url_for('user_billing_history', before=last.payment_date.isoformat(), before_id=last.id)
+    return render_template('user_billing_history.html', billing_records=billing_records,
+                           next_page=next_page, first_page=bool(before and before_id))
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+def stream_export(statement, fmt, stats=None):
+    """Yield a SELECT's rows as CSV or NDJSON text, EXPORT_CHUNK_ROWS at a time.
+
+    Rows come from a server-side cursor (yield_per), so memory use does not
+    depend on the size of the result. stats['rows'] counts the rows written.
+    """
+    chunk_rows = app.config['EXPORT_CHUNK_ROWS']
+    result = db.session.execute(statement.execution_options(yield_per=chunk_rows))
+    columns = list(result.keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+    for partition in result.partitions():
+        if stats is not None:
+            stats['rows'] = stats.get('rows', 0) + len(partition)
+        for row in partition:
+            if writer:
+                writer.writerow(row)
+            else:
+                record = {c: (v.isoformat() if isinstance(v, datetime) else v) for c, v in zip(columns, row)}
+                buffer.write(json.dumps(record) + '\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+    result.close()
+
+def gzip_chunks(chunks):
+    """Compress a stream of text chunks into a single gzip member, chunk by chunk."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_response(statement, fmt, filename, compress=False):
+    """Stream statement as an attachment in one of EXPORT_FORMATS, optionally gzipped."""
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    chunks = stream_export(statement, fmt)
+    if compress:
+        chunks = gzip_chunks(chunks)
+        mimetype, extension = 'application/gzip', extension + '.gz'
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}.{extension}'},
+    )
+
+@app.route('/user/billing-history/export')
+@require_user
+def export_billing_history():
+    user = current_identity()
+    statement = (
+        select(
+            BillingHistory.invoice_number,
+            BillingHistory.payment_date,
+            BillingHistory.description,
+            Plan.name.label('plan'),
+            BillingHistory.amount,
+            BillingHistory.status,
+            PaymentMethod.card_type,
+            PaymentMethod.last_four_digits,
+        )
+        .outerjoin(Subscription, Subscription.id == BillingHistory.subscription_id)
+        .outerjoin(Plan, Plan.id == Subscription.plan_id)
+        .outerjoin(PaymentMethod, PaymentMethod.id == BillingHistory.payment_method_id)
+        .where(BillingHistory.user_id == user.id)
+        .order_by(BillingHistory.payment_date.desc(), BillingHistory.id.desc())
+    )
+    return export_response(statement, request.args.get('format', 'csv'), 'billing-history')
+
+# Admin bulk exports
+# Whole tables, streamed in primary key order as gzipped CSV or NDJSON.
+# Each entry names the column the from/to date range applies to.
+ADMIN_EXPORTS = {
+    'subscriptions': (Subscription, Subscription.start_date),
+    'billing': (BillingHistory, BillingHistory.payment_date),
+    'discount_usage': (DiscountUsage, DiscountUsage.used_at),
+    'audit_log': (AuditLog, AuditLog.timestamp),
+}
+
+def admin_export_statement(name, date_from=None, date_to=None):
+    """SELECT for an ADMIN_EXPORTS table; date_to is inclusive."""
+    model, date_column = ADMIN_EXPORTS[name]
+    statement = select(model.__table__).order_by(model.id)
+    if date_from:
+        statement = statement.where(date_column >= date_from)
+    if date_to:
+        statement = statement.where(date_column < date_to + timedelta(days=1))
+    return statement
+
+def parse_export_date(value):
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+@app.route('/admin/export/<name>')
+@require_admin
+def admin_export(name):
+    """Download ?format=csv|ndjson, optionally limited by ?from=YYYY-MM-DD&to=YYYY-MM-DD."""
+    user = current_identity()
+    if name not in ADMIN_EXPORTS:
+        abort(404)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+    try:
+        date_from = parse_export_date(request.args.get('from'))
+        date_to = parse_export_date(request.args.get('to'))
+    except ValueError:
+        abort(400)
+    statement = admin_export_statement(name, date_from, date_to)
+    audit(user.username, f"Exported {name} as {fmt}")
+    db.session.commit()
+    return export_response(statement, fmt, name, compress=True)
+
+@app.cli.command('export')
+@click.argument('name', type=click.Choice(sorted(ADMIN_EXPORTS)))
+@click.option('--format', 'fmt', type=click.Choice(sorted(EXPORT_FORMATS)), default='csv')
+@click.option('--from', 'date_from', type=click.DateTime(['%Y-%m-%d']), default=None)
+@click.option('--to', 'date_to', type=click.DateTime(['%Y-%m-%d']), default=None)
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default=None,
+              help='Defaults to <name>.<format>.gz in the current directory.')
+def export_command(name, fmt, date_from, date_to, output):
+    """Write a table as gzip-compressed CSV or NDJSON."""
+    output = output or f'{name}.{fmt}.gz'
+    stats = {}
+    started = time.perf_counter()
+    with open(output, 'wb') as f:
+        for data in gzip_chunks(stream_export(admin_export_statement(name, date_from, date_to), fmt, stats)):
+            f.write(data)
+    elapsed = time.perf_counter() - started
+    rows = stats.get('rows', 0)
+    click.echo(f'Exported {rows} {name} rows to {output} in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/sec).')
+
+# Audit log retention
+# Rows older than AUDIT_RETENTION_DAYS move to one gzip NDJSON file per month
+# in AUDIT_ARCHIVE_DIR, AUDIT_ARCHIVE_CHUNK rows at a time: a chunk is
+# appended (as its own gzip member) and fsynced before its rows are deleted.
+# A crash between the two re-archives that chunk on the next run, so
+# search_audit_log() drops duplicate ids.
+def audit_archive_path(month):
+    return os.path.join(app.config['AUDIT_ARCHIVE_DIR'], f'audit-{month}.ndjson.gz')
+
+def archive_audit_log(older_than_days=None, chunk_size=None):
+    """Move audit rows older than the retention window to the monthly archives; return {month: rows}."""
+    days = app.config['AUDIT_RETENTION_DAYS'] if older_than_days is None else older_than_days
+    chunk_size = chunk_size or app.config['AUDIT_ARCHIVE_CHUNK']
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    os.makedirs(app.config['AUDIT_ARCHIVE_DIR'], exist_ok=True)
+    archived = defaultdict(int)
+    while True:
+        rows = db.session.execute(
+            select(AuditLog.id, AuditLog.actor, AuditLog.action, AuditLog.timestamp)
+            .where(AuditLog.timestamp < cutoff)
+            .order_by(AuditLog.timestamp, AuditLog.id).limit(chunk_size)
+        ).all()
+        if not rows:
+            break
+        by_month = defaultdict(list)
+        for row in rows:
+            by_month[f'{row.timestamp:%Y-%m}'].append(json.dumps({
+                'id': row.id, 'actor': row.actor, 'action': row.action, 'timestamp': row.timestamp.isoformat(),
+            }))
+        for month, lines in by_month.items():
+            with open(audit_archive_path(month), 'ab') as f:
+                f.write(zlib.compress(('\n'.join(lines) + '\n').encode(), wbits=31))
+                f.flush()
+                os.fsync(f.fileno())
+            archived[month] += len(lines)
+        db.session.execute(delete(AuditLog).where(AuditLog.id.in_([row.id for row in rows])))
+        db.session.commit()
+    return dict(archived)
+
+def read_audit_archive(month):
+    """Yield the archived entries of a month (a YYYY-MM string) in archive order."""
+    path = audit_archive_path(month)
+    if not os.path.exists(path):
+        return
+    import gzip  # only the archive reader needs the file wrapper
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+def archived_months():
+    names = os.listdir(app.config['AUDIT_ARCHIVE_DIR']) if os.path.isdir(app.config['AUDIT_ARCHIVE_DIR']) else []
+    return sorted(name[len('audit-'):-len('.ndjson.gz')] for name in names
+                  if name.startswith('audit-') and name.endswith('.ndjson.gz'))
+
+def search_audit_log(text=None, actor=None, date_from=None, date_to=None, limit=100):
+    """Newest-first matches from the live table, then from the archives, up to limit entries.
+
+    Only archives whose month overlaps [date_from, date_to) are opened, and
+    the search stops at the first month that fills the limit.
+    """
+    query = select(AuditLog.id, AuditLog.actor, AuditLog.action, AuditLog.timestamp)
+    if text:
+        query = query.where(AuditLog.action.contains(text))
+    if actor:
+        query = query.where(AuditLog.actor == actor)
+    if date_from:
+        query = query.where(AuditLog.timestamp >= date_from)
+    if date_to:
+        query = query.where(AuditLog.timestamp < date_to)
+    results = [
+        {'id': row.id, 'actor': row.actor, 'action': row.action, 'timestamp': row.timestamp.isoformat(), 'archived': False}
+        for row in db.session.execute(query.order_by(AuditLog.timestamp.desc(), AuditLog.id.desc()).limit(limit))
+    ]
+    first_month = f'{date_from:%Y-%m}' if date_from else None
+    last_month = f'{date_to - timedelta(microseconds=1):%Y-%m}' if date_to else None
+    seen = {entry['id'] for entry in results}
+    for month in reversed(archived_months()):
+        if len(results) >= limit or (first_month and month < first_month):
+            break
+        if last_month and month > last_month:
+            continue
+        matches = []
+        for entry in read_audit_archive(month):
+            timestamp = datetime.fromisoformat(entry['timestamp'])
+            if (entry['id'] in seen or (text and text not in (entry['action'] or ''))
+                    or (actor and entry['actor'] != actor) or (date_from and timestamp < date_from)
+                    or (date_to and timestamp >= date_to)):
+                continue
+            seen.add(entry['id'])
+            matches.append(dict(entry, archived=True))
+        matches.sort(key=lambda entry: (entry['timestamp'], entry['id']), reverse=True)
+        results.extend(matches[:limit - len(results)])
+    return results
+
+@app.route('/admin/audit/search')
+@require_admin_json
+def admin_audit_search():
+    """?q=text&actor=name&from=YYYY-MM-DD&to=YYYY-MM-DD&limit=N over the live log and its archives."""
+    try:
+        date_from = parse_export_date(request.args.get('from'))
+        date_to = parse_export_date(request.args.get('to'))
+        limit = min(int(request.args.get('limit', 100)), 1000)
+    except ValueError:
+        return jsonify({'error': 'from/to must be YYYY-MM-DD and limit a number'}), 400
+    entries = search_audit_log(request.args.get('q') or None, request.args.get('actor') or None,
+                               date_from, date_to + timedelta(days=1) if date_to else None, limit)
+    return jsonify({'entries': entries, 'count': len(entries)})
+
+@app.cli.command('archive-audit')
+@click.option('--days', type=int, default=None, help='Archive rows older than this (default: AUDIT_RETENTION_DAYS).')
+@click.option('--chunk-size', type=int, default=None, help='Rows per archive-and-delete transaction.')
+def archive_audit_command(days, chunk_size):
+    """Move old audit log rows to compressed monthly archive files."""
+    started = time.perf_counter()
+    archived = archive_audit_log(days, chunk_size)
+    elapsed = time.perf_counter() - started
+    for month, rows in sorted(archived.items()):
+        click.echo(f'{month}: {rows} rows -> {audit_archive_path(month)}')
+    total = sum(archived.values())
+    click.echo(f'Archived {total} audit rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/sec).')
 
 # Account Settings
 @app.route('/user/account-settings')
+@require_user
 def user_account_settings():
-    user = current_user()
-    if not user or user.role != 'user':
-        return redirect(url_for('login'))
+    user = current_identity()
     
     return render_template('user_account_settings.html', user=user)
 
 @app.route('/user/account-settings/update', methods=['POST'])
+@require_user
 def update_account_settings():
     user = current_user()
-    if not user or user.role != 'user':
+    if not user:
         return redirect(url_for('login'))
     
     new_username = request.form.get('username', user.username)
@@ -1519,16 +3882,249 @@ def update_account_settings():
     if new_password:
         user.password = new_password
     
-    db.session.add(AuditLog(actor=user.username, action="Updated account settings"))
+    audit(user.username, "Updated account settings")
     db.session.commit()
+    identities.put(user.id, Identity(user.id, user.username, user.role))
+    remember_identity(user)
     
     flash('Account settings updated successfully', 'success')
     return redirect(url_for('user_account_settings'))
 
+# Subscription lifecycle
+# Active subscriptions whose end_date has passed are renewed for another
+# period, billed to the user's default payment method, or expired when there
+# is no usable payment method or the plan was deactivated. run_lifecycle()
+# handles them LIFECYCLE_CHUNK_SIZE at a time, one transaction per chunk, so
+# a crash loses at most the chunk in flight. Processed rows drop out of the
+# due set, and the next run resumes the unfinished LifecycleRun with the same
+# cut-off.
+RENEWAL_PERIOD = timedelta(days=30)
+
+def process_lifecycle_chunk(run, chunk_size):
+    """Renew or expire up to chunk_size due subscriptions and commit. Returns how many were due."""
+    rows = db.session.execute(
+        select(Subscription.id, Subscription.user_id, Subscription.plan_id, Subscription.start_date,
+               Subscription.end_date, Plan.name, Plan.price, Plan.active)
+        .join(Plan, Plan.id == Subscription.plan_id)
+        .where(Subscription.status == 'active', Subscription.end_date <= run.as_of)
+        .order_by(Subscription.end_date, Subscription.id)
+        .limit(chunk_size)
+    ).all()
+    if not rows:
+        return 0
+
+    user_ids = {row.user_id for row in rows}
+    payment_methods = dict(db.session.execute(
+        select(PaymentMethod.user_id, func.min(PaymentMethod.id))
+        .where(PaymentMethod.user_id.in_(user_ids), PaymentMethod.is_default == True, PaymentMethod.is_active == True)
+        .group_by(PaymentMethod.user_id)
+    ).all())
+
+    now = datetime.utcnow()
+    renewals, invoices, expired_ids = [], [], []
+    removed, added = [], []
+    for row in rows:
+        payment_method_id = payment_methods.get(row.user_id)
+        if payment_method_id and row.active:
+            # Continue the billing period; restart it from the cut-off if it lapsed long ago
+            new_end = row.end_date + RENEWAL_PERIOD
+            if new_end <= run.as_of:
+                new_end = run.as_of + RENEWAL_PERIOD
+            renewals.append({'sub_id': row.id, 'new_end': new_end})
+            invoices.append({
+                'user_id': row.user_id,
+                'subscription_id': row.id,
+                'amount': row.price,
+                'payment_method_id': payment_method_id,
+                'status': 'paid',
+                'payment_date': now,
+                'invoice_number': f'INV-R{row.id}-{row.end_date:%Y%m%d}',
+                'description': f'{row.name} renewal',
+            })
+            removed.append((ROLLUP_ENDING, row.end_date.date(), row.plan_id))
+            added.append((ROLLUP_ENDING, new_end.date(), row.plan_id))
+        else:
+            expired_ids.append(row.id)
+            start = (row.start_date or now).date()
+            removed.append((ROLLUP_STARTED + 'active', start, row.plan_id))
+            added.append((ROLLUP_STARTED + 'expired', start, row.plan_id))
+
+    # Per-id executemany: with "id IN (...) AND status = 'active'" SQLite picks
+    # the (status, end_date) index and scans every active subscription.
+    subscriptions = Subscription.__table__
+    still_active = (subscriptions.c.id == bindparam('sub_id')) & (subscriptions.c.status == 'active')
+    updated = 0
+    if renewals:
+        updated += db.session.execute(
+            update(subscriptions).where(still_active).values(end_date=bindparam('new_end')), renewals
+        ).rowcount
+        db.session.execute(insert(BillingHistory.__table__), invoices)
+    if expired_ids:
+        updated += db.session.execute(
+            update(subscriptions).where(still_active).values(status='expired'),
+            [{'sub_id': sub_id} for sub_id in expired_ids],
+        ).rowcount
+    if updated != len(rows):
+        # A subscription changed under us (e.g. cancelled); redo the chunk from fresh rows
+        db.session.rollback()
+        return len(rows)
+
+    apply_rollup(removed=removed, added=added)
+    run.chunks += 1
+    run.renewed += len(renewals)
+    run.expired += len(expired_ids)
+    db.session.commit()
+    for user_id in user_ids:
+        chat_contexts.invalidate(user_id)
+    return len(rows)
+
+def run_lifecycle(as_of=None, chunk_size=None, max_chunks=None):
+    """Sweep due subscriptions, resuming an unfinished run if there is one.
+
+    Returns (run, processed) where processed counts the subscriptions handled
+    by this call. With max_chunks the sweep stops early and stays unfinished.
+    """
+    chunk_size = chunk_size or app.config['LIFECYCLE_CHUNK_SIZE']
+    run = LifecycleRun.query.filter(LifecycleRun.finished_at.is_(None)).order_by(LifecycleRun.id.desc()).first()
+    if run is None:
+        run = LifecycleRun(as_of=as_of or datetime.utcnow(), chunks=0, renewed=0, expired=0)
+        db.session.add(run)
+        db.session.commit()
+    before = run.renewed + run.expired
+    chunks = 0
+    while max_chunks is None or chunks < max_chunks:
+        if not process_lifecycle_chunk(run, chunk_size):
+            run.finished_at = datetime.utcnow()
+            audit('system', f"Lifecycle run {run.id}: {run.renewed} renewed, {run.expired} expired")
+            db.session.commit()
+            break
+        chunks += 1
+    response_cache.clear()
+    return run, run.renewed + run.expired - before
+
+@app.cli.command('lifecycle')
+@click.option('--as-of', type=click.DateTime(['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S']), default=None,
+              help='Treat subscriptions ending on or before this time as due (default: now).')
+@click.option('--chunk-size', type=int, default=None, help='Subscriptions per transaction.')
+@click.option('--max-chunks', type=int, default=None, help='Stop after this many chunks; the next run resumes.')
+def lifecycle_command(as_of, chunk_size, max_chunks):
+    """Renew or expire subscriptions whose end date has passed."""
+    started = time.perf_counter()
+    run, processed = run_lifecycle(as_of, chunk_size, max_chunks)
+    elapsed = time.perf_counter() - started
+    state = 'finished' if run.finished_at else 'paused, run again to resume'
+    click.echo(f'Lifecycle run {run.id} ({state}, as of {run.as_of:%Y-%m-%d %H:%M:%S}): '
+               f'{run.renewed} renewed, {run.expired} expired in {run.chunks} chunks.')
+    click.echo(f'This invocation: {processed} subscriptions in {elapsed:.1f}s '
+               f'({processed / max(elapsed, 1e-9):.0f} subscriptions/sec).')
+
+def start_lifecycle_scheduler():
+    """Sweep every LIFECYCLE_INTERVAL seconds in a background thread (single-process deployments)."""
+    def loop():
+        while True:
+            time.sleep(app.config['LIFECYCLE_INTERVAL'])
+            try:
+                with app.app_context():
+                    run_lifecycle()
+            except SQLAlchemyError:
+                app.logger.exception('Lifecycle sweep failed')
+    threading.Thread(target=loop, name='lifecycle', daemon=True).start()
+
+# Health checks
+# Probes for load balancers and process managers. Neither touches the ORM
+# session or the caches; /readyz checks out one pooled connection.
+@app.route('/healthz')
+def healthz():
+    """Liveness: this worker answers requests."""
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: the database answers and its schema is at SCHEMA_VERSION."""
+    try:
+        with db.engine.connect() as conn:
+            version = conn.execute(select(func.max(SchemaMigration.version))).scalar()
+    except SQLAlchemyError:
+        app.logger.exception('Readiness check failed')
+        return jsonify({'status': 'unavailable', 'reason': 'database unreachable'}), 503
+    if version is None or version < SCHEMA_VERSION:
+        return jsonify({'status': 'unavailable', 'reason': f'schema at {version}, need {SCHEMA_VERSION}'}), 503
+    return jsonify({'status': 'ready', 'schema_version': version, 'pid': os.getpid()})
+
+# Forked workers
+# serve.py loads the app once and forks its workers from it, so the plan
+# catalog, pricing rules and compiled templates are shared copy-on-write.
+# Pooled connections, background threads and locks must not cross a fork;
+# each child drops the inherited ones and starts its own on demand.
+def reset_after_fork():
+    global _plan_catalog_lock, _pricing_rules_lock
+    if 'sqlalchemy' in app.extensions:
+        with app.app_context():
+            db.engine.dispose(close=False)  # the parent keeps using its connections
+    _plan_catalog_lock = threading.Lock()
+    _pricing_rules_lock = threading.Lock()
+    response_cache._lock = threading.Lock()
+    response_cache._key_locks = {}
+    chat_contexts._lock = threading.Lock()
+    identities._lock = threading.Lock()
+    rate_limiter.__init__()  # in-flight counts and the shared map's thread lock
+    audit_sink.__init__()
+    chat_jobs.__init__()
+    notification_hub.__init__()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+# Application factory
+# create_app() applies the configuration, binds the database, runs the
+# versioned schema bootstrap and starts the optional background sweep. It
+# runs once per process: explicitly (serve.py, to do it before forking) or
+# on the first app context. Settings read from the environment above are
+# the defaults that config overrides. Settings derived from others are
+# computed here, unless config sets them.
+_create_lock = threading.RLock()
+_created = False
+
+def create_app(config=None):
+    """Initialize and return the application.
+
+    config is a mapping of app.config overrides, e.g.
+    create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'AUDIT_MODE': 'sync'}).
+    Later calls return the same app and may not pass config.
+    """
+    global _created
+    if _created and not config:
+        return app
+    with _create_lock:
+        if 'sqlalchemy' in app.extensions:  # done, or in progress further up this thread's stack
+            if config:
+                raise RuntimeError('create_app() already initialized the app; pass config to the first call')
+            return app
+        app.config.update(config or {})
+        app.config.setdefault('SQLITE_PRAGMAS', sqlite_pragmas(app.config['STORAGE_PROFILE'],
+                                                               os.environ.get('SQLITE_PRAGMAS', '')))
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+        app.config.setdefault('RATE_LIMITS', rate_limits(os.environ.get('RATE_LIMITS', '')))
+        rate_limiter.__init__()  # both read their settings when built
+        audit_sink.__init__()
+        db.init_app(app)
+        try:
+            if app.config['JINJA_BYTECODE_CACHE']:
+                os.makedirs(app.config['JINJA_BYTECODE_CACHE'], exist_ok=True)
+                app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE'])
+            with app.app_context():
+                bootstrap_schema()
+        except BaseException:
+            del app.extensions['sqlalchemy']  # let the next call try again
+            raise
+        if app.config['LIFECYCLE_INTERVAL']:
+            start_lifecycle_scheduler()
+        _created = True
+    return app
+
 if __name__ == '__main__':
     with app.app_context():
-        if not os.path.exists('subscriptions.db'):
-            db.create_all()
+        if not User.query.first():
             seed_data()
             print('DB initialized with seed data.')
     app.run(debug=True)
@@ -0,0 +1,103 @@
+"""Memory and throughput of the streamed admin export (/admin/export/<name>).
+
+Bulk-inserts --rows billing records into a throwaway SQLite database, then
+downloads /admin/export/billing as gzip-compressed CSV and NDJSON. While the
+response streams it samples the process RSS; a flat RSS curve means the
+export does not buffer rows. Reports rows/sec and compressed MB/sec.
+
+Usage:
+    python benchmarks/admin_export.py --rows 5000000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def seed(m, rows):
+    m.seed_data()
+    user_id = m.User.query.filter_by(username='user1').first().id
+    sub_id = m.Subscription.query.filter_by(user_id=user_id).first().id
+    table = m.BillingHistory.__table__
+    start = datetime.utcnow() - timedelta(days=3 * 365)
+    batch = []
+    with m.db.engine.begin() as conn:
+        for i in range(rows):
+            batch.append({
+                'user_id': user_id, 'subscription_id': sub_id, 'amount': 499.0, 'status': 'paid',
+                'payment_date': start + timedelta(seconds=i * 17), 'invoice_number': f'BENCH-{i}',
+                'description': 'Benchmark invoice',
+            })
+            if len(batch) == 50000:
+                conn.execute(table.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(table.insert(), batch)
+
+
+def export(client, fmt, sample_every):
+    response = client.get(f'/admin/export/billing?format={fmt}', buffered=False)
+    assert response.status_code == 200, response.status_code
+    decompressor = zlib.decompressobj(31)
+    lines = compressed = 0
+    readings = []
+    started = time.perf_counter()
+    for chunk in response.response:
+        compressed += len(chunk)
+        lines += decompressor.decompress(chunk).count(b'\n')
+        if time.perf_counter() - started >= len(readings) * sample_every:
+            readings.append(rss_mb())
+    response.close()
+    elapsed = time.perf_counter() - started
+    readings.append(rss_mb())
+    return lines, compressed, elapsed, readings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--sample-every', type=float, default=2.0, help='seconds between RSS samples')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-export-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        run(m, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    with m.app.app_context():
+        started = time.perf_counter()
+        seed(m, args.rows)
+        total = m.BillingHistory.query.count()
+        print(f'Seeded {args.rows} billing rows in {time.perf_counter() - started:.1f}s')
+
+    client = m.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    print(f'RSS before export: {rss_mb():.0f} MB')
+    for fmt in ('csv', 'ndjson'):
+        lines, compressed, elapsed, readings = export(client, fmt, args.sample_every)
+        rows = lines - 1 if fmt == 'csv' else lines
+        assert rows == total, f'{fmt}: exported {rows} of {total} rows'
+        print(f'{fmt:<7} {rows} rows in {elapsed:.1f}s: {rows / elapsed:,.0f} rows/sec, '
+              f'{compressed / 2 ** 20:.1f} MB gzip ({compressed / 2 ** 20 / elapsed:.1f} MB/s)')
+        print(f'        RSS MB every {args.sample_every:g}s: {" ".join(f"{r:.0f}" for r in readings)} '
+              f'(min {min(readings):.0f}, max {max(readings):.0f})')
+
+
+if __name__ == '__main__':
+    main()
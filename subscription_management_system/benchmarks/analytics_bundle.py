@@ -0,0 +1,139 @@
+"""Compare the five-request analytics fan-out with the single /api/analytics/bundle call.
+
+Seeds a throwaway SQLite database with N subscriptions, builds the rollups, then
+reports query count and latency for:
+  * legacy scans   - the GROUP BY scans of `subscription` the page used to issue
+  * rollup fan-out - the five /api/analytics/* requests the page used to make
+  * bundle         - the single /api/analytics/bundle request
+
+Usage:
+    python benchmarks/analytics_bundle.py --subscriptions 1000000
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+FANOUT = [
+    '/api/analytics/subscription_trends',
+    '/api/analytics/revenue',
+    '/api/analytics/subscription_status',
+    '/api/analytics/subscription_growth',
+    '/api/analytics/subscription_duration',
+]
+
+LEGACY_SCANS = [
+    "SELECT CAST(STRFTIME('%m', start_date) AS INTEGER), COUNT(id) FROM subscription GROUP BY 1",
+    "SELECT plan.name, COUNT(subscription.id) FROM plan JOIN subscription ON subscription.plan_id = plan.id GROUP BY plan.name",
+    "SELECT COUNT(*) FROM subscription",
+    "SELECT COUNT(*) FROM subscription WHERE status = 'cancelled'",
+    "SELECT plan.name, SUM(plan.price) FROM plan JOIN subscription ON subscription.plan_id = plan.id GROUP BY plan.name",
+    "SELECT CAST(STRFTIME('%m', start_date) AS INTEGER), COUNT(id) FROM subscription WHERE status = 'active' GROUP BY 1",
+    "SELECT CAST(STRFTIME('%m', start_date) AS INTEGER), COUNT(id) FROM subscription WHERE status = 'cancelled' GROUP BY 1",
+    "SELECT CAST(STRFTIME('%m', subscription.start_date) AS INTEGER), SUM(plan.price) FROM subscription JOIN plan ON subscription.plan_id = plan.id GROUP BY 1",
+    "SELECT status, COUNT(id) FROM subscription GROUP BY status",
+    "SELECT CAST(STRFTIME('%m', start_date) AS INTEGER), COUNT(id) FROM subscription GROUP BY 1 ORDER BY 1",
+    "SELECT CASE WHEN end_date > datetime('now', '+30 days') THEN 'Long-term (30+ days)' "
+    "WHEN end_date > datetime('now', '+7 days') THEN 'Medium-term (7-30 days)' "
+    "WHEN end_date > datetime('now') THEN 'Short-term (1-7 days)' ELSE 'Expired' END AS c, COUNT(id) "
+    "FROM subscription GROUP BY c",
+]
+
+
+def seed(m, subscriptions, seed_value=42):
+    rng = random.Random(seed_value)
+    db = m.db
+    db.create_all()
+    m.seed_data()
+    plan_ids = [p.id for p in m.Plan.query.all()]
+    user_id = m.User.query.filter_by(username='user1').first().id
+    now = datetime.utcnow()
+    table = m.Subscription.__table__
+    batch = []
+    with db.engine.begin() as conn:
+        for _ in range(subscriptions):
+            start = now - timedelta(days=rng.randint(0, 730), seconds=rng.randint(0, 86399))
+            batch.append({
+                'user_id': user_id,
+                'plan_id': rng.choice(plan_ids),
+                'status': 'active' if rng.random() < 0.7 else 'cancelled',
+                'start_date': start,
+                'end_date': start + timedelta(days=30),
+            })
+            if len(batch) == 50000:
+                conn.execute(table.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(table.insert(), batch)
+    m.ensure_schema()
+    m.rebuild_analytics()
+
+
+def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscriptions', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-analytics-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        run(m, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    from sqlalchemy import event, text
+
+    queries = []
+    with m.app.app_context():
+        started = time.perf_counter()
+        seed(m, args.subscriptions)
+        print(f'Seeded {args.subscriptions} subscriptions in {time.perf_counter() - started:.1f}s')
+        event.listen(m.db.engine, 'before_cursor_execute', lambda *a: queries.append(a[2]))
+
+        client = m.app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+
+        def legacy():
+            with m.db.engine.connect() as conn:
+                for sql in LEGACY_SCANS:
+                    conn.execute(text(sql)).all()
+
+        def fanout():
+            client.get('/admin/analytics')
+            for url in FANOUT:
+                client.get(url)
+
+        def bundle():
+            client.get('/admin/analytics')
+            client.get('/api/analytics/bundle')
+
+        print(f"{'mode':<16}{'requests':>10}{'queries':>10}{'median ms':>12}")
+        for name, fn, requests in [('legacy scans', legacy, 6), ('rollup fan-out', fanout, 6), ('bundle', bundle, 2)]:
+            queries.clear()
+            fn()
+            count = len(queries)
+            print(f'{name:<16}{requests:>10}{count:>10}{measure(fn, args.repeat):>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Checkout and cancel throughput with synchronous vs batched audit writes.
+
+Creates --writers users with a card and --prepared active subscriptions each,
+then for each AUDIT_MODE runs --writers threads for --duration seconds that
+alternate /subscribe/<plan_id> and /cancel/<sub_id>. Reports operations/sec,
+p50/p95 latency and, for 'async', the sink's queue depth and flush latency
+after the run.
+
+Usage:
+    python benchmarks/audit_sink.py --writers 8 --duration 10
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+def seed(m, writers, prepared):
+    db = m.db
+    m.seed_data()
+    plan_id = m.Plan.query.filter_by(active=True).order_by(m.Plan.price).first().id
+    now = datetime.utcnow()
+    users = []
+    for i in range(writers):
+        user = m.User(username=f'audit{i}', password='pw', role='user')
+        db.session.add(user)
+        db.session.flush()
+        card = m.PaymentMethod(user_id=user.id, card_type='visa', last_four_digits='4242',
+                               expiry_month=12, expiry_year=now.year + 3, is_default=True)
+        db.session.add(card)
+        db.session.flush()
+        users.append((user.username, user.id, card.id))
+    db.session.commit()
+    with db.engine.begin() as conn:
+        conn.execute(m.Subscription.__table__.insert(), [
+            {'user_id': user_id, 'plan_id': plan_id, 'status': 'active', 'start_date': now,
+             'end_date': now + timedelta(days=30)}
+            for _, user_id, _ in users for _ in range(prepared)
+        ])
+    m.rebuild_analytics()
+    db.session.commit()
+    subs = {user_id: [s for (s,) in db.session.query(m.Subscription.id).filter_by(user_id=user_id)]
+            for _, user_id, _ in users}
+    return plan_id, [(username, card_id, subs[user_id]) for username, user_id, card_id in users]
+
+
+def workload(m, args, plan_id, writers):
+    stop = threading.Event()
+    lock = threading.Lock()
+    timings = []
+
+    def writer(username, card_id, subs):
+        client = m.app.test_client()
+        client.post('/login', data={'username': username, 'password': 'pw'})
+        local = []
+        while not stop.is_set() and subs:
+            started = time.perf_counter()
+            response = client.post(f'/subscribe/{plan_id}', data={'payment_method_id': card_id},
+                                   headers={'X-Requested-With': 'XMLHttpRequest'})
+            assert response.get_json()['success'], response.get_json()
+            local.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            response = client.post(f'/cancel/{subs.pop()}')
+            assert response.status_code == 302, response.status_code
+            local.append(time.perf_counter() - started)
+        with lock:
+            timings.extend(local)
+
+    threads = [threading.Thread(target=writer, args=w) for w in writers]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return timings, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per mode')
+    parser.add_argument('--prepared', type=int, default=5000, help='active subscriptions per writer to cancel')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-audit-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        run(m, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    with m.app.app_context():
+        plan_id, writers = seed(m, args.writers, args.prepared)
+        logged_before = m.AuditLog.query.count()
+
+    print(f"{'mode':<7}{'ops':>8}{'ops/sec':>10}{'p50 ms':>9}{'p95 ms':>9}")
+    operations = 0
+    for mode in ('sync', 'async'):
+        m.app.config['AUDIT_MODE'] = mode
+        timings, elapsed = workload(m, args, plan_id, writers)
+        operations += len(timings)
+        timings.sort()
+        print(f"{mode:<7}{len(timings):>8}{len(timings) / elapsed:>10.1f}"
+              f"{statistics.median(timings) * 1000:>9.1f}{timings[int(len(timings) * 0.95)] * 1000:>9.1f}")
+
+    depth = m.audit_sink.stats()['queue_depth']
+    assert m.audit_sink.flush(30), 'audit sink did not drain'
+    stats = m.audit_sink.stats()
+    print(f"async sink: {stats['written']} entries in {stats['flushes']} batches, queue depth at the end "
+          f"{depth}, flush avg {stats['avg_flush_ms']} ms / max {stats['max_flush_ms']} ms")
+    with m.app.app_context():
+        logged = m.AuditLog.query.count() - logged_before
+    assert logged == operations, f'{logged} audit rows for {operations} operations'
+    print(f'OK: {logged} audit rows for {operations} operations')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Request-path latency of /api/chatbot while AI provider replies are pending.
+
+Starts a local stub of the OpenAI chat completions API that answers after
+--provider-delay seconds, points the app at it through OPENAI_BASE_URL, sends
+--messages chatbot requests and reports how long each request took. It then
+polls the jobs until every reply has been stored as a bot ChatMessage.
+
+Usage:
+    python benchmarks/chatbot_latency.py --messages 20 --provider-delay 2
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def start_stub_provider(delay):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(delay)
+            body = json.dumps({'choices': [{'message': {'content': 'Stub reply: try Pro Fiber.'}}]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--provider-delay', type=float, default=2.0)
+    args = parser.parse_args()
+
+    server = start_stub_provider(args.provider_delay)
+    workdir = tempfile.mkdtemp(prefix='bench-chatbot-')
+    os.environ.update({
+        'DATABASE_URL': 'sqlite:///' + os.path.join(workdir, 'bench.db'),
+        'AI_PROVIDER': 'openai',
+        'OPENAI_API_KEY': 'stub',
+        'OPENAI_BASE_URL': f'http://127.0.0.1:{server.server_port}/v1',
+        'CHATBOT_MAX_PENDING': str(max(args.messages, 32)),
+        'RATE_LIMIT_ENABLED': '0',
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        run(m, args)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    with m.app.app_context():
+        m.seed_data()
+    client = m.app.test_client()
+    client.post('/login', data={'username': 'user1', 'password': 'user123'})
+    chat_id = client.post('/api/chats', json={'name': 'bench'}).get_json()['chat_id']
+
+    timings, jobs = [], []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        response = client.post('/api/chatbot', json={'message': f'how fast is my connection today? ({i})', 'chat_id': chat_id})
+        timings.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 202, response.get_data(as_text=True)
+        jobs.append(response.get_json()['job_id'])
+
+    print(f'{args.messages} requests with a {args.provider_delay:.1f}s provider: '
+          f'median {statistics.median(timings):.2f} ms, max {max(timings):.2f} ms')
+
+    started = time.perf_counter()
+    pending = set(jobs)
+    while pending:
+        time.sleep(0.1)
+        for job_id in list(pending):
+            if client.get(f'/api/chatbot/jobs/{job_id}').get_json()['status'] == 'done':
+                pending.discard(job_id)
+    print(f'all replies collected after {time.perf_counter() - started:.2f}s '
+          f'({m.app.config["CHATBOT_WORKERS"]} workers)')
+
+    with m.app.app_context():
+        stored = m.ChatMessage.query.filter_by(chat_id=chat_id, sender='bot').count()
+    assert stored == args.messages, f'expected {args.messages} bot messages, found {stored}'
+    print(f'{stored} bot replies stored')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Cold-start time of a worker process: import, schema bootstrap, first requests.
+
+Every run starts a fresh Python interpreter that imports the framework
+libraries, then imports app and calls create_app(), and then sends the first
+GET /login and GET /plans through the test client. These are the first
+template renders. Each scenario runs --runs times and reports the median:
+
+  empty database       first boot, bootstrap_schema() creates everything
+  current schema       the database is at SCHEMA_VERSION, bootstrap is one query
+  + bytecode cache     as above with JINJA_BYTECODE_CACHE already filled
+
+For comparison every child process also times one full ensure_schema() after
+startup. This is the work every import did before the bootstrap was versioned.
+
+Usage:
+    python benchmarks/cold_start.py --subscriptions 100000 --runs 5
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import flask, flask_sqlalchemy, sqlalchemy
+libraries = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app as m
+m.create_app()
+imported = time.perf_counter()
+client = m.app.test_client()
+assert client.get('/login').status_code == 200
+assert client.get('/plans').status_code == 200
+served = time.perf_counter()
+with m.app.app_context():
+    ensure_started = time.perf_counter()
+    m.ensure_schema()
+    ensure_ms = (time.perf_counter() - ensure_started) * 1000
+print(json.dumps({
+    'libraries_ms': (libraries - started) * 1000,
+    'app_ms': (imported - libraries) * 1000,
+    'first_requests_ms': (served - imported) * 1000,
+    'total_ms': (served - started) * 1000,
+    'ensure_schema_ms': ensure_ms,
+}))
+"""
+
+COLUMNS = ['libraries_ms', 'app_ms', 'first_requests_ms', 'total_ms', 'ensure_schema_ms']
+
+
+def boot(database_url, bytecode_cache=''):
+    env = dict(os.environ, DATABASE_URL=database_url, JINJA_BYTECODE_CACHE=bytecode_cache,
+               AUDIT_MODE='sync', LIFECYCLE_INTERVAL='0')
+    output = subprocess.run([sys.executable, '-c', CHILD, APP_DIR], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def median_of(samples):
+    return {column: statistics.median(s[column] for s in samples) for column in COLUMNS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscriptions', type=int, default=100000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-cold-start-')
+    try:
+        run(workdir, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(workdir, args):
+    database = os.path.join(workdir, 'bench.db')
+    database_url = 'sqlite:///' + database
+    bytecode_cache = os.path.join(workdir, 'jinja')
+
+    empty = []
+    for _ in range(args.runs):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(database + suffix):
+                os.remove(database + suffix)
+        empty.append(boot(database_url))
+
+    # Keep the last database and fill it in a process of our own
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, APP_DIR)
+    import app as m
+    with m.app.app_context():
+        m.seed_data()
+        m.generate_data(users=max(1, args.subscriptions // 20), subscriptions=args.subscriptions,
+                        chats=max(1, args.subscriptions // 50))
+    m.audit_sink.flush(30)
+    with m.app.app_context():
+        m.db.engine.dispose()
+
+    current = [boot(database_url) for _ in range(args.runs)]
+    boot(database_url, bytecode_cache)  # fill the cache
+    cached = [boot(database_url, bytecode_cache) for _ in range(args.runs)]
+
+    print(f'median of {args.runs} worker boots, {args.subscriptions:,} subscriptions after the first scenario')
+    print(f"{'scenario':<22}{'libraries':>11}{'app+boot':>10}{'first GETs':>12}{'total':>9}{'ensure_schema':>15}")
+    for name, samples in [('empty database', empty), ('current schema', current),
+                          ('+ bytecode cache', cached)]:
+        row = median_of(samples)
+        print(f"{name:<22}{row['libraries_ms']:>9.0f}ms{row['app_ms']:>8.0f}ms{row['first_requests_ms']:>10.1f}ms"
+              f"{row['total_ms']:>7.0f}ms{row['ensure_schema_ms']:>13.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Flash-sale load test for discount redemption.
+
+N concurrent clients (each logged in as its own user) check out with the same
+discount code until their attempts run out. Afterwards the script verifies
+that the discount was never redeemed more often than its usage limit and that
+used_count matches the DiscountUsage rows, then reports redemptions/sec.
+
+Usage:
+    python benchmarks/discount_redemption.py --clients 50 --limit 500 --attempts 20
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+CODE = 'FLASH50'
+
+
+def seed(m, clients, limit):
+    db = m.db
+    m.seed_data()
+    users = [m.User(username=f'load{i}', password='load', role='user') for i in range(clients)]
+    db.session.add_all(users)
+    db.session.flush()
+    db.session.add_all([
+        m.PaymentMethod(user_id=u.id, card_type='visa', last_four_digits='4242',
+                        expiry_month=12, expiry_year=2030, is_default=True)
+        for u in users
+    ])
+    db.session.add(m.Discount(
+        name='Flash Sale', code=CODE, discount_type='percentage', discount_value=50.0,
+        valid_from=datetime.utcnow() - timedelta(days=1), valid_until=datetime.utcnow() + timedelta(days=1),
+        usage_limit=limit,
+    ))
+    db.session.commit()
+    plan = m.Plan.query.filter_by(active=True).first()
+    return [(u.username, m.PaymentMethod.query.filter_by(user_id=u.id).first().id) for u in users], plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--limit', type=int, default=500, help='usage limit of the discount')
+    parser.add_argument('--attempts', type=int, default=20, help='checkouts per client')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-discount-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        run(m, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    with m.app.app_context():
+        accounts, plan = seed(m, args.clients, args.limit)
+
+    results = {'discounted': 0, 'full_price': 0, 'failed': 0}
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.clients)
+
+    def client(username, payment_id):
+        c = m.app.test_client()
+        c.post('/login', data={'username': username, 'password': 'load'})
+        barrier.wait()
+        for _ in range(args.attempts):
+            response = c.post(
+                f'/subscribe/{plan.id}',
+                data={'payment_method_id': payment_id, 'discount_code': CODE},
+                headers={'X-Requested-With': 'XMLHttpRequest'},
+            )
+            data = response.get_json(silent=True) or {}
+            if not data.get('success'):
+                outcome = 'failed'
+            elif data['final_amount'] < plan.price:
+                outcome = 'discounted'
+            else:
+                outcome = 'full_price'
+            with lock:
+                results[outcome] += 1
+
+    threads = [threading.Thread(target=client, args=account) for account in accounts]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with m.app.app_context():
+        discount = m.Discount.query.filter_by(code=CODE).first()
+        usages = m.DiscountUsage.query.filter_by(discount_id=discount.id).count()
+
+    attempts = args.clients * args.attempts
+    print(f'clients={args.clients} attempts={attempts} usage_limit={args.limit}')
+    print(f"checkouts: {results['discounted']} discounted, {results['full_price']} full price, {results['failed']} failed")
+    print(f'used_count={discount.used_count} discount_usage_rows={usages}')
+    print(f'elapsed {elapsed:.2f}s, {attempts / elapsed:.1f} checkouts/sec, {discount.used_count / elapsed:.1f} redemptions/sec')
+
+    assert discount.used_count <= args.limit, 'discount oversubscribed'
+    assert discount.used_count == usages == results['discounted'], 'redemption counts disagree'
+    print('OK: no oversubscription')
+
+
+if __name__ == '__main__':
+    main()
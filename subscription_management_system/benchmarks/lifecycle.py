@@ -0,0 +1,120 @@
+"""Throughput of the subscription lifecycle engine (flask lifecycle).
+
+Seeds --subscriptions due subscriptions (plus 10% that are not due yet)
+spread over --users users, of whom --without-card have no default payment
+method. It then runs the engine for --interrupt-after chunks to simulate a
+crash, resumes it to completion and checks the results:
+  * no active subscription is still due
+  * one BillingHistory row per renewal, renewed + expired == due
+  * the incrementally maintained rollups equal a full rebuild_analytics()
+
+Usage:
+    python benchmarks/lifecycle.py --subscriptions 1000000 --users 20000
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def seed(m, subscriptions, users, without_card, seed_value=7):
+    rng = random.Random(seed_value)
+    db = m.db
+    m.seed_data()
+    plan_ids = [p.id for p in m.Plan.query.filter_by(active=True).all()]
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        conn.execute(m.User.__table__.insert(), [
+            {'username': f'life{i}', 'password': 'x', 'role': 'user'} for i in range(users)
+        ])
+    first_user = m.User.query.filter_by(username='life0').first().id
+    user_ids = list(range(first_user, first_user + users))
+    carded = user_ids[int(users * without_card):]
+    due = 0
+    with db.engine.begin() as conn:
+        conn.execute(m.PaymentMethod.__table__.insert(), [
+            {'user_id': u, 'card_type': 'visa', 'last_four_digits': '4242', 'expiry_month': 12,
+             'expiry_year': 2030, 'is_default': True, 'is_active': True, 'created_at': now}
+            for u in carded
+        ])
+        batch = []
+        for i in range(int(subscriptions * 1.1)):
+            is_due = i < subscriptions
+            due += is_due
+            end = now - timedelta(days=rng.uniform(0, 60)) if is_due else now + timedelta(days=rng.uniform(1, 30))
+            batch.append({'user_id': rng.choice(user_ids), 'plan_id': rng.choice(plan_ids), 'status': 'active',
+                          'start_date': end - timedelta(days=30), 'end_date': end})
+            if len(batch) == 50000:
+                conn.execute(m.Subscription.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(m.Subscription.__table__.insert(), batch)
+    m.rebuild_analytics()
+    db.session.commit()
+    return due
+
+
+def rollup_snapshot(m):
+    rows = m.db.session.query(m.Analytics.metric_name, m.Analytics.metric_date, m.Analytics.plan_id,
+                              m.Analytics.metric_value).all()
+    return {(n, d, p): v for n, d, p, v in rows if v}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscriptions', type=int, default=1000000, help='due subscriptions')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--without-card', type=float, default=0.1, help='share of users without a default card')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--interrupt-after', type=int, default=10, help='chunks before the simulated crash')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-lifecycle-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        run(m, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    with m.app.app_context():
+        started = time.perf_counter()
+        due = seed(m, args.subscriptions, args.users, args.without_card)
+        billing_before = m.BillingHistory.query.count()
+        print(f'Seeded {due} due subscriptions in {time.perf_counter() - started:.1f}s')
+
+        started = time.perf_counter()
+        lifecycle_run, first = m.run_lifecycle(chunk_size=args.chunk_size, max_chunks=args.interrupt_after)
+        assert lifecycle_run.finished_at is None
+        print(f'interrupted after {lifecycle_run.chunks} chunks: {first} processed')
+        lifecycle_run, rest = m.run_lifecycle(chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - started
+        assert lifecycle_run.finished_at is not None
+        print(f'resumed run {lifecycle_run.id}: {lifecycle_run.renewed} renewed, {lifecycle_run.expired} expired '
+              f'in {lifecycle_run.chunks} chunks')
+        print(f'{due} subscriptions in {elapsed:.1f}s: {due / elapsed:,.0f} subscriptions/sec')
+
+        still_due = m.Subscription.query.filter(m.Subscription.status == 'active',
+                                                m.Subscription.end_date <= lifecycle_run.as_of).count()
+        invoices = m.BillingHistory.query.count() - billing_before
+        assert still_due == 0, f'{still_due} subscriptions still due'
+        assert first + rest == due == lifecycle_run.renewed + lifecycle_run.expired
+        assert invoices == lifecycle_run.renewed, f'{invoices} invoices for {lifecycle_run.renewed} renewals'
+
+        incremental = rollup_snapshot(m)
+        m.rebuild_analytics()
+        m.db.session.commit()
+        assert incremental == rollup_snapshot(m), 'rollups drifted from rebuild_analytics()'
+        print('OK: nothing left due, one invoice per renewal, rollups match a full rebuild')
+
+
+if __name__ == '__main__':
+    main()
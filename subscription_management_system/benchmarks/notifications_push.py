@@ -0,0 +1,163 @@
+"""Database load of dashboard notifications: 3-second polling vs the SSE stream.
+
+Seeds N users that each have a subscription expiring soon, then keeps N
+dashboards connected for --duration seconds twice:
+  * poll - every client calls /api/user/notifications every --poll-interval seconds
+  * push - every client holds /api/user/notifications/stream open while an admin
+           creates --discounts discounts, which are pushed to every stream
+and reports the SQL statements/sec the notifications cost in each mode. Logins
+and the initial snapshot of each stream are counted separately as connect cost.
+
+Usage:
+    python benchmarks/notifications_push.py --clients 200 --duration 15
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+def seed(m, clients):
+    db = m.db
+    m.seed_data()
+    plan_id = m.Plan.query.filter_by(active=True).first().id
+    users = [m.User(username=f'dash{i}', password='dash', role='user') for i in range(clients)]
+    db.session.add_all(users)
+    db.session.flush()
+    now = datetime.utcnow()
+    subs = [m.Subscription(user_id=u.id, plan_id=plan_id, status='active',
+                           start_date=now - timedelta(days=27), end_date=now + timedelta(days=3))
+            for u in users]
+    db.session.add_all(subs)
+    db.session.commit()
+    m.apply_rollup(added=[key for sub in subs for key in m.rollup_keys(sub)])
+    db.session.commit()
+    return [u.username for u in users]
+
+
+def login(m, username):
+    client = m.app.test_client()
+    client.post('/login', data={'username': username, 'password': 'dash'})
+    return client
+
+
+def poll(m, clients, args, count):
+    stop = threading.Event()
+
+    def dashboard(client):
+        time.sleep(random.uniform(0, args.poll_interval))
+        while not stop.is_set():
+            client.get('/api/user/notifications')
+            stop.wait(args.poll_interval)
+
+    threads = [threading.Thread(target=dashboard, args=(c,)) for c in clients]
+    count['queries'] = 0
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return count['queries'], 0
+
+
+def push(m, clients, args, count):
+    stop = threading.Event()
+    connected = threading.Barrier(len(clients) + 1)
+    delivered = [0]
+    lock = threading.Lock()
+
+    def dashboard(client):
+        response = client.get('/api/user/notifications/stream', buffered=False)
+        connected.wait()
+        try:
+            for chunk in response.response:
+                pushed = chunk.count(b'"message": "Push ')
+                if pushed:
+                    with lock:
+                        delivered[0] += pushed
+                if stop.is_set():
+                    break
+        finally:
+            response.close()
+
+    count['queries'] = 0
+    threads = [threading.Thread(target=dashboard, args=(c,)) for c in clients]
+    for t in threads:
+        t.start()
+    connected.wait()
+    connect_queries = count['queries']
+
+    count['queries'] = 0
+    admin = m.app.test_client()
+    admin.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    until = (datetime.utcnow() + timedelta(days=30)).strftime('%Y-%m-%d')
+    for i in range(args.discounts):
+        time.sleep(args.duration / (args.discounts + 1))
+        admin.post('/admin/discounts/create', data={
+            'name': f'Push {i}', 'code': f'PUSH{i}', 'discount_type': 'percentage',
+            'discount_value': 10, 'valid_from': today, 'valid_until': until,
+        })
+    time.sleep(args.duration / (args.discounts + 1))
+    queries = count['queries']
+    stop.set()
+    for t in threads:
+        t.join()
+    print(f'push: {delivered[0]} discount notifications delivered '
+          f'({args.discounts} discounts x {len(clients)} streams expected)')
+    return queries, connect_queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=15.0, help='seconds per mode')
+    parser.add_argument('--poll-interval', type=float, default=3.0)
+    parser.add_argument('--scan-interval', type=int, default=5, help='expiry scan interval of the push hub')
+    parser.add_argument('--discounts', type=int, default=3, help='discounts created during the push run')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-notifications-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    os.environ['NOTIFICATION_SCAN_INTERVAL'] = str(args.scan_interval)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        run(m, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    from sqlalchemy import event
+
+    # Measure steady state: keep the post-login window open for the whole run
+    m.app.config['NOTIFICATION_WINDOW_SECONDS'] = 24 * 3600
+    m.app.config['NOTIFICATION_HEARTBEAT'] = 1
+    with m.app.app_context():
+        usernames = seed(m, args.clients)
+        count = {'queries': 0}
+        lock = threading.Lock()
+
+        def on_execute(*_):
+            with lock:
+                count['queries'] += 1
+        event.listen(m.db.engine, 'before_cursor_execute', on_execute)
+
+    print(f"{'mode':<8}{'clients':>9}{'connect queries':>17}{'queries':>10}{'queries/sec':>13}")
+    for name, mode in [('poll', poll), ('push', push)]:
+        clients = [login(m, u) for u in usernames]
+        queries, connect = mode(m, clients, args, count)
+        print(f'{name:<8}{args.clients:>9}{connect:>17}{queries:>10}{queries / args.duration:>13.1f}')
+
+
+if __name__ == '__main__':
+    main()
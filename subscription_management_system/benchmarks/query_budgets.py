@@ -0,0 +1,141 @@
+"""Check the per-route SQL query budgets against small and large accounts.
+
+Creates two users, one with --small and one with --large subscriptions and
+invoices, runs every route listed in QUERY_BUDGETS for both with
+QUERY_BUDGET_STRICT enabled, and prints the statement counts. Fails if a
+route exceeds its budget or if its count depends on the account size.
+The chatbot is measured twice: with the built-in replies and with a stub AI
+provider, whose reply is held back until the request has been counted.
+
+Usage:
+    python benchmarks/query_budgets.py --small 1 --large 200
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+def seed_account(m, username, subscriptions):
+    db = m.db
+    user = m.User(username=username, password='pw', role='user')
+    db.session.add(user)
+    db.session.flush()
+    card = m.PaymentMethod(user_id=user.id, card_type='visa', last_four_digits='4242',
+                           expiry_month=12, expiry_year=2030, is_default=True)
+    db.session.add(card)
+    db.session.flush()
+    plans = m.Plan.query.filter_by(active=True).all()
+    now = datetime.utcnow()
+    for i in range(subscriptions):
+        plan = plans[i % len(plans)]
+        sub = m.Subscription(user_id=user.id, plan_id=plan.id, status='cancelled' if i % 3 == 2 else 'active',
+                             start_date=now - timedelta(days=i), end_date=now + timedelta(days=5 + i % 40))
+        db.session.add(sub)
+        db.session.flush()
+        db.session.add(m.BillingHistory(user_id=user.id, subscription_id=sub.id, amount=plan.price,
+                                        payment_method_id=card.id, invoice_number=f'INV-{username}-{i}',
+                                        description=f'{plan.name} payment'))
+    db.session.commit()
+
+
+def provider_path(m, send, replies):
+    """Run send() as the AI_PROVIDER path against a stub provider that waits for replies."""
+    def stub_provider(url, payload, headers, timeout):
+        replies.wait(10)  # keeps the bot reply's INSERT out of the counted request
+        return {'choices': [{'message': {'content': 'stub reply'}}]}
+    m.app.config['CHATBOT_TRANSPORT'] = stub_provider
+
+    def run(client):
+        os.environ.update(AI_PROVIDER='openai', OPENAI_API_KEY='bench')
+        try:
+            return send(client)
+        finally:
+            del os.environ['AI_PROVIDER'], os.environ['OPENAI_API_KEY']
+    return run
+
+
+def settle(client, responses, replies):
+    """Let the stub provider answer and wait until the replies are stored."""
+    replies.set()
+    for response in responses:
+        job_id = response.get_json().get('job_id')
+        while job_id and client.get(f'/api/chatbot/jobs/{job_id}').get_json()['status'] == 'pending':
+            time.sleep(0.01)
+    replies.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--small', type=int, default=1)
+    parser.add_argument('--large', type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-budgets-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        sys.exit(run(m, args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    m.app.config['QUERY_BUDGET_STRICT'] = True
+    with m.app.app_context():
+        m.seed_data()
+        seed_account(m, 'small', args.small)
+        seed_account(m, 'large', args.large)
+
+    replies = threading.Event()
+    requests = {
+        'user_dashboard': lambda c: c.get('/user/dashboard'),
+        'user_billing_history': lambda c: c.get('/user/billing-history'),
+        'user_recommendations': lambda c: c.get('/user/recommendations'),
+        'user_offers': lambda c: c.get('/user/offers'),
+        'user_notifications': lambda c: c.get('/api/user/notifications'),
+        'api_chatbot_reply': lambda c: c.post('/api/chatbot', json={'message': 'which plan should I pick?',
+                                                                    'chat_id': chat_ids[c]}),
+        'api_chatbot_reply provider': provider_path(m, lambda c: c.post(
+            '/api/chatbot', json={'message': 'is there a student price?', 'chat_id': chat_ids[c]}), replies),
+        'api_get_chats': lambda c: c.get('/api/chats'),
+        'api_quote': lambda c: c.get('/api/quote?code=SUMMER20'),
+    }
+    missing = set(m.QUERY_BUDGETS) - {label.split()[0] for label in requests}
+    assert not missing, f'no request defined for {sorted(missing)}'
+
+    counts, chat_ids = {}, {}
+    for username in ('small', 'large'):
+        client = m.app.test_client()
+        client.post('/login', data={'username': username, 'password': 'pw'})
+        chat_ids[client] = client.post('/api/chats', json={'name': 'budget'}).get_json()['chat_id']
+        for label, send in requests.items():
+            warm = send(client)  # warm the per-process caches
+            with m.count_queries() as statements:
+                response = send(client)
+            assert response.status_code < 400, f'{label}: HTTP {response.status_code}'
+            counts[label, username] = len(statements)
+            if label.endswith(' provider'):
+                assert response.status_code == 202, f'{label}: no provider job started'
+                settle(client, [warm, response], replies)
+
+    failed = 0
+    print(f"{'endpoint':<30}{'budget':>8}{f'{args.small} rows':>10}{f'{args.large} rows':>12}")
+    for label in requests:
+        budget = m.QUERY_BUDGETS[label.split()[0]]
+        small, large = counts[label, 'small'], counts[label, 'large']
+        ok = max(small, large) <= budget and small == large
+        failed += not ok
+        print(f"{label:<30}{budget:>8}{small:>10}{large:>12}{'' if ok else '  FAIL'}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Latency of well-behaved users while a few clients hammer the expensive endpoints.
+
+Generates a small database. For each setting of RATE_LIMIT_ENABLED it
+runs --users user threads that open the dashboard and price discount codes,
+asking the chatbot every fifth request, with --think seconds between
+requests (within the default limits), next to --abusers
+threads that post chatbot messages, discount codes and failed logins
+back to back, all for --duration seconds. The clients run in the server's
+process, so --abuse-gap stands in for an abuser's network round trip and
+keeps their client-side work from taking over the GIL. It reports the well-behaved
+users' p50/p99 latency and the abusers' requests served and refused
+(429/503). It also reports the latency of the refusals.
+
+Usage:
+    python benchmarks/rate_limit.py --users 16 --abusers 4 --duration 20
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+
+def accounts(m, count):
+    with m.app.app_context():
+        rows = m.db.session.execute(
+            m.select(m.User.username).where(m.User.role == 'user', m.User.password == 'password')
+            .order_by(m.User.id).limit(count)
+        ).scalars().all()
+    assert len(rows) == count, f'only {len(rows)} generated users'
+    return rows
+
+
+def login(m, username):
+    client = m.app.test_client()
+    client.post('/login', data={'username': username, 'password': 'password'})
+    chat_id = client.post('/api/chats', json={'name': 'bench'}).get_json()['chat_id']
+    return client, chat_id
+
+
+def workload(m, args, users, abusers, plan_id):
+    stop = threading.Event()
+    lock = threading.Lock()
+    good, served, refused, refused_ms = [], [0], {429: 0, 503: 0}, []
+
+    def user(client, chat_id):
+        requests = [
+            lambda: client.get('/user/dashboard'),
+            lambda: client.get('/api/quote?code=SUMMER20'),
+            lambda: client.get('/user/dashboard'),
+            lambda: client.get('/api/quote?code=WELCOME10'),
+            lambda: client.post('/api/chatbot', json={'message': 'suggest a plan', 'chat_id': chat_id}),
+        ]
+        local, i = [], 0
+        while not stop.is_set():
+            started = time.perf_counter()
+            response = requests[i % len(requests)]()
+            local.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, f'well-behaved user got HTTP {response.status_code}'
+            i += 1
+            stop.wait(args.think)
+        with lock:
+            good.extend(local)
+
+    def abuser(client, chat_id):
+        anonymous = m.app.test_client()
+        requests = [
+            lambda: client.post('/api/chatbot', json={'message': 'suggest a plan', 'chat_id': chat_id}),
+            lambda: client.post('/apply_discount', data={'discount_code': 'NOPE', 'plan_id': plan_id}),
+            lambda: anonymous.post('/login', data={'username': 'admin', 'password': 'guess'}),
+        ]
+        i = 0
+        while not stop.is_set():
+            started = time.perf_counter()
+            response = requests[i % len(requests)]()
+            elapsed = (time.perf_counter() - started) * 1000
+            i += 1
+            stop.wait(args.abuse_gap)
+            with lock:
+                if response.status_code in refused:
+                    refused[response.status_code] += 1
+                    refused_ms.append(elapsed)
+                else:
+                    served[0] += 1
+
+    threads = [threading.Thread(target=user, args=u) for u in users]
+    threads += [threading.Thread(target=abuser, args=a) for a in abusers]
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return good, served[0], refused, refused_ms
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--abusers', type=int, default=4)
+    parser.add_argument('--think', type=float, default=0.5, help='seconds between a user\'s requests')
+    parser.add_argument('--abuse-gap', type=float, default=0.005, help='seconds between an abuser\'s requests')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per setting')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-ratelimit-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        run(m, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    with m.app.app_context():
+        m.seed_data()
+        m.generate_data(users=args.users + args.abusers, subscriptions=20 * (args.users + args.abusers), chats=0)
+        plan_id = m.Plan.query.filter_by(active=True).order_by(m.Plan.price).first().id
+    names = accounts(m, args.users + args.abusers)
+
+    print(f"{'limiter':<9}{'user p50':>10}{'user p99':>10}{'user reqs':>11}{'abuse served':>14}"
+          f"{'429':>7}{'503':>6}{'refusal p50':>13}")
+    for enabled in (False, True):
+        # Every test client logs in from 127.0.0.1, so log in before limiting
+        m.app.config['RATE_LIMIT_ENABLED'] = False
+        users = [login(m, name) for name in names[:args.users]]
+        abusers = [login(m, name) for name in names[args.users:]]
+        m.app.config['RATE_LIMIT_ENABLED'] = enabled
+        m.rate_limiter.__init__()
+        good, served, refused, refused_ms = workload(m, args, users, abusers, plan_id)
+        print(f"{'on' if enabled else 'off':<9}{statistics.median(good):>8.1f}ms{percentile(good, 0.99):>8.1f}ms"
+              f"{len(good):>11}{served:>14}{refused[429]:>7}{refused[503]:>6}"
+              f"{statistics.median(refused_ms) if refused_ms else 0:>11.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
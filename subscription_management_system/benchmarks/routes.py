@@ -0,0 +1,203 @@
+"""Latency and query counts of the key routes at growing data volumes.
+
+Grows one throwaway SQLite database through each --scales subscription count
+with generate_data() (about 6 invoices per subscription, 1 user per 20
+subscriptions), and at every scale drives the Flask test client through each
+route in ROUTES: --warmup untimed requests, then --requests timed ones. User
+routes run as the account with the most subscriptions. The response cache is
+off, so the analytics routes run their rollup queries on every request. It
+records p50/p95 latency and the SQL statement count per request.
+
+The results are compared with the --baseline JSON file. A route fails when
+its p95 exceeds the baseline by more than --threshold (a fraction), with
+--min-delta-ms as a noise floor, or when it runs more queries than before.
+The exit status is 1 if any route fails. --update writes the new numbers to
+the baseline instead; baselines are machine specific, so refresh them on the
+machine that runs the comparison.
+
+Usage:
+    python benchmarks/routes.py --scales 10000,100000,1000000 --update
+    python benchmarks/routes.py --scales 10000,100000 --threshold 0.25
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routes_baseline.json')
+
+# Endpoint names measured at every scale; fixtures() builds one request for each
+ROUTES = [
+    'login', 'list_plans', 'apply_discount', 'subscribe', 'user_dashboard', 'admin_dashboard',
+    'api_analytics_bundle', 'api_subscription_trends', 'api_revenue', 'api_subscription_status',
+    'api_subscription_growth', 'api_subscription_duration', 'api_plan_counts', 'api_chatbot_reply',
+]
+
+
+def grow(m, scale, seed):
+    """Add subscriptions (and proportional users, invoices, chats) until there are `scale`."""
+    with m.app.app_context():
+        have = m.Subscription.query.count()
+        if scale > have:
+            add = scale - have
+            m.generate_data(users=max(1, add // 20), subscriptions=add, discounts=max(1, add // 2000),
+                            chats=max(1, add // 50), seed=seed)
+
+
+def fixtures(m):
+    """Log in the heaviest user and the admin and describe one request per route."""
+    with m.app.app_context():
+        user_id = m.db.session.execute(m.select(m.Subscription.user_id).group_by(m.Subscription.user_id)
+                                       .order_by(m.func.count().desc()).limit(1)).scalar()
+        user = m.db.session.get(m.User, user_id)
+        card = m.PaymentMethod.query.filter_by(user_id=user.id, is_active=True).first()
+        if card is None:
+            card = m.PaymentMethod(user_id=user.id, card_type='visa', last_four_digits='4242',
+                                   expiry_month=12, expiry_year=datetime.utcnow().year + 3, is_default=True)
+            m.db.session.add(card)
+        discount = m.Discount(name='Benchmark', code=f'BENCH{user.id}', discount_type='percentage',
+                              discount_value=10, valid_from=datetime(2000, 1, 1), valid_until=datetime(2100, 1, 1))
+        if not m.Discount.query.filter_by(code=discount.code).first():
+            m.db.session.add(discount)
+        plan_id = m.Plan.query.filter_by(active=True).order_by(m.Plan.price).first().id
+        m.db.session.commit()
+        credentials = {'username': user.username, 'password': user.password}
+        card_id, subscriptions = card.id, m.Subscription.query.filter_by(user_id=user.id).count()
+
+    client = m.app.test_client()
+    client.post('/login', data=credentials)
+    chat_id = client.post('/api/chats', json={'name': 'benchmark'}).get_json()['chat_id']
+    admin = m.app.test_client()
+    admin.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    anonymous = m.app.test_client()
+    ajax = {'X-Requested-With': 'XMLHttpRequest'}
+
+    requests = {
+        'login': (anonymous, 'post', '/login', {'data': credentials}),
+        'list_plans': (client, 'get', '/plans', {}),
+        'apply_discount': (client, 'post', '/apply_discount',
+                           {'data': {'discount_code': f'BENCH{user_id}', 'plan_id': plan_id}}),
+        'subscribe': (client, 'post', f'/subscribe/{plan_id}',
+                      {'data': {'payment_method_id': card_id}, 'headers': ajax}),
+        'user_dashboard': (client, 'get', '/user/dashboard', {}),
+        'admin_dashboard': (admin, 'get', '/admin/dashboard', {}),
+        'api_analytics_bundle': (admin, 'get', '/api/analytics/bundle', {}),
+        'api_subscription_trends': (admin, 'get', '/api/analytics/subscription_trends', {}),
+        'api_revenue': (admin, 'get', '/api/analytics/revenue', {}),
+        'api_subscription_status': (admin, 'get', '/api/analytics/subscription_status', {}),
+        'api_subscription_growth': (admin, 'get', '/api/analytics/subscription_growth', {}),
+        'api_subscription_duration': (admin, 'get', '/api/analytics/subscription_duration', {}),
+        'api_plan_counts': (admin, 'get', '/api/plan_counts', {}),
+        'api_chatbot_reply': (client, 'post', '/api/chatbot',
+                              {'json': {'message': 'suggest a better plan', 'chat_id': chat_id}}),
+    }
+    assert set(requests) == set(ROUTES)
+    return requests, subscriptions
+
+
+def measure(m, request, warmup, count):
+    client, method, url, kwargs = request
+    send = getattr(client, method)
+    for _ in range(warmup):
+        send(url, **kwargs)
+    timings, queries = [], []
+    for _ in range(count):
+        with m.count_queries() as statements:
+            started = time.perf_counter()
+            response = send(url, **kwargs)
+            timings.append((time.perf_counter() - started) * 1000)
+        assert response.status_code < 400, f'{url}: HTTP {response.status_code}'
+        queries.append(len(statements))
+    timings.sort()
+    return {
+        'p50_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        'queries': max(queries),
+    }
+
+
+def compare(current, baseline, threshold, min_delta_ms):
+    """Return the failure reason, or '' if current is within the baseline's tolerance."""
+    if baseline is None:
+        return ''
+    reasons = []
+    if current['queries'] > baseline['queries']:
+        reasons.append(f"queries {baseline['queries']} -> {current['queries']}")
+    limit = baseline['p95_ms'] * (1 + threshold)
+    if current['p95_ms'] > limit and current['p95_ms'] - baseline['p95_ms'] > min_delta_ms:
+        reasons.append(f"p95 {baseline['p95_ms']:.1f} -> {current['p95_ms']:.1f} ms")
+    return ', '.join(reasons)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='10000,100000,1000000', help='comma-separated subscription counts')
+    parser.add_argument('--requests', type=int, default=50, help='timed requests per route and scale')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed p95 growth over the baseline')
+    parser.add_argument('--min-delta-ms', type=float, default=5.0, help='ignore p95 growth below this')
+    parser.add_argument('--update', action='store_true', help='write the results to the baseline')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-routes-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    os.environ['RESPONSE_CACHE_TTL'] = '0'
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        sys.exit(run(m, args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    scales = sorted(int(s) for s in args.scales.split(','))
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    with m.app.app_context():
+        m.seed_data()
+
+    results, failed = {}, 0
+    for i, scale in enumerate(scales):
+        started = time.perf_counter()
+        grow(m, scale, args.seed + i)
+        requests, heaviest = fixtures(m)
+        print(f'\n{scale:,} subscriptions (built in {time.perf_counter() - started:.0f}s, '
+              f'user routes as an account with {heaviest} subscriptions)')
+        print(f"{'route':<28}{'p50 ms':>9}{'p95 ms':>9}{'queries':>9}   vs baseline")
+        results[str(scale)] = {}
+        for route in ROUTES:
+            current = measure(m, requests[route], args.warmup, args.requests)
+            results[str(scale)][route] = current
+            reason = compare(current, baseline.get('scales', {}).get(str(scale), {}).get(route),
+                             args.threshold, args.min_delta_ms)
+            failed += bool(reason) and not args.update
+            print(f"{route:<28}{current['p50_ms']:>9.2f}{current['p95_ms']:>9.2f}{current['queries']:>9}   "
+                  f"{'FAIL ' + reason if reason else 'ok'}")
+
+    if args.update:
+        scales_out = dict(baseline.get('scales', {}), **results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'requests': args.requests, 'scales': scales_out}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'\nbaseline written to {args.baseline}')
+    elif failed:
+        print(f'\n{failed} route(s) regressed beyond {args.threshold:.0%}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    main()
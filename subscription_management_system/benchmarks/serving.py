@@ -0,0 +1,135 @@
+"""Requests/sec of serve.py as the worker count grows.
+
+Seeds a throwaway database, then for each --workers count starts
+`serve.py --workers N --threads --threads` on a free local port, waits
+for /readyz, and runs --clients client processes that each send requests to
+--paths (round robin, a new connection per request) for --duration seconds.
+It reports requests/sec, p50/p95 latency, errors and the number of distinct
+worker pids that answered /healthz. Throughput can only grow with workers
+up to the number of CPU cores, because each worker runs Python under its
+own GIL.
+
+Usage:
+    python benchmarks/serving.py --workers 1,2,4 --clients 16 --duration 10
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('GET', path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def wait_ready(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'serve.py exited with status {process.returncode}')
+        try:
+            if get(port, '/readyz')[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('server did not become ready')
+
+
+def client(port, paths, duration):
+    timings, errors = [], 0
+    deadline = time.monotonic() + duration
+    i = 0
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            status, _ = get(port, paths[i % len(paths)])
+        except OSError:
+            status = 0
+        i += 1
+        if status == 200:
+            timings.append((time.perf_counter() - started) * 1000)
+        else:
+            errors += 1
+    return timings, errors
+
+
+def load(port, args):
+    paths = args.paths.split(',')
+    with multiprocessing.Pool(args.clients) as pool:
+        results = pool.starmap(client, [(port, paths, args.duration)] * args.clients)
+    timings = sorted(t for result, _ in results for t in result)
+    errors = sum(e for _, e in results)
+    pids = {get(port, '/healthz')[1] for _ in range(50)}
+    return timings, errors, len(pids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated worker counts')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client processes')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per worker count')
+    parser.add_argument('--paths', default='/plans,/api/quote,/healthz', help='comma-separated GET paths')
+    parser.add_argument('--server', choices=['auto', 'gunicorn', 'builtin'], default='auto')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-serving-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    sys.path.insert(0, APP_DIR)
+    import app as m
+
+    try:
+        run(m, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    with m.app.app_context():
+        m.seed_data()
+        m.db.engine.dispose()
+
+    print(f'{os.cpu_count()} CPUs, {args.clients} clients, {args.threads} threads per worker, paths {args.paths}')
+    print(f"{'workers':<9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'errors':>8}{'pids':>6}")
+    for workers in (int(w) for w in args.workers.split(',')):
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(APP_DIR, 'serve.py'), '--bind', f'127.0.0.1:{port}',
+             '--workers', str(workers), '--threads', str(args.threads), '--server', args.server],
+            cwd=APP_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_ready(port, process)
+            timings, errors, pids = load(port, args)
+        finally:
+            process.terminate()
+            process.wait(30)
+        print(f"{workers:<9}{len(timings) / args.duration:>9.1f}{statistics.median(timings):>9.1f}"
+              f"{timings[int(len(timings) * 0.95)]:>9.1f}{errors:>8}{pids:>6}")
+
+
+if __name__ == '__main__':
+    main()
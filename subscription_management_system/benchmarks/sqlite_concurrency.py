@@ -0,0 +1,137 @@
+"""Concurrent readers and writers under each SQLite storage profile.
+
+Generates --subscriptions subscriptions with generate_data(), then for every
+profile in STORAGE_PROFILES runs --readers admin threads that load --read-url
+(by default /admin/dashboard, whose counts scan the subscription table) and
+--writers user threads that check out plans through /subscribe/<plan_id>, all
+for --duration seconds. Between profiles the engine is disposed so new
+connections pick up the profile's pragmas. Reports reads/sec, checkouts/sec,
+failed checkouts ("database is locked" surfaces as 'Checkout failed'), HTTP
+errors and p95 latencies. With the rollback journal a commit waits for every
+running read to finish; in WAL mode it does not.
+
+Usage:
+    python benchmarks/sqlite_concurrency.py --readers 8 --writers 4 --duration 10
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+def accounts(m, count):
+    """(username, payment method id) of generated users that have a card."""
+    with m.app.app_context():
+        rows = m.db.session.execute(
+            m.select(m.User.username, m.func.min(m.PaymentMethod.id))
+            .join(m.PaymentMethod, m.PaymentMethod.user_id == m.User.id)
+            .where(m.User.role == 'user', m.User.password == 'password')
+            .group_by(m.User.id).limit(count)
+        ).all()
+    assert len(rows) == count, f'only {len(rows)} users with a card'
+    return rows
+
+
+def login(m, username, password='password'):
+    client = m.app.test_client()
+    client.post('/login', data={'username': username, 'password': password})
+    return client
+
+
+def workload(m, args, readers, writers, plan_id):
+    stop = threading.Event()
+    lock = threading.Lock()
+    totals = {'reads': 0, 'checkouts': 0, 'failed': 0, 'errors': 0}
+    read_ms, write_ms = [], []
+
+    def reader(client):
+        while not stop.is_set():
+            started = time.perf_counter()
+            response = client.get(args.read_url)
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                if response.status_code == 200:
+                    totals['reads'] += 1
+                    read_ms.append(elapsed)
+                else:
+                    totals['errors'] += 1
+
+    def writer(client, card_id):
+        while not stop.is_set():
+            started = time.perf_counter()
+            response = client.post(f'/subscribe/{plan_id}', data={'payment_method_id': card_id},
+                                   headers={'X-Requested-With': 'XMLHttpRequest'})
+            elapsed = (time.perf_counter() - started) * 1000
+            ok = response.status_code == 200 and response.get_json()['success']
+            with lock:
+                if ok:
+                    totals['checkouts'] += 1
+                    write_ms.append(elapsed)
+                elif response.status_code == 200:
+                    totals['failed'] += 1
+                else:
+                    totals['errors'] += 1
+
+    threads = [threading.Thread(target=reader, args=(c,)) for c in readers]
+    threads += [threading.Thread(target=writer, args=w) for w in writers]
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    for name, timings in [('p95_read_ms', read_ms), ('p95_checkout_ms', write_ms)]:
+        timings.sort()
+        totals[name] = timings[int(len(timings) * 0.95)] if timings else 0
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscriptions', type=int, default=100000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per profile')
+    parser.add_argument('--read-url', default='/admin/dashboard',
+                        help='page the readers load; /admin/dashboard counts every subscription')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-sqlite-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    try:
+        run(m, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(m, args):
+    with m.app.app_context():
+        m.seed_data()
+        m.generate_data(users=max(args.readers + args.writers, args.subscriptions // 20),
+                        subscriptions=args.subscriptions, chats=0)
+        plan_id = m.Plan.query.filter_by(active=True).order_by(m.Plan.price).first().id
+    users = accounts(m, args.writers)
+
+    print(f"{'profile':<10}{'reads/s':>10}{'checkouts/s':>13}{'failed':>8}{'5xx':>6}{'p95 read ms':>13}"
+          f"{'p95 checkout ms':>17}")
+    for profile in m.STORAGE_PROFILES:
+        m.app.config['SQLITE_PRAGMAS'] = m.sqlite_pragmas(profile)
+        with m.app.app_context():
+            m.db.engine.dispose()
+        readers = [login(m, 'admin', 'admin123') for _ in range(args.readers)]
+        writers = [(login(m, username), card_id) for username, card_id in users]
+        totals = workload(m, args, readers, writers, plan_id)
+        print(f"{profile:<10}{totals['reads'] / args.duration:>10.1f}{totals['checkouts'] / args.duration:>13.1f}"
+              f"{totals['failed']:>8}{totals['errors']:>6}{totals['p95_read_ms']:>13.1f}"
+              f"{totals['p95_checkout_ms']:>17.1f}")
+
+
+if __name__ == '__main__':
+    main()
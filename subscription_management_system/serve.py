@@ -0,0 +1,206 @@
+"""Production entry point: a prefork WSGI server with the app loaded before fork.
+
+    python serve.py --workers 4 --threads 8 --bind 0.0.0.0:8000
+
+The app is created (create_app() runs its schema bootstrap) once in the
+master process; workers are forked from it and share the loaded code, plan
+catalog and compiled templates copy-on-write. Runs on gunicorn's threaded
+workers when gunicorn is installed, otherwise on a small prefork server
+built on werkzeug. Each option defaults to an environment variable
+(SERVE_BIND, SERVE_WORKERS, SERVE_THREADS, SERVE_BACKLOG, SERVE_TIMEOUT).
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # optional; the built-in server is used instead
+    BaseApplication = None
+
+from app import audit_sink, create_app, notification_hub
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """werkzeug server that handles requests on a fixed pool of threads.
+
+    At most `backlog` accepted connections wait for a thread; past that the
+    accept loop answers 503 with Retry-After instead of queueing more.
+    """
+
+    multithread = True
+    multiprocess = True
+    BUSY_RESPONSE = (
+        b'HTTP/1.0 503 Service Unavailable\r\n'
+        b'Retry-After: 1\r\n'
+        b'Content-Type: text/plain\r\n'
+        b'Content-Length: 20\r\n'
+        b'Connection: close\r\n'
+        b'\r\n'
+        b'Server is too busy.\n'
+    )
+
+    def __init__(self, *args, threads, backlog, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+        self.slots = threading.BoundedSemaphore(threads + backlog)  # running plus waiting requests
+        self.refused = 0
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.refused += 1
+            try:
+                request.sendall(self.BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+
+class RequestHandler(WSGIRequestHandler):
+    # One request per connection: an idle keep-alive connection would hold one
+    # of the worker's few threads
+    protocol_version = 'HTTP/1.0'
+
+
+def serve_builtin(app, host, port, workers, threads, backlog):
+    listener = socket.create_server((host, port), backlog=2048)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # no per-request access log
+    if workers == 1 or not hasattr(os, 'fork'):
+        server = PooledWSGIServer(host, port, app, handler=RequestHandler, fd=listener.fileno(),
+                                  threads=threads, backlog=backlog)
+        print(f'Serving on http://{host}:{port} (1 process, {threads} threads)', flush=True)
+        server.serve_forever()
+        return
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            children.add(pid)
+            return
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGINT, lambda signum, frame: sys.exit(0))
+        server = PooledWSGIServer(host, port, app, handler=RequestHandler, fd=listener.fileno(),
+                                  threads=threads, backlog=backlog)
+        try:
+            server.serve_forever()
+        except SystemExit:
+            pass
+        finally:
+            # Finish the requests in flight and write their audit entries;
+            # os._exit() skips the atexit handlers inherited from the master
+            notification_hub.close()
+            server.pool.shutdown(wait=True)
+            audit_sink.close()
+            os._exit(0)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    print(f'Serving on http://{host}:{port} ({workers} workers x {threads} threads)', flush=True)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f'Worker {pid} exited with status {status}, restarting', file=sys.stderr, flush=True)
+            spawn()
+
+
+def close_streams_on_exit(worker):
+    """End the notification streams first when gunicorn stops a worker."""
+    handle_exit = worker.handle_exit
+
+    def on_exit(signum, frame):
+        notification_hub.close()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, on_exit)
+
+
+def serve_gunicorn(app, bind, workers, threads, backlog, timeout):
+    options = {
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        'worker_connections': threads + backlog,  # further connections wait in the listen queue
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'timeout': timeout,
+        'post_worker_init': close_streams_on_exit,
+    }
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for name, value in options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bind', default=os.environ.get('SERVE_BIND', '127.0.0.1:8000'), help='host:port')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SERVE_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('SERVE_THREADS', 8)),
+                        help='request threads per worker; notification streams may hold half of them')
+    parser.add_argument('--backlog', type=int, default=int(os.environ.get('SERVE_BACKLOG', 64)),
+                        help='requests per worker that may wait for a thread; the built-in server answers 503 beyond that')
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('SERVE_TIMEOUT', 60)),
+                        help='seconds before gunicorn restarts a silent worker')
+    parser.add_argument('--server', choices=['auto', 'gunicorn', 'builtin'], default='auto')
+    args = parser.parse_args()
+
+    config = {}
+    if 'NOTIFICATION_MAX_STREAMS' not in os.environ:
+        # Keep at least half of every worker's threads for ordinary requests
+        config['NOTIFICATION_MAX_STREAMS'] = args.threads // 2
+    app = create_app(config)
+    server = args.server
+    if server == 'auto':
+        server = 'gunicorn' if BaseApplication is not None else 'builtin'
+    if server == 'gunicorn':
+        if BaseApplication is None:
+            parser.error('gunicorn is not installed (pip install gunicorn)')
+        serve_gunicorn(app, args.bind, args.workers, args.threads, args.backlog, args.timeout)
+    else:
+        host, _, port = args.bind.rpartition(':')
+        serve_builtin(app, host or '127.0.0.1', int(port), args.workers, args.threads, args.backlog)
+
+
+if __name__ == '__main__':
+    main()